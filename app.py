@@ -2,20 +2,95 @@
 # HỆ THỐNG BÁO CÁO THỜI GIAN NHẬP HÀNG - VERCEL DEPLOYMENT
 
 import os
+import hashlib
 import json
-import pandas as pd
-import gradio as gr
-from datetime import datetime
+import time
+import importlib.util
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+import threading
 import traceback
 
+# ========== STARTUP PROFILE ==========
+class StartupProfile:
+    """Time spent per import and per create_app phase during a cold start.
+    
+    Enabled with STARTUP_PROFILE=1; the report is printed once the module
+    has finished loading. When disabled a phase costs one attribute check.
+    """
+    
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.started = time.perf_counter()
+        self.phases = []
+        self._depth = 0
+        self._lap_started = self.started
+    
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = self._lap_started = time.perf_counter()
+        # Reserve the slot so the phase is listed before its laps
+        index = len(self.phases)
+        self.phases.append((self._depth, name, 0.0))
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            self.phases[index] = (self._depth, name, time.perf_counter() - start)
+    
+    def lap(self, name):
+        """Record the time since the enclosing phase started or the previous lap"""
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self.phases.append((self._depth, name, now - self._lap_started))
+        self._lap_started = now
+    
+    def report(self, budget=None):
+        total = time.perf_counter() - self.started
+        return {
+            "total_s": round(total, 4),
+            "budget_s": budget,
+            "within_budget": budget is None or total <= budget,
+            "phases": [{"name": name, "depth": depth, "seconds": round(seconds, 4)}
+                       for depth, name, seconds in self.phases]
+        }
+    
+    def print_report(self, budget=None):
+        report = self.report(budget)
+        print("📊 Startup profile:")
+        for item in report["phases"]:
+            print(f"   {'  ' * item['depth']}{item['name']:<32} {item['seconds'] * 1000:8.1f} ms")
+        status = "✅" if report["within_budget"] else "⚠️ over budget"
+        print(f"   {'total':<32} {report['total_s'] * 1000:8.1f} ms  {status} (budget {budget}s)")
+        print(json.dumps(report))
+
+STARTUP = StartupProfile(os.getenv("STARTUP_PROFILE") == "1")
+
+with STARTUP.phase("import gradio"):
+    import gradio as gr
+
+# gr.Dataframe components load pandas while the UI is built anyway
+with STARTUP.phase("import pandas"):
+    import pandas as pd
+
 # ========== IMPORTS FOR GOOGLE SHEETS ==========
-try:
-    import gspread
-    from google.oauth2.service_account import Credentials
-    from google.auth.transport.requests import Request
-    GOOGLE_AVAILABLE = True
-except ImportError:
-    GOOGLE_AVAILABLE = False
+# The Google stack is imported by the client pool on first use, not at
+# module load: only check that it is installed.
+def _module_available(name):
+    try:
+        return importlib.util.find_spec(name) is not None
+    except ModuleNotFoundError:
+        return False
+
+with STARTUP.phase("probe google stack"):
+    GOOGLE_AVAILABLE = _module_available("gspread") and _module_available("google.oauth2")
+if not GOOGLE_AVAILABLE:
     print("⚠️ Google dependencies not installed")
 
 # ========== CẤU HÌNH HỆ THỐNG ==========
@@ -28,7 +103,17 @@ SYSTEM_CONFIG = {
         "Tháng 4": "T4", "Tháng 5": "T5", "Tháng 6": "T6",
         "Tháng 7": "T7", "Tháng 8": "T8", "Tháng 9": "T9",
         "Tháng 10": "T10", "Tháng 11": "T11", "Tháng 12": "T12"
-    }
+    },
+    # Refresh the OAuth token this many seconds before it expires
+    "token_refresh_margin": 300,
+    # Max keep-alive connections to the Google APIs
+    "http_pool_size": 16,
+    # Trucks weighed in after this time count as late
+    "late_cutoff": "17:00:00",
+    # Cold-start budget (seconds) checked by the startup profile, well inside maxDuration 60
+    "cold_start_budget": 15,
+    # Exported report files, reused while the data is unchanged
+    "export_dir": os.getenv("EXPORT_DIR", os.path.join(tempfile.gettempdir(), "kieutimes-exports"))
 }
 
 # ========== CSS CUSTOM ==========
@@ -77,43 +162,122 @@ CUSTOM_CSS = """
 """
 
 # ========== GOOGLE SHEETS HELPER ==========
-def get_google_client():
-    """Get Google Sheets client with Vercel environment support"""
-    try:
-        if not GOOGLE_AVAILABLE:
-            return None
-        
-        # Vercel Environment Variable
-        if 'GOOGLE_CREDS_JSON' in os.environ:
-            creds_json = os.environ['GOOGLE_CREDS_JSON']
-            creds_dict = json.loads(creds_json)
-        elif os.path.exists('credentials.json'):
-            with open('credentials.json', 'r', encoding='utf-8') as f:
-                creds_dict = json.load(f)
-        else:
+GOOGLE_SCOPES = [
+    'https://www.googleapis.com/auth/spreadsheets',
+    'https://www.googleapis.com/auth/drive'
+]
+
+def load_credentials_dict():
+    """Read service account info from the Vercel env or credentials.json"""
+    # Vercel Environment Variable
+    if 'GOOGLE_CREDS_JSON' in os.environ:
+        creds_dict = json.loads(os.environ['GOOGLE_CREDS_JSON'])
+    elif os.path.exists('credentials.json'):
+        with open('credentials.json', 'r', encoding='utf-8') as f:
+            creds_dict = json.load(f)
+    else:
+        return None
+    
+    # Fix private key formatting
+    if 'private_key' in creds_dict:
+        creds_dict['private_key'] = creds_dict['private_key'].replace('\\n', '\n')
+    return creds_dict
+
+class SheetsClientPool:
+    """Process-wide authorized gspread client.
+    
+    Keeps one client on a keep-alive HTTP session, refreshes the OAuth token
+    before it expires and is safe to share between Gradio worker threads.
+    """
+    
+    def __init__(self, refresh_margin=None, pool_size=None):
+        if refresh_margin is None:
+            refresh_margin = SYSTEM_CONFIG["token_refresh_margin"]
+        if pool_size is None:
+            pool_size = SYSTEM_CONFIG["http_pool_size"]
+        self._lock = threading.Lock()
+        self._refresh_margin = timedelta(seconds=refresh_margin)
+        self._pool_size = pool_size
+        self._credentials = None
+        self._auth_request = None
+        self._client = None
+    
+    def _needs_refresh(self):
+        credentials = self._credentials
+        if credentials is None or not credentials.token or credentials.expiry is None:
+            return True
+        # google-auth stores expiry as a naive UTC datetime
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        return credentials.expiry - now <= self._refresh_margin
+    
+    def _build_client(self):
+        creds_dict = load_credentials_dict()
+        if creds_dict is None:
             print("❌ No Google credentials found")
             return None
         
-        # Fix private key formatting
-        if 'private_key' in creds_dict:
-            creds_dict['private_key'] = creds_dict['private_key'].replace('\\n', '\n')
+        import gspread
+        import requests
+        from requests.adapters import HTTPAdapter
+        from google.oauth2.service_account import Credentials
+        from google.auth.transport.requests import AuthorizedSession, Request
+        
+        credentials = Credentials.from_service_account_info(creds_dict, scopes=GOOGLE_SCOPES)
+        
+        # Separate session for token requests, keep-alive session for Sheets API
+        token_session = requests.Session()
+        token_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        auth_request = Request(token_session)
         
-        scope = [
-            'https://www.googleapis.com/auth/spreadsheets',
-            'https://www.googleapis.com/auth/drive'
-        ]
+        session = AuthorizedSession(credentials, auth_request=auth_request)
+        session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=self._pool_size))
         
-        credentials = Credentials.from_service_account_info(creds_dict, scopes=scope)
-        client = gspread.authorize(credentials)
+        credentials.refresh(auth_request)
+        self._credentials = credentials
+        self._auth_request = auth_request
         print("✅ Google Sheets connected!")
-        return client
+        return gspread.Client(auth=credentials, session=session)
+    
+    def get_client(self):
+        """Return the shared client, building it or refreshing its token when needed"""
+        client = self._client
+        if client is not None and not self._needs_refresh():
+            return client
+        
+        with self._lock:
+            if self._client is None:
+                self._client = self._build_client()
+            elif self._needs_refresh():
+                self._credentials.refresh(self._auth_request)
+            return self._client
+    
+    def reset(self):
+        """Drop the current client (e.g. after a credentials change)"""
+        with self._lock:
+            self._client = None
+            self._credentials = None
+            self._auth_request = None
+
+CLIENT_POOL = SheetsClientPool()
+
+def get_google_client():
+    """Get Google Sheets client with Vercel environment support"""
+    try:
+        if not GOOGLE_AVAILABLE:
+            return None
+        
+        return CLIENT_POOL.get_client()
         
     except Exception as e:
         print(f"❌ Google connection error: {e}")
         traceback.print_exc()
+        CLIENT_POOL.reset()
         return None
 
 # ========== DATA PROCESSING ==========
+DEMO_COLUMNS = ['Ngày', 'Số xe', 'Nguyên liệu', 'Xe cân vào', 'Xe cân ra',
+                'Tổng thời gian', 'Số lượng', 'Net Weight (kg)', 'Nguyên nhân']
+
 def demo_read_data(month):
     """Demo function for testing without Google Sheets"""
     try:
@@ -134,6 +298,102 @@ def demo_read_data(month):
     except Exception as e:
         return pd.DataFrame(), f"❌ Lỗi: {str(e)}"
 
+# ========== MONTH SUMMARY (DASHBOARD) ==========
+def summarize_month_frame(df):
+    """Additive totals (count, late, weight, duration) for a block of rows"""
+    if df.empty:
+        return {"count": 0, "late_count": 0, "weight_sum": 0.0, "duration_sum": 0.0}
+    
+    def column(name):
+        return df[name] if name in df.columns else pd.Series(pd.NA, index=df.index, dtype=object)
+    
+    arrival = pd.to_timedelta(column('Xe cân vào').astype('string'), errors='coerce')
+    duration = pd.to_timedelta(column('Tổng thời gian').astype('string'), errors='coerce')
+    weight = pd.to_numeric(column('Net Weight (kg)'), errors='coerce')
+    return {
+        "count": len(df),
+        "late_count": int((arrival > pd.to_timedelta(SYSTEM_CONFIG["late_cutoff"])).sum()),
+        "weight_sum": float(weight.sum()),
+        "duration_sum": float(duration.dt.total_seconds().sum())
+    }
+
+class MonthSummaryStore:
+    """Materialized per-month totals so the dashboard renders in constant time"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._summaries = {}
+    
+    def replace(self, month, summary):
+        with self._lock:
+            self._summaries[month] = dict(summary)
+    
+    def get(self, month):
+        with self._lock:
+            summary = self._summaries.get(month)
+            return dict(summary) if summary is not None else None
+
+SUMMARY_STORE = MonthSummaryStore()
+
+# ========== EXPORT ==========
+EXCEL_AVAILABLE = _module_available("openpyxl")
+
+def export_report_file(month):
+    """Write the month's report to .xlsx (CSV without openpyxl), cached by data version"""
+    df, _ = demo_read_data(month)
+    if df.empty:
+        return None
+    
+    ext = "xlsx" if EXCEL_AVAILABLE else "csv"
+    version = f"{int(pd.util.hash_pandas_object(df, index=False).sum()) & 0xFFFFFFFFFFFFFFFF:016x}"
+    digest = hashlib.sha1(f"{month}|{ext}|{len(df)}|{version}".encode("utf-8")).hexdigest()[:16]
+    path = os.path.join(SYSTEM_CONFIG["export_dir"], digest, f"BaoCao_{SYSTEM_CONFIG['month_mapping'].get(month, 'T1')}.{ext}")
+    if os.path.exists(path):
+        return path
+    
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path[:-len(ext) - 1]}.{os.getpid()}.tmp.{ext}"
+    if EXCEL_AVAILABLE:
+        df.to_excel(tmp_path, index=False, engine="openpyxl")
+    else:
+        df.to_csv(tmp_path, index=False, encoding="utf-8-sig")
+    os.replace(tmp_path, path)
+    return path
+
+def render_dashboard_cards(month):
+    """Dashboard metric cards for a month, read from SUMMARY_STORE"""
+    summary = SUMMARY_STORE.get(month)
+    total, late, note = "--", "--", "Chưa tải dữ liệu"
+    if summary is not None:
+        total = str(summary["count"])
+        late = str(summary["late_count"])
+        rate = summary["late_count"] / summary["count"] if summary["count"] else 0.0
+        note = f"{rate:.0%} tổng số xe"
+    
+    return [
+        f"""
+                                <div class="metric-box">
+                                    <div style="color: #6b7280; font-size: 0.9rem;">THÁNG HIỆN TẠI</div>
+                                    <div style="font-size: 2rem; font-weight: 700; color: #3b82f6;">{month}</div>
+                                    <div style="font-size: 0.8rem; color: #9ca3af; margin-top: 0.5rem;">Dữ liệu cập nhật</div>
+                                </div>
+                                """,
+        f"""
+                                <div class="metric-box">
+                                    <div style="color: #6b7280; font-size: 0.9rem;">TỔNG XE NHẬP</div>
+                                    <div style="font-size: 2rem; font-weight: 700; color: #10b981;">{total}</div>
+                                    <div style="font-size: 0.8rem; color: #9ca3af; margin-top: 0.5rem;">{month}</div>
+                                </div>
+                                """,
+        f"""
+                                <div class="metric-box">
+                                    <div style="color: #6b7280; font-size: 0.9rem;">XE NHẬP TRỄ</div>
+                                    <div style="font-size: 2rem; font-weight: 700; color: #ef4444;">{late}</div>
+                                    <div style="font-size: 0.8rem; color: #9ca3af; margin-top: 0.5rem;">{note}</div>
+                                </div>
+                                """
+    ]
+
 # ========== UI COMPONENTS ==========
 def create_header():
     """Create application header"""
@@ -202,13 +462,16 @@ def create_app():
         ),
         css=CUSTOM_CSS
     ) as app:
+        STARTUP.lap("blocks + theme")
         
         create_header()
+        STARTUP.lap("header")
         
         with gr.Row():
             # Sidebar
             with gr.Column(scale=1, min_width=280):
                 create_sidebar()
+            STARTUP.lap("sidebar")
             
             # Main content
             with gr.Column(scale=4):
@@ -218,33 +481,16 @@ def create_app():
                         gr.Markdown("## 📊 TỔNG QUAN HỆ THỐNG")
                         
                         # Metrics
+                        cards = render_dashboard_cards("Tháng 1")
                         with gr.Row():
                             with gr.Column():
-                                metric1 = gr.HTML("""
-                                <div class="metric-box">
-                                    <div style="color: #6b7280; font-size: 0.9rem;">THÁNG HIỆN TẠI</div>
-                                    <div style="font-size: 2rem; font-weight: 700; color: #3b82f6;">Tháng 1</div>
-                                    <div style="font-size: 0.8rem; color: #9ca3af; margin-top: 0.5rem;">Dữ liệu cập nhật</div>
-                                </div>
-                                """)
+                                metric1 = gr.HTML(cards[0])
                             
                             with gr.Column():
-                                metric2 = gr.HTML("""
-                                <div class="metric-box">
-                                    <div style="color: #6b7280; font-size: 0.9rem;">TỔNG XE NHẬP</div>
-                                    <div style="font-size: 2rem; font-weight: 700; color: #10b981;">48</div>
-                                    <div style="font-size: 0.8rem; color: #9ca3af; margin-top: 0.5rem;">Từ 01/01/2025</div>
-                                </div>
-                                """)
+                                metric2 = gr.HTML(cards[1])
                             
                             with gr.Column():
-                                metric3 = gr.HTML("""
-                                <div class="metric-box">
-                                    <div style="color: #6b7280; font-size: 0.9rem;">XE NHẬP TRỄ</div>
-                                    <div style="font-size: 2rem; font-weight: 700; color: #ef4444;">12</div>
-                                    <div style="font-size: 0.8rem; color: #9ca3af; margin-top: 0.5rem;">25% tổng số xe</div>
-                                </div>
-                                """)
+                                metric3 = gr.HTML(cards[2])
                         
                         # Quick Actions
                         gr.Markdown("### ⚡ HÀNH ĐỘNG NHANH")
@@ -253,16 +499,16 @@ def create_app():
                             quick2 = gr.Button("📥 Nhập Excel", size="lg", variant="primary")
                             quick3 = gr.Button("📊 Xem báo cáo", size="lg")
                         
-                        # Data Table
+                        # Data Table (demo data is built on page load, not at import)
                         gr.Markdown("### 📋 DỮ LIỆU MẪU")
-                        sample_df, _ = demo_read_data("Tháng 1")
                         data_table = gr.Dataframe(
-                            value=sample_df,
-                            headers=list(sample_df.columns),
+                            headers=DEMO_COLUMNS,
                             height=300,
                             interactive=False
                         )
                     
+                    STARTUP.lap("tab dashboard")
+                    
                     # Tab 2: Nhập dữ liệu
                     with gr.Tab("📥 Nhập dữ liệu"):
                         gr.Markdown("## 📥 NHẬP DỮ LIỆU TỪ EXCEL")
@@ -301,6 +547,8 @@ def create_app():
                             height=200
                         )
                     
+                    STARTUP.lap("tab input")
+                    
                     # Tab 3: Báo cáo
                     with gr.Tab("📈 Báo cáo"):
                         gr.Markdown("## 📈 BÁO CÁO CHI TIẾT")
@@ -321,6 +569,9 @@ def create_app():
                         )
                         
                         report_status = gr.Markdown("**Trạng thái:** Chờ tải dữ liệu")
+                        export_file = gr.File(label="File xuất", visible=False, interactive=False)
+                    
+                    STARTUP.lap("tab report")
                     
                     # Tab 4: Thống kê
                     with gr.Tab("📊 Thống kê"):
@@ -348,22 +599,41 @@ def create_app():
                         gr.Markdown("### 📈 BIỂU ĐỒ PHÂN BỐ")
                         chart_placeholder = gr.Plot(value=None, label="Biểu đồ sẽ hiển thị ở đây")
         
+        STARTUP.lap("tab stats")
+        
         # ========== EVENT HANDLERS ==========
         def load_report_handler(month):
             """Handle report loading"""
             try:
                 df, status = demo_read_data(month)
                 if not df.empty:
-                    return df, f"✅ Đã tải dữ liệu {month}: {len(df)} dòng"
+                    SUMMARY_STORE.replace(month, summarize_month_frame(df))
+                    return df, f"✅ Đã tải dữ liệu {month}: {len(df)} dòng", *render_dashboard_cards(month)
                 else:
-                    return pd.DataFrame(), "📭 Không có dữ liệu"
+                    return pd.DataFrame(), "📭 Không có dữ liệu", *render_dashboard_cards(month)
             except Exception as e:
-                return pd.DataFrame(), f"❌ Lỗi: {str(e)}"
+                return pd.DataFrame(), f"❌ Lỗi: {str(e)}", *render_dashboard_cards(month)
         
         load_btn.click(
             load_report_handler,
             inputs=[report_month],
-            outputs=[report_data, report_status]
+            outputs=[report_data, report_status, metric1, metric2, metric3]
+        )
+        
+        def export_report_handler(month):
+            """Handle report export"""
+            try:
+                path = export_report_file(month)
+                if path is None:
+                    return gr.File(visible=False), "📭 Không có dữ liệu để xuất"
+                return gr.File(value=path, visible=True), f"✅ Đã xuất {month}: {os.path.basename(path)}"
+            except Exception as e:
+                return gr.File(visible=False), f"❌ Lỗi xuất file: {str(e)}"
+        
+        export_btn.click(
+            export_report_handler,
+            inputs=[report_month],
+            outputs=[export_file, report_status]
         )
         
         def preview_paste_handler(text):
@@ -387,12 +657,20 @@ def create_app():
             inputs=[paste_area],
             outputs=[preview_table, status_display]
         )
+        
+        # Demo data is built on demand when a page loads
+        app.load(lambda: demo_read_data("Tháng 1")[0], outputs=[data_table])
+        STARTUP.lap("events")
     
     return app
 
 # ========== VERCEL DEPLOYMENT ==========
 # Vercel cần biến môi trường
-app = create_app()
+with STARTUP.phase("create_app"):
+    app = create_app()
+
+if STARTUP.enabled:
+    STARTUP.print_report(SYSTEM_CONFIG["cold_start_budget"])
 
 # For Vercel serverless function
 if __name__ == "__main__":
@@ -3,16 +3,53 @@
 import gradio as gr
 import pandas as pd
 import numpy as np
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    SNAPSHOTS_AVAILABLE = True
+except ImportError:
+    SNAPSHOTS_AVAILABLE = False
+try:
+    import openpyxl
+    EXCEL_AVAILABLE = True
+except ImportError:
+    EXCEL_AVAILABLE = False
 import gspread
+from gspread.exceptions import APIError, WorksheetNotFound
+from gspread.http_client import HTTPClient
+from gspread.spreadsheet import Spreadsheet
+from gspread.utils import absolute_range_name, extract_id_from_url, rowcol_to_a1
+from gspread.worksheet import Worksheet
+import requests
+from requests.adapters import HTTPAdapter
+from fastapi import FastAPI, Response
+import uvicorn
 from google.oauth2.service_account import Credentials
-from datetime import datetime, timedelta
+from google.auth.transport.requests import AuthorizedSession, Request
+from datetime import date, datetime, time as dt_time, timedelta, timezone
+import asyncio
+import bisect
+import contextlib
+import csv
+import functools
+import hashlib
+import heapq
+import inspect
 import io
+import itertools
 import time
 import json
+import math
 import re
 import os
+import shutil
+import random
 import sys
-from io import BytesIO
+import tempfile
+import threading
+import uuid
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor, wait as wait_futures
 import traceback
 
 # ========== CẤU HÌNH HỆ THỐNG ==========
@@ -26,7 +63,93 @@ SYSTEM_CONFIG = {
         "Tháng 4": "T4", "Tháng 5": "T5", "Tháng 6": "T6",
         "Tháng 7": "T7", "Tháng 8": "T8", "Tháng 9": "T9",
         "Tháng 10": "T10", "Tháng 11": "T11", "Tháng 12": "T12"
-    }
+    },
+    # Làm mới OAuth token trước khi hết hạn (giây)
+    "token_refresh_margin": 300,
+    # Số kết nối keep-alive tối đa tới Google API
+    "http_pool_size": 16,
+    # Thời gian dữ liệu tháng trong cache được coi là mới (giây)
+    "sheet_cache_ttl": 60,
+    # Nguồn dữ liệu: "google" hoặc "fake" (Google Sheets giả lập trong bộ nhớ, xem fake_sheets.py)
+    "sheets_backend": os.getenv("SHEETS_BACKEND", "google"),
+    # Thư mục lưu snapshot Parquet của từng tháng (trên Vercel chỉ /tmp ghi được);
+    # dữ liệu giả lập dùng thư mục riêng để không lẫn với snapshot thật
+    "snapshot_dir": os.getenv("SNAPSHOT_DIR", os.path.join(
+        tempfile.gettempdir(),
+        "kieutimes-snapshots-fake" if os.getenv("SHEETS_BACKEND") == "fake" else "kieutimes-snapshots"
+    )),
+    # Metadata spreadsheet (tiêu đề, id, số dòng các worksheet) được lấy lại sau chừng này giây
+    "sheet_metadata_ttl": 600,
+    # Số dòng mỗi lần đọc từ sheet
+    "sheet_page_size": 500,
+    # Gặp liên tiếp chừng này dòng trống thì coi như hết dữ liệu
+    "sheet_empty_block": 50,
+    # Đọc nhiều spreadsheet (năm/kho) cùng lúc: số spreadsheet song song, thời gian chờ tối đa (giây)
+    "registry_max_workers": 4,
+    "registry_timeout": 45,
+    # Số vùng tháng tối đa trong một lần gọi values.batchGet
+    "year_batch_size": 12,
+    # Số ô tối đa trong một lần gọi values.batchUpdate khi ghi
+    "write_chunk_cells": 100000,
+    # Số lời gọi Google Sheets chạy đồng thời từ các handler async
+    "max_sheets_in_flight": 8,
+    # Quota Google Sheets API (lượt/phút/người dùng) và chính sách thử lại
+    "sheets_read_quota": 60,
+    "sheets_write_quota": 60,
+    "sheets_max_retries": 5,
+    "sheets_backoff_base": 1.0,
+    "sheets_backoff_max": 32.0,
+    # Chờ (giây) sau lần gõ cuối trước khi phân tích lại preview dữ liệu dán
+    "paste_debounce": 0.3,
+    # Số dòng mỗi trang của bảng báo cáo
+    "report_page_size": 50,
+    # Số dòng cuối hiển thị trong danh sách nhập thủ công
+    "manual_display_rows": 20,
+    # Số dòng mỗi khối khi đọc file Excel tải lên
+    "upload_chunk_rows": 2000,
+    # File xuất báo cáo: thư mục cache, số file giữ lại, số dòng mỗi khối khi ghi
+    "export_dir": os.getenv("EXPORT_DIR", os.path.join(tempfile.gettempdir(), "kieutimes-exports")),
+    "export_cache_files": 20,
+    "export_chunk_rows": 5000,
+    # Mốc histogram độ trễ (giây) của chỉ số /metrics
+    "metrics_buckets": (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+    # Nhật ký các lượt lưu chưa ghi lên Google Sheets (trên Vercel chỉ /tmp ghi được)
+    "journal_dir": os.getenv("JOURNAL_DIR", os.path.join(
+        tempfile.gettempdir(),
+        "kieutimes-journal-fake" if os.getenv("SHEETS_BACKEND") == "fake" else "kieutimes-journal"
+    )),
+    # Chờ (giây) trước khi ghi để gộp các lượt lưu liên tiếp của cùng một tháng
+    "save_flush_delay": 1.0,
+    # Ghi lỗi thì thử lại sau base * 2^n giây, tối đa max giây
+    "save_retry_base": 5.0,
+    "save_retry_max": 300.0,
+    # Dòng đầu tiên của vùng dữ liệu trên sheet tháng (A7)
+    "data_start_row": 7,
+    # Xe cân vào sau giờ này là nhập trễ
+    "late_cutoff": "17:00:00",
+    # Tổng thời gian vượt ngưỡng này là nhập chậm
+    "slow_threshold": "02:00:00"
+}
+
+# Vùng dữ liệu trên sheet tháng: cột A đến U, bắt đầu từ dòng tiêu đề
+SHEET_FIRST_COLUMN = "A"
+SHEET_LAST_COLUMN = "U"
+SHEET_WIDTH = ord(SHEET_LAST_COLUMN) - ord(SHEET_FIRST_COLUMN) + 1
+SHEET_HEADER_MARKER = "Ngày/tháng"
+
+# Tên cột trên sheet -> tên cột trong DataFrame
+COLUMN_MAPPING = {
+    'Ngày/tháng': 'date',
+    'Số Xe': 'so_xe',
+    'Tên nguyên liệu': 'nguyen_lieu',
+    'Xe cân VÀO': 'xe_can_vao',
+    'Xe cân RA': 'xe_can_ra',
+    'Tổng thời gian': 'tong_thoi_gian',
+    'Số lượng': 'so_luong',
+    'Bag.': 'bag',
+    'Net.Wgh. (kg)': 'net_weight',
+    'Nguyên nhân': 'nguyen_nhan',
+    'Lí do chi tiết': 'ly_do_chi_tiet'
 }
 
 # ========== CSS TÙY CHỈNH ==========
@@ -63,184 +186,2679 @@ CUSTOM_CSS = """
 </style>
 """
 
-# ========== HÀM KẾT NỐI GOOGLE SHEETS ==========
-def get_google_client():
-    """Kết nối đến Google Sheets - An toàn cho production"""
-    try:
-        # Ưu tiên Environment Variables (Vercel)
-        if 'GOOGLE_CREDS_JSON' in os.environ:
-            creds_json = os.environ['GOOGLE_CREDS_JSON']
-            creds_dict = json.loads(creds_json)
-        # Hoặc file local (development)
-        elif os.path.exists('credentials.json'):
-            with open('credentials.json', 'r', encoding='utf-8') as f:
-                creds_dict = json.load(f)
+# ========== CHỈ SỐ GIÁM SÁT (PROMETHEUS) ==========
+METRICS_PREFIX = "kieutimes"
+
+class MetricsRegistry:
+    """Counter và histogram trong bộ nhớ, xuất theo định dạng text của Prometheus.
+
+    Mỗi lần ghi chỉ là một phép cộng dưới lock (histogram thêm một lần
+    bisect) nên có thể luôn bật. Số liệu sẵn có của các cache và scheduler
+    được đọc lúc xuất qua các collector.
+    """
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or SYSTEM_CONFIG["metrics_buckets"])
+        self._lock = threading.Lock()
+        self._meta = {}          # tên -> (kiểu, mô tả)
+        self._counters = {}      # (tên, nhãn) -> giá trị
+        self._histograms = {}    # (tên, nhãn) -> [đếm từng bucket..., +Inf, tổng]
+        self._collectors = []
+
+    def describe(self, name, kind, text):
+        self._meta[f"{METRICS_PREFIX}_{name}"] = (kind, text)
+
+    def inc(self, name, value=1, **labels):
+        key = (f"{METRICS_PREFIX}_{name}", tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (f"{METRICS_PREFIX}_{name}", tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._histograms.get(key)
+            if counts is None:
+                counts = self._histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def collector(self, fn):
+        """fn() -> các bộ (tên, giá trị, nhãn) đọc tại thời điểm xuất"""
+        self._collectors.append(fn)
+        return fn
+
+    @staticmethod
+    def _labels(labels, **extra):
+        items = list(labels) + list(extra.items())
+        if not items:
+            return ""
+        escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in items)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + "}"
+
+    def render(self):
+        with self._lock:
+            samples = {}
+            for (name, labels), value in self._counters.items():
+                samples.setdefault(name, []).append(f"{name}{self._labels(labels)} {value}")
+            for (name, labels), counts in self._histograms.items():
+                lines = samples.setdefault(name, [])
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(float(bound))
+                    lines.append(f"{name}_bucket{self._labels(labels, le=le)} {cumulative}")
+                lines.append(f"{name}_sum{self._labels(labels)} {counts[-1]}")
+                lines.append(f"{name}_count{self._labels(labels)} {cumulative}")
+
+        for collect in self._collectors:
+            try:
+                for name, value, labels in collect():
+                    name = f"{METRICS_PREFIX}_{name}"
+                    samples.setdefault(name, []).append(f"{name}{self._labels(sorted(labels.items()))} {value}")
+            except Exception as e:
+                print(f"⚠️ Lỗi thu thập chỉ số: {str(e)}")
+
+        out = []
+        for name in sorted(samples):
+            kind, text = self._meta.get(name, ("untyped", ""))
+            out.append(f"# HELP {name} {text}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(samples[name])
+        return "\n".join(out) + "\n"
+
+METRICS = MetricsRegistry()
+METRICS.describe("handler_duration_seconds", "histogram", "Thời gian chạy handler Gradio")
+METRICS.describe("handler_exceptions_total", "counter", "Số lần handler Gradio ném lỗi")
+METRICS.describe("sheets_requests_total", "counter", "Số request Google Sheets API theo thao tác và kết quả")
+METRICS.describe("sheets_request_duration_seconds", "histogram", "Thời gian mỗi request Google Sheets API (không gồm thời gian chờ quota)")
+METRICS.describe("sheets_rows_total", "counter", "Số dòng đọc/ghi theo sheet tháng")
+METRICS.describe("sheets_bytes_total", "counter", "Số byte UTF-8 giá trị ô đọc/ghi theo sheet tháng")
+METRICS.describe("sheets_scheduler_events_total", "counter", "Sự kiện của bộ điều phối quota")
+METRICS.describe("sheets_scheduler_wait_seconds_total", "counter", "Tổng thời gian chờ quota")
+METRICS.describe("sheets_scheduler_waiting", "gauge", "Số lời gọi đang chờ quota")
+METRICS.describe("sheets_gateway_in_flight", "gauge", "Số lời gọi Sheets đang chạy từ handler async")
+METRICS.describe("month_cache_events_total", "counter", "Hit/miss của cache dữ liệu tháng")
+METRICS.describe("month_cache_entries", "gauge", "Số tháng đang có trong cache")
+METRICS.describe("month_cache_hit_ratio", "gauge", "Tỉ lệ lượt đọc được phục vụ từ cache hoặc snapshot")
+METRICS.describe("export_cache_events_total", "counter", "Hit/miss của cache file xuất")
+METRICS.describe("sheet_handle_events_total", "counter", "Tra cứu worksheet trong cache handle và số lần lấy lại metadata")
+METRICS.describe("save_queue_events_total", "counter", "Sự kiện của hàng đợi ghi nền")
+METRICS.describe("save_queue_pending", "gauge", "Số lượt lưu đang chờ ghi lên Google Sheets")
+
+@METRICS.collector
+def collect_runtime_metrics():
+    """Số liệu sẵn có của scheduler, gateway và các cache"""
+    scheduler = SHEETS_SCHEDULER.stats()
+    for event in ("calls", "throttled", "quota_errors", "retried", "failed"):
+        yield "sheets_scheduler_events_total", scheduler[event], {"event": event}
+    yield "sheets_scheduler_wait_seconds_total", scheduler["wait_seconds"], {}
+    yield "sheets_scheduler_waiting", scheduler["waiting"], {}
+
+    yield "sheets_gateway_in_flight", SHEETS_GATEWAY.stats()["in_flight"], {}
+
+    cache = MONTH_CACHE.stats()
+    for event in ("hits", "stale_hits", "misses", "snapshot_hits", "coalesced", "refreshes", "refresh_errors"):
+        yield "month_cache_events_total", cache[event], {"event": event}
+    yield "month_cache_entries", cache["entries"], {}
+    yield "month_cache_hit_ratio", cache["hit_rate"], {}
+
+    for event, value in EXPORT_CACHE.stats().items():
+        yield "export_cache_events_total", value, {"event": event}
+
+    handles = SHEET_HANDLES.stats()
+    for event in ("hits", "misses", "refreshes"):
+        yield "sheet_handle_events_total", handles[event], {"event": event}
+
+    queue = SAVE_QUEUE.stats()
+    for event in ("saved", "replayed", "writes", "merged", "write_errors"):
+        yield "save_queue_events_total", queue[event], {"event": event}
+    yield "save_queue_pending", queue["pending"], {}
+
+def instrumented(fn):
+    """Đo thời gian handler Gradio (hàm thường, async hoặc async generator)"""
+    name = fn.__name__
+
+    def record(started, failed):
+        METRICS.observe("handler_duration_seconds", time.perf_counter() - started, handler=name)
+        if failed:
+            METRICS.inc("handler_exceptions_total", handler=name)
+
+    if inspect.isasyncgenfunction(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            started, failed = time.perf_counter(), False
+            try:
+                async for item in fn(*args, **kwargs):
+                    yield item
+            except Exception:
+                failed = True
+                raise
+            finally:
+                record(started, failed)
+    elif inspect.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            started, failed = time.perf_counter(), False
+            try:
+                return await fn(*args, **kwargs)
+            except Exception:
+                failed = True
+                raise
+            finally:
+                record(started, failed)
+    else:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started, failed = time.perf_counter(), False
+            try:
+                return fn(*args, **kwargs)
+            except Exception:
+                failed = True
+                raise
+            finally:
+                record(started, failed)
+    return wrapper
+
+def _values_bytes(rows):
+    return sum(len(''.join(map(str, row)).encode('utf-8')) for row in rows)
+
+def record_sheet_io(direction, sheet_name, rows):
+    """Cộng số dòng và byte giá trị ô đã đọc ("read") hoặc ghi ("write")"""
+    METRICS.inc("sheets_rows_total", len(rows), direction=direction, sheet=sheet_name)
+    METRICS.inc("sheets_bytes_total", _values_bytes(rows), direction=direction, sheet=sheet_name)
+
+# "/spreadsheets/<id>/values/<vùng>:append" -> ("values", "append")
+_SHEETS_API_PATH = re.compile(r'/spreadsheets/[^/:]+(?:/(values|sheets)(?:/[^:]*)?)?(?::(\w+))?$')
+
+def sheets_operation(method, url):
+    """Tên thao tác Google API của một request, dùng làm nhãn chỉ số"""
+    path = url.split('?', 1)[0]
+    match = _SHEETS_API_PATH.search(path)
+    if match is None:
+        return "drive" if "/drive/" in path else "other"
+    resource, action = match.groups()
+    if action is None:
+        action = "get" if method.upper() == "GET" else "update"
+    return f"{resource or 'spreadsheets'}.{action}"
+
+# ========== HÀM KẾT NỐI GOOGLE SHEETS ==========
+GOOGLE_SCOPES = [
+    'https://www.googleapis.com/auth/spreadsheets',
+    'https://www.googleapis.com/auth/drive'
+]
+
+def load_credentials_dict():
+    """Đọc service account từ Environment Variables (Vercel) hoặc credentials.json"""
+    # Ưu tiên Environment Variables (Vercel)
+    if 'GOOGLE_CREDS_JSON' in os.environ:
+        creds_dict = json.loads(os.environ['GOOGLE_CREDS_JSON'])
+    # Hoặc file local (development)
+    elif os.path.exists('credentials.json'):
+        with open('credentials.json', 'r', encoding='utf-8') as f:
+            creds_dict = json.load(f)
+    else:
+        return None
+    
+    # Fix newline trong private key
+    if 'private_key' in creds_dict:
+        creds_dict['private_key'] = creds_dict['private_key'].replace('\\n', '\n')
+    return creds_dict
+
+# ========== ĐIỀU PHỐI QUOTA GOOGLE SHEETS ==========
+PRIORITY_WRITE = 0
+PRIORITY_INTERACTIVE = 1
+PRIORITY_BACKGROUND = 2
+
+# Mã lỗi nên thử lại: hết quota, timeout và lỗi phía server
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+# Thao tác gọi lại sẽ ghi thêm lần nữa: chỉ thử lại khi bị từ chối vì quota (429),
+# lỗi mạng/5xx thì Google có thể đã ghi nên không tự thử lại
+NON_IDEMPOTENT_OPERATIONS = {"values.append"}
+
+class TokenBucket:
+    """Token bucket: rate token/giây, tối đa capacity token"""
+    
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60.0
+        self.capacity = float(per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+    
+    def _fill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def wait_time(self):
+        """Số giây phải chờ đến khi có 1 token (0 nếu có ngay)"""
+        self._fill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+    
+    def take(self):
+        self.tokens -= 1
+    
+    def drain(self):
+        """Bị Google trả 429: coi như quota của phút này đã hết"""
+        self._fill()
+        self.tokens = min(self.tokens, 0.0)
+
+class SheetsCallScheduler:
+    """Mọi lời gọi Google Sheets API đi qua đây.
+    
+    Lượt đọc và ghi lấy token từ hai bucket riêng theo quota. Người chờ
+    được phục vụ theo độ ưu tiên: ghi trước, rồi thao tác của người dùng,
+    làm mới cache ở background đứng sau và nhường khi đang có lượt ghi.
+    Lỗi 429/5xx được thử lại với exponential backoff có jitter.
+    """
+    
+    def __init__(self, read_quota=None, write_quota=None, max_retries=None,
+                 backoff_base=None, backoff_max=None):
+        self._buckets = {
+            "read": TokenBucket(read_quota or SYSTEM_CONFIG["sheets_read_quota"]),
+            "write": TokenBucket(write_quota or SYSTEM_CONFIG["sheets_write_quota"]),
+        }
+        self.max_retries = SYSTEM_CONFIG["sheets_max_retries"] if max_retries is None else max_retries
+        self.backoff_base = backoff_base or SYSTEM_CONFIG["sheets_backoff_base"]
+        self.backoff_max = backoff_max or SYSTEM_CONFIG["sheets_backoff_max"]
+        self._cond = threading.Condition()
+        self._waiters = {"read": [], "write": []}   # heap (priority, seq)
+        self._seq = itertools.count()
+        self._writes_active = 0
+        self._local = threading.local()
+        self._stats = {"calls": 0, "throttled": 0, "quota_errors": 0,
+                       "retried": 0, "failed": 0, "wait_seconds": 0.0}
+    
+    @contextlib.contextmanager
+    def priority(self, level):
+        """Đặt độ ưu tiên cho các lượt đọc trong thread hiện tại"""
+        previous = getattr(self._local, "priority", PRIORITY_INTERACTIVE)
+        self._local.priority = level
+        try:
+            yield
+        finally:
+            self._local.priority = previous
+    
+    def _can_go(self, kind, ticket):
+        if self._waiters[kind][0] != ticket:
+            return False
+        if ticket[0] == PRIORITY_BACKGROUND and (self._waiters["write"] or self._writes_active):
+            return False
+        return True
+    
+    def _acquire(self, kind, priority):
+        ticket = (priority, next(self._seq))
+        waited = 0.0
+        with self._cond:
+            heapq.heappush(self._waiters[kind], ticket)
+            try:
+                while True:
+                    if self._can_go(kind, ticket):
+                        delay = self._buckets[kind].wait_time()
+                        if delay == 0:
+                            self._buckets[kind].take()
+                            if kind == "write":
+                                self._writes_active += 1
+                            break
+                    else:
+                        delay = None
+                    started = time.monotonic()
+                    self._cond.wait(timeout=delay)
+                    waited += time.monotonic() - started
+            finally:
+                self._waiters[kind].remove(ticket)
+                heapq.heapify(self._waiters[kind])
+                if waited:
+                    self._stats["throttled"] += 1
+                    self._stats["wait_seconds"] += waited
+                self._cond.notify_all()
+    
+    def _release(self, kind):
+        if kind == "write":
+            with self._cond:
+                self._writes_active -= 1
+                self._cond.notify_all()
+    
+    def _backoff(self, attempt, error):
+        # Tôn trọng Retry-After nếu Google gửi kèm
+        retry_after = None
+        if isinstance(error, APIError):
+            retry_after = error.response.headers.get("Retry-After")
+        if retry_after and retry_after.isdigit():
+            return min(self.backoff_max, float(retry_after))
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+    
+    @staticmethod
+    def is_retryable(error):
+        if isinstance(error, APIError):
+            return error.code in RETRYABLE_STATUS
+        return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+    
+    @staticmethod
+    def _record(kind, operation, status, started):
+        METRICS.inc("sheets_requests_total", kind=kind, operation=operation, status=status)
+        METRICS.observe("sheets_request_duration_seconds", time.perf_counter() - started, operation=operation)
+    
+    def execute(self, kind, call, priority=None, operation="other"):
+        """Chạy call() trong quota của kind ("read"/"write"), thử lại khi cần"""
+        if priority is None:
+            priority = PRIORITY_WRITE if kind == "write" else getattr(self._local, "priority", PRIORITY_INTERACTIVE)
+        
+        attempt = 0
+        while True:
+            self._acquire(kind, priority)
+            started = time.perf_counter()
+            try:
+                with self._cond:
+                    self._stats["calls"] += 1
+                result = call()
+                self._record(kind, operation, "ok", started)
+                return result
+            except Exception as e:
+                self._record(kind, operation, str(e.code) if isinstance(e, APIError) else type(e).__name__, started)
+                quota_hit = isinstance(e, APIError) and e.code == 429
+                with self._cond:
+                    if quota_hit:
+                        self._stats["quota_errors"] += 1
+                        self._buckets[kind].drain()
+                    if (not self.is_retryable(e) or attempt >= self.max_retries
+                            or (operation in NON_IDEMPOTENT_OPERATIONS and not quota_hit)):
+                        self._stats["failed"] += 1
+                        raise
+                    self._stats["retried"] += 1
+                delay = self._backoff(attempt, e)
+                attempt += 1
+            finally:
+                self._release(kind)
+            time.sleep(delay)
+    
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats["waiting"] = sum(len(w) for w in self._waiters.values())
+        return stats
+
+SHEETS_SCHEDULER = SheetsCallScheduler()
+
+class ScheduledHTTPClient(HTTPClient):
+    """HTTP client của gspread gửi mọi request qua SHEETS_SCHEDULER"""
+    
+    def request(self, method, endpoint, *args, **kwargs):
+        kind = "read" if method.upper() == "GET" else "write"
+        return SHEETS_SCHEDULER.execute(
+            kind, lambda: super(ScheduledHTTPClient, self).request(method, endpoint, *args, **kwargs),
+            operation=sheets_operation(method, endpoint)
+        )
+
+def is_ambiguous_write_error(error):
+    """Lỗi ghi mà không biết Google đã thực hiện hay chưa (mạng, timeout, 5xx)"""
+    if isinstance(error, APIError) and error.code == 429:
+        return False
+    return SheetsCallScheduler.is_retryable(error)
+
+def describe_sheets_error(error):
+    """Thông báo lỗi Google Sheets cho người dùng"""
+    if isinstance(error, APIError) and error.code == 429:
+        return "⏳ Google Sheets đang giới hạn lượt truy cập (quota), vui lòng thử lại sau ít phút"
+    if isinstance(error, APIError) and error.code >= 500:
+        return "⚠️ Google Sheets đang gặp sự cố, vui lòng thử lại sau"
+    if isinstance(error, ConnectionError):
+        return f"❌ {str(error)}"
+    return f"❌ Lỗi Google Sheets: {str(error)}"
+
+# Lỗi gần nhất khi đọc/ghi từng tháng: (sheet_url, sheet_name) -> thông báo
+SHEET_ERRORS = {}
+
+class SheetsClientPool:
+    """Giữ một client gspread đã xác thực dùng chung cho cả process.
+    
+    Client dùng một session HTTP keep-alive, token được làm mới trước khi
+    hết hạn, và an toàn khi gọi từ nhiều worker thread của Gradio.
+    """
+    
+    def __init__(self, refresh_margin=None, pool_size=None):
+        if refresh_margin is None:
+            refresh_margin = SYSTEM_CONFIG["token_refresh_margin"]
+        if pool_size is None:
+            pool_size = SYSTEM_CONFIG["http_pool_size"]
+        self._lock = threading.Lock()
+        self._refresh_margin = timedelta(seconds=refresh_margin)
+        self._pool_size = pool_size
+        self._credentials = None
+        self._auth_request = None
+        self._client = None
+    
+    def _needs_refresh(self):
+        credentials = self._credentials
+        if credentials is None:
+            # Client không dùng OAuth (backend giả lập) thì không cần làm mới
+            return self._client is None
+        if not credentials.token or credentials.expiry is None:
+            return True
+        # google-auth lưu expiry dạng UTC không có tzinfo
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        return credentials.expiry - now <= self._refresh_margin
+    
+    def _build_client(self):
+        if SYSTEM_CONFIG["sheets_backend"] == "fake":
+            from fake_sheets import FakeSheetsBackend
+            print("🧪 Dùng Google Sheets giả lập (SHEETS_BACKEND=fake)")
+            return FakeSheetsBackend.from_env().client()
+        
+        creds_dict = load_credentials_dict()
+        if creds_dict is None:
+            print("⚠️ Không tìm thấy Google Sheets credentials")
+            return None
+        
+        credentials = Credentials.from_service_account_info(creds_dict, scopes=GOOGLE_SCOPES)
+        
+        # Session riêng cho việc lấy token, session keep-alive cho Sheets API
+        token_session = requests.Session()
+        token_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        auth_request = Request(token_session)
+        
+        session = AuthorizedSession(credentials, auth_request=auth_request)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self._pool_size)
+        session.mount("https://", adapter)
+        
+        credentials.refresh(auth_request)
+        self._credentials = credentials
+        self._auth_request = auth_request
+        print("✅ Kết nối Google Sheets thành công!")
+        return gspread.Client(auth=credentials, session=session, http_client=ScheduledHTTPClient)
+    
+    def get_client(self):
+        """Trả về client dùng chung, tạo mới hoặc làm mới token khi cần"""
+        client = self._client
+        if client is not None and not self._needs_refresh():
+            return client
+        
+        with self._lock:
+            if self._client is None:
+                self._client = self._build_client()
+            elif self._needs_refresh():
+                self._credentials.refresh(self._auth_request)
+            return self._client
+    
+    def install(self, client):
+        """Dùng một client có sẵn thay cho Google Sheets (ví dụ khi kiểm thử tải)"""
+        with self._lock:
+            self._client = client
+            self._credentials = None
+            self._auth_request = None
+    
+    def reset(self):
+        """Bỏ client hiện tại (ví dụ khi đổi credentials)"""
+        with self._lock:
+            self._client = None
+            self._credentials = None
+            self._auth_request = None
+
+CLIENT_POOL = SheetsClientPool()
+
+def get_google_client():
+    """Kết nối đến Google Sheets - An toàn cho production"""
+    try:
+        return CLIENT_POOL.get_client()
+        
+    except Exception as e:
+        print(f"❌ Lỗi kết nối Google Sheets: {str(e)}")
+        traceback.print_exc()
+        CLIENT_POOL.reset()
+        return None
+
+class MetadataSpreadsheet(Spreadsheet):
+    """Spreadsheet dựng từ metadata đã lấy sẵn (Spreadsheet.__init__ tự gọi API lấy lại)"""
+    
+    def __init__(self, http_client, metadata):
+        self.client = http_client
+        self._properties = dict(metadata["properties"], id=metadata["spreadsheetId"])
+
+def open_with_worksheets(client, sheet_url):
+    """Mở spreadsheet -> (spreadsheet, [worksheet]) bằng một lần gọi metadata.
+    
+    open_by_url của gspread lấy metadata nhưng bỏ phần sheets, nên
+    worksheets() phải lấy lại; ở đây dựng cả hai từ cùng một response.
+    """
+    if not isinstance(client, gspread.Client):
+        # Client thay thế (backend giả lập): theo API gspread thông thường
+        spreadsheet = client.open_by_url(sheet_url)
+        return spreadsheet, spreadsheet.worksheets()
+    metadata = client.http_client.fetch_sheet_metadata(extract_id_from_url(sheet_url))
+    spreadsheet = MetadataSpreadsheet(client.http_client, metadata)
+    worksheets = [Worksheet(spreadsheet, sheet["properties"], spreadsheet.id, client.http_client)
+                  for sheet in metadata["sheets"]]
+    return spreadsheet, worksheets
+
+class SheetHandleCache:
+    """Spreadsheet và worksheet đã mở, khóa theo sheet_url.
+    
+    Mỗi spreadsheet chỉ mở một lần; tiêu đề, id và số dòng/cột của mọi
+    worksheet lấy trong một lần gọi metadata. Chỉ lấy lại khi không tìm
+    thấy tiêu đề, khi gặp lỗi cấu trúc (sheet bị đổi tên/xóa, lưới thay
+    đổi), sau values.append, khi đọc/ghi chạm hết lưới đang nhớ hoặc sau
+    ttl giây, nên mỗi lần đọc chỉ còn lời gọi lấy giá trị.
+    """
+    
+    def __init__(self, ttl=None):
+        self.ttl = SYSTEM_CONFIG["sheet_metadata_ttl"] if ttl is None else ttl
+        self._lock = threading.Lock()
+        self._entries = {}   # sheet_url -> (client, spreadsheet, {tiêu đề: worksheet}, fetched_at)
+        self._stats = {"hits": 0, "misses": 0, "refreshes": 0}
+    
+    def _refresh(self, client, sheet_url, spreadsheet=None):
+        if spreadsheet is None:
+            spreadsheet, worksheets = open_with_worksheets(client, sheet_url)
+        else:
+            worksheets = spreadsheet.worksheets()
+        index = {worksheet.title: worksheet for worksheet in worksheets}
+        entry = (client, spreadsheet, index, time.monotonic())
+        with self._lock:
+            self._entries[sheet_url] = entry
+            self._stats["refreshes"] += 1
+        return entry
+    
+    def _entry(self, client, sheet_url):
+        with self._lock:
+            entry = self._entries.get(sheet_url)
+        # Client mới (đổi credentials, backend giả lập) thì mở lại từ đầu
+        if entry is None or entry[0] is not client:
+            return self._refresh(client, sheet_url)
+        if time.monotonic() - entry[3] >= self.ttl:
+            return self._refresh(client, sheet_url, entry[1])
+        return entry
+    
+    def spreadsheet(self, client, sheet_url):
+        return self._entry(client, sheet_url)[1]
+    
+    def reload(self, client, sheet_url, title):
+        """Lấy lại metadata ngay (số dòng/cột mới nhất) và trả về worksheet"""
+        entry = self._refresh(client, sheet_url, self._entry(client, sheet_url)[1])
+        worksheet = entry[2].get(title)
+        if worksheet is None:
+            raise WorksheetNotFound(title)
+        return worksheet
+    
+    def expire(self, sheet_url):
+        """Giữ spreadsheet đã mở nhưng lấy lại metadata ở lần dùng tới
+        (lưới vừa đổi kích thước ngoài handle, ví dụ values.append chèn dòng)"""
+        with self._lock:
+            entry = self._entries.get(sheet_url)
+            if entry is not None:
+                self._entries[sheet_url] = entry[:3] + (float("-inf"),)
+    
+    def worksheets(self, client, sheet_url):
+        """{tiêu đề: worksheet} của spreadsheet"""
+        return dict(self._entry(client, sheet_url)[2])
+    
+    def worksheet(self, client, sheet_url, title):
+        entry = self._entry(client, sheet_url)
+        worksheet = entry[2].get(title)
+        with self._lock:
+            self._stats["hits" if worksheet is not None else "misses"] += 1
+        if worksheet is None:
+            # Sheet vừa được thêm hoặc đổi tên: lấy lại metadata một lần
+            worksheet = self._refresh(client, sheet_url, entry[1])[2].get(title)
+            if worksheet is None:
+                raise WorksheetNotFound(title)
+        return worksheet
+    
+    def invalidate(self, sheet_url):
+        with self._lock:
+            self._entries.pop(sheet_url, None)
+    
+    def index(self, sheet_url):
+        """{tiêu đề: id worksheet} đang nhớ"""
+        with self._lock:
+            entry = self._entries.get(sheet_url)
+        return {title: worksheet.id for title, worksheet in entry[2].items()} if entry else {}
+    
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, spreadsheets=len(self._entries))
+
+SHEET_HANDLES = SheetHandleCache()
+
+def is_structure_error(error):
+    """Lỗi cho thấy metadata đang nhớ đã cũ: sheet bị đổi tên/xóa hoặc lưới thay đổi"""
+    if isinstance(error, WorksheetNotFound):
+        return True
+    if isinstance(error, APIError) and error.code == 400:
+        message = str(error)
+        return "Unable to parse range" in message or "exceeds grid limits" in message
+    return False
+
+# ========== SNAPSHOT CỤC BỘ ==========
+def frame_version(df):
+    """Dấu phiên bản của dữ liệu tháng (đổi khi nội dung đổi)"""
+    if df.empty:
+        return "empty"
+    digest = int(pd.util.hash_pandas_object(df, index=False).sum()) & 0xFFFFFFFFFFFFFFFF
+    return f"{len(df)}-{digest:016x}"
+
+class SnapshotStore:
+    """Bản sao tốt gần nhất của từng tháng (đã chuyển kiểu) dạng Parquet.
+    
+    Instance serverless mới khởi động đọc được dữ liệu ngay từ snapshot,
+    và vẫn đọc được khi Google Sheets không truy cập được.
+    """
+    
+    META_KEY = b"kieutimes"
+    
+    def __init__(self, directory=None):
+        self.directory = directory or SYSTEM_CONFIG["snapshot_dir"]
+        self.enabled = SNAPSHOTS_AVAILABLE
+    
+    def _path(self, key):
+        sheet_url, sheet_name = key
+        url_hash = hashlib.sha1(sheet_url.encode("utf-8")).hexdigest()[:12]
+        return os.path.join(self.directory, f"{url_hash}_{sheet_name}.parquet")
+    
+    def save(self, key, df):
+        """Ghi snapshot (ghi file tạm rồi đổi tên để không hỏng khi lỗi giữa chừng)"""
+        if not self.enabled or df.empty:
+            return None
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            
+            # Tên cột có thể trùng (cột không tiêu đề): lưu theo vị trí, giữ tên gốc trong metadata
+            columns = [str(column) for column in df.columns]
+            positional = df.set_axis([f"c{i}" for i in range(len(columns))], axis=1)
+            table = pa.Table.from_pandas(positional, preserve_index=False)
+            
+            meta = {
+                "columns": columns,
+                "version": frame_version(df),
+                "saved_at": datetime.now().isoformat(timespec="seconds"),
+                "sheet_url": key[0],
+                "sheet_name": key[1]
+            }
+            schema_meta = dict(table.schema.metadata or {})
+            schema_meta[self.META_KEY] = json.dumps(meta, ensure_ascii=False).encode("utf-8")
+            table = table.replace_schema_metadata(schema_meta)
+            
+            path = self._path(key)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            pq.write_table(table, tmp_path)
+            os.replace(tmp_path, path)
+            return meta
+        
+        except Exception as e:
+            print(f"⚠️ Lỗi ghi snapshot {key[1]}: {str(e)}")
+            return None
+    
+    def load(self, key):
+        """Đọc snapshot, trả về (DataFrame, metadata) hoặc None"""
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            table = pq.read_table(path)
+            meta = json.loads(table.schema.metadata[self.META_KEY])
+            df = table.to_pandas()
+            df.columns = meta["columns"]
+            return df, meta
+        
+        except Exception as e:
+            print(f"⚠️ Lỗi đọc snapshot {key[1]}: {str(e)}")
+            return None
+    
+    def delete(self, key):
+        if not self.enabled:
+            return
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+SNAPSHOT_STORE = SnapshotStore()
+
+# ========== CACHE DỮ LIỆU THÁNG ==========
+class MonthDataCache:
+    """Cache DataFrame theo tháng, khóa (sheet_url, sheet_name).
+    
+    Trong TTL trả thẳng từ cache. Hết TTL thì vẫn trả bản cũ ngay và tải
+    lại ở background (stale-while-revalidate). Khi chưa có trong bộ nhớ
+    (cold start) thì trả snapshot cục bộ nếu có rồi đồng bộ ở background.
+    Nhiều lượt miss cùng một tháng chỉ gọi loader một lần (single-flight).
+    """
+    
+    def __init__(self, ttl=None, max_workers=2, snapshots=None):
+        if ttl is None:
+            ttl = SYSTEM_CONFIG["sheet_cache_ttl"]
+        self.ttl = ttl
+        self._snapshots = snapshots
+        self._lock = threading.Lock()
+        self._entries = {}       # key -> (df, fetched_at)
+        self._generations = {}   # key -> số lần invalidate
+        self._refreshing = set()
+        self._inflight = {}      # key -> Future của lần tải đang chạy
+        self._versions = {}      # key -> frame_version của entry hiện tại
+        self._snapshot_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sheet-refresh")
+        self._stats = {"hits": 0, "stale_hits": 0, "misses": 0, "snapshot_hits": 0,
+                       "coalesced": 0, "refreshes": 0, "refresh_errors": 0}
+    
+    def get(self, key, loader, summarize=None):
+        """Lấy DataFrame cho key, gọi loader() khi chưa có trong cache.
+        
+        summarize(df) (nếu có) tính tổng hợp Dashboard cho dữ liệu vừa tải;
+        tổng hợp chỉ được thay khi dữ liệu được nhận cho generation hiện tại.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            generation = self._generations.get(key, 0)
+            if entry is not None:
+                df, fetched_at = entry
+                if time.monotonic() - fetched_at < self.ttl:
+                    self._stats["hits"] += 1
+                else:
+                    self._stats["stale_hits"] += 1
+                    self._schedule_refresh(key, loader, generation, summarize)
+                return df.copy(deep=False)
+            self._stats["misses"] += 1
+        
+        # Cold start: trả snapshot ngay, đồng bộ với Google Sheets ở background
+        snapshot = self._snapshots.load(key) if self._snapshots is not None else None
+        if snapshot is not None:
+            df = snapshot[0]
+            with self._lock:
+                if key not in self._entries and self._generations.get(key, 0) == generation:
+                    self._entries[key] = (df, float("-inf"))
+                    self._versions.pop(key, None)
+                self._stats["snapshot_hits"] += 1
+                self._schedule_refresh(key, loader, generation, summarize)
+            return df.copy(deep=False)
+        
+        return self._load_once(key, loader, generation, summarize).copy(deep=False)
+    
+    def _load_once(self, key, loader, generation, summarize=None):
+        """Gọi loader() cho key; lượt khác đang chờ cùng key dùng chung kết quả"""
+        with self._lock:
+            pending = self._inflight.get(key)
+            if pending is None:
+                pending = self._inflight[key] = Future()
+                leader = True
+            else:
+                self._stats["coalesced"] += 1
+                leader = False
+        if not leader:
+            return pending.result()
+        
+        try:
+            df = loader()
+        except BaseException as e:
+            pending.set_exception(e)
+            raise
+        else:
+            self._store(key, df, generation, summarize(df) if summarize is not None else None)
+            pending.set_result(df)
+            return df
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+    
+    def _schedule_refresh(self, key, loader, generation, summarize=None):
+        # Gọi khi đang giữ self._lock
+        if key not in self._refreshing:
+            self._refreshing.add(key)
+            self._executor.submit(self._refresh, key, loader, generation, summarize)
+    
+    def peek(self, key):
+        """DataFrame còn trong TTL (tính là hit), hoặc None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[1] < self.ttl:
+                self._stats["hits"] += 1
+                return entry[0].copy(deep=False)
+        return None
+    
+    def versioned(self, key):
+        """(DataFrame, phiên bản) của entry đang có, hoặc None; phiên bản tính một lần mỗi entry"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            df = entry[0]
+            version = self._versions.get(key)
+        if version is None:
+            version = frame_version(df)
+            with self._lock:
+                current = self._entries.get(key)
+                if current is not None and current[0] is df:
+                    self._versions[key] = version
+        return df.copy(deep=False), version
+    
+    def generation(self, key):
+        """Generation hiện tại của key; lấy trước khi bắt đầu đọc rồi truyền cho put()"""
+        with self._lock:
+            return self._generations.get(key, 0)
+    
+    def put(self, key, df, generation=None, summary=None):
+        """Ghi sẵn DataFrame vào cache (ví dụ từ lần tải cả năm).
+        
+        generation là giá trị lấy trước khi đọc: tháng bị ghi (invalidate)
+        trong lúc đang đọc thì bỏ kết quả. summary (nếu có) thay tổng hợp
+        Dashboard cùng lúc với entry. Trả về True nếu được nhận.
+        """
+        if generation is None:
+            generation = self.generation(key)
+        return self._store(key, df, generation, summary)
+    
+    def _store(self, key, df, generation, summary=None):
+        with self._lock:
+            # Bỏ kết quả nếu tháng đã bị invalidate trong lúc đang tải
+            if self._generations.get(key, 0) != generation:
+                return False
+            self._entries[key] = (df, time.monotonic())
+            self._versions.pop(key, None)
+            # Cùng khóa với invalidate(): lượt ghi xen giữa không bị tổng hợp cũ đè lên
+            if summary is not None:
+                SUMMARY_STORE.replace(key, summary)
+        if self._snapshots is not None:
+            self._executor.submit(self._save_snapshot, key, df, generation)
+        return True
+    
+    def _save_snapshot(self, key, df, generation):
+        """Ghi snapshot của một generation; bỏ qua hoặc xóa lại nếu tháng đã
+        bị invalidate trước/trong lúc ghi (không để snapshot cũ sau khi ghi sheet)"""
+        with self._snapshot_lock:
+            with self._lock:
+                if self._generations.get(key, 0) != generation:
+                    return
+            self._snapshots.save(key, df)
+            with self._lock:
+                moved = self._generations.get(key, 0) != generation
+            if moved:
+                self._snapshots.delete(key)
+    
+    def _refresh(self, key, loader, generation, summarize=None):
+        try:
+            with SHEETS_SCHEDULER.priority(PRIORITY_BACKGROUND):
+                df = loader()
+            self._store(key, df, generation, summarize(df) if summarize is not None else None)
+            with self._lock:
+                self._stats["refreshes"] += 1
+        except Exception as e:
+            print(f"⚠️ Lỗi làm mới cache {key[1]}: {str(e)}")
+            with self._lock:
+                self._stats["refresh_errors"] += 1
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+    
+    def invalidate(self, sheet_url, sheet_name, then=None):
+        """Xóa dữ liệu cache của một tháng (sau khi ghi).
+        
+        then() (nếu có, ví dụ cập nhật tổng hợp Dashboard của lượt ghi) chạy
+        cùng khóa với việc tăng generation, nên lượt tải đang chạy không thể
+        đè tổng hợp cũ lên sau đó.
+        """
+        key = (sheet_url, sheet_name)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._versions.pop(key, None)
+            self._generations[key] = self._generations.get(key, 0) + 1
+            if then is not None:
+                then()
+        # Snapshot cũ không còn đúng sau khi ghi
+        if self._snapshots is not None:
+            self._snapshots.delete(key)
+    
+    def clear(self):
+        with self._lock:
+            for key in self._entries:
+                self._generations[key] = self._generations.get(key, 0) + 1
+            self._entries.clear()
+            self._versions.clear()
+    
+    def stats(self):
+        """Số lần hit/miss để điều chỉnh TTL"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        lookups = stats["hits"] + stats["stale_hits"] + stats["misses"]
+        served = stats["hits"] + stats["stale_hits"] + stats["snapshot_hits"]
+        stats["hit_rate"] = served / lookups if lookups else 0.0
+        return stats
+
+MONTH_CACHE = MonthDataCache(snapshots=SNAPSHOT_STORE)
+
+# ========== KIỂU DỮ LIỆU THÁNG ==========
+SCHEMA_DATE_COLUMNS = ['date']
+SCHEMA_DURATION_COLUMNS = ['xe_can_vao', 'xe_can_ra', 'tong_thoi_gian']
+SCHEMA_FLOAT_COLUMNS = ['so_luong', 'net_weight']
+SCHEMA_CATEGORY_COLUMNS = ['nguyen_nhan', 'nguyen_lieu', 'so_xe']
+
+# Các ô không chuyển được kiểu ở lần tải gần nhất: (sheet_url, sheet_name) -> DataFrame
+SCHEMA_ISSUES = {}
+
+def _as_text(values):
+    """Chuỗi đã strip, ô trống -> NA"""
+    text = values.astype('string').str.strip()
+    return text.mask(text == '')
+
+def parse_date_column(values):
+    """Ngày dạng 2025-01-23 hoặc 23/01/2025 -> datetime64"""
+    text = _as_text(values)
+    parsed = pd.to_datetime(text, format='%Y-%m-%d', errors='coerce')
+    retry = parsed.isna() & text.notna()
+    if retry.any():
+        parsed[retry] = pd.to_datetime(text[retry], format='mixed', dayfirst=True, errors='coerce')
+    return parsed
+
+def parse_duration_column(values):
+    """Giờ cân / tổng thời gian dạng HH:MM[:SS] -> timedelta64"""
+    text = _as_text(values)
+    short = text.str.fullmatch(r'\d{1,2}:\d{2}').fillna(False)
+    text = text.mask(short, text + ':00')
+    return pd.to_timedelta(text, errors='coerce')
+
+def parse_float_column(values):
+    """Số lượng / khối lượng (bỏ dấu phân cách hàng nghìn) -> float32"""
+    text = _as_text(values).str.replace(r'[\s,]', '', regex=True)
+    return pd.to_numeric(text, errors='coerce').astype('float32')
+
+def apply_schema(df):
+    """Chuyển các cột đã map sang kiểu thật một lần khi tải.
+    
+    Trả về (DataFrame đã chuyển kiểu, DataFrame các ô lỗi gồm row/column/value).
+    Ô lỗi được giữ lại dưới dạng NaT/NaN chứ không bỏ dòng.
+    """
+    if df.empty:
+        return df, pd.DataFrame(columns=['row', 'column', 'value'])
+    
+    converters = (
+        [(column, parse_date_column) for column in SCHEMA_DATE_COLUMNS] +
+        [(column, parse_duration_column) for column in SCHEMA_DURATION_COLUMNS] +
+        [(column, parse_float_column) for column in SCHEMA_FLOAT_COLUMNS]
+    )
+    
+    typed = df.copy(deep=False)
+    issues = []
+    for column, parser in converters:
+        if column not in typed.columns:
+            continue
+        raw = typed[column]
+        converted = parser(raw)
+        bad = converted.isna() & _as_text(raw).notna()
+        if bad.any():
+            issues.append(pd.DataFrame({'row': raw.index[bad], 'column': column, 'value': raw[bad].astype(str).values}))
+        typed[column] = converted
+    
+    for column in SCHEMA_CATEGORY_COLUMNS:
+        if column in typed.columns:
+            typed[column] = typed[column].astype('category')
+    
+    if issues:
+        return typed, pd.concat(issues, ignore_index=True)
+    return typed, pd.DataFrame(columns=['row', 'column', 'value'])
+
+def record_schema_issues(key, issues):
+    """Lưu và báo các ô không hợp lệ của một tháng"""
+    SCHEMA_ISSUES[key] = issues
+    if not issues.empty:
+        counts = issues['column'].value_counts().to_dict()
+        print(f"⚠️ {key[1]}: {len(issues)} ô không hợp lệ {counts}")
+
+# ========== HÀM XỬ LÝ DỮ LIỆU ==========
+def read_sheet_data(client, sheet_name, sheet_url=None, use_cache=True):
+    """Đọc dữ liệu từ sheet cụ thể (qua cache tháng)"""
+    try:
+        if sheet_url is None:
+            sheet_url = SYSTEM_CONFIG["default_sheet_url"]
+        
+        if not use_cache:
+            return fetch_sheet_data(client, sheet_name, sheet_url)
+        
+        def loader():
+            if client is None:
+                raise ConnectionError("Không thể kết nối Google Sheets")
+            return fetch_sheet_data(client, sheet_name, sheet_url)
+        
+        key = (sheet_url, sheet_name)
+        df = MONTH_CACHE.get(key, loader, summarize_month_frame)
+        SHEET_ERRORS.pop(key, None)
+        
+        # Dữ liệu lấy từ snapshot chưa có tổng hợp cho Dashboard
+        if not df.empty and SUMMARY_STORE.get(key) is None:
+            SUMMARY_STORE.replace(key, summarize_month_frame(df))
+        return df
+        
+    except Exception as e:
+        print(f"Lỗi đọc sheet {sheet_name}: {str(e)}")
+        if is_structure_error(e):
+            SHEET_HANDLES.invalidate(sheet_url)
+        SHEET_ERRORS[(sheet_url, sheet_name)] = describe_sheets_error(e)
+        return pd.DataFrame()
+
+# Vị trí dòng tiêu đề của từng worksheet:
+# (sheet_url, sheet_name) -> (số dòng, có dấu "Ngày/tháng" hay không)
+_HEADER_ROW_CACHE = {}
+_HEADER_ROW_LOCK = threading.Lock()
+
+def _is_header_row(row):
+    return len(row) > 0 and SHEET_HEADER_MARKER in str(row[0])
+
+def _is_blank_row(row):
+    return not any(str(cell).strip() for cell in row)
+
+def find_header_row(worksheet, page_size=None):
+    """Tìm dòng tiêu đề "Ngày/tháng" ở cột A (đánh số từ 1), chỉ đọc cột A"""
+    if page_size is None:
+        page_size = SYSTEM_CONFIG["sheet_page_size"]
+    
+    row_count = worksheet.row_count
+    start = 1
+    while start <= row_count:
+        end = min(start + page_size - 1, row_count)
+        column = worksheet.get(f"{SHEET_FIRST_COLUMN}{start}:{SHEET_FIRST_COLUMN}{end}")
+        for offset, row in enumerate(column):
+            if _is_header_row(row):
+                return start + offset
+        start = end + 1
+    
+    # Không có tiêu đề: dòng đầu tiên được coi là tiêu đề
+    return 1
+
+def iter_sheet_pages(worksheet, first_row, page_size=None, empty_block=None, reload=None):
+    """Đọc vùng A:U theo từng trang, dừng khi gặp một khối dòng trống.
+    
+    Mỗi trang là list các dòng đã pad đủ SHEET_WIDTH cột. Nếu dữ liệu kéo
+    tới hết lưới, reload() (nếu có) trả về worksheet với số dòng mới nhất
+    để đọc tiếp phần lưới mới thêm mà handle đang nhớ chưa biết.
+    """
+    if page_size is None:
+        page_size = SYSTEM_CONFIG["sheet_page_size"]
+    if empty_block is None:
+        empty_block = SYSTEM_CONFIG["sheet_empty_block"]
+    
+    row_count = worksheet.row_count
+    blank_run = 0
+    start = first_row
+    while blank_run < empty_block:
+        if start > row_count:
+            if reload is None:
+                break
+            worksheet, reload = reload(), None
+            if worksheet.row_count <= row_count:
+                break
+            row_count = worksheet.row_count
+        end = min(start + page_size - 1, row_count)
+        values = worksheet.get(f"{SHEET_FIRST_COLUMN}{start}:{SHEET_LAST_COLUMN}{end}")
+        record_sheet_io("read", worksheet.title, values)
+        
+        page = []
+        for row in values:
+            row = list(row[:SHEET_WIDTH])
+            page.append(row + [''] * (SHEET_WIDTH - len(row)))
+            blank_run = blank_run + 1 if _is_blank_row(row) else 0
+            if blank_run >= empty_block:
+                # Như parse_month_values: nội dung sau khối trống (ghi chú, chữ ký) không phải dữ liệu
+                yield page
+                return
+        
+        # API bỏ các dòng trống ở cuối vùng đọc
+        blank_run += (end - start + 1) - len(values)
+        yield page
+        start = end + 1
+
+def find_data_end(worksheet, first_row, page_size=None, empty_block=None, reload=None):
+    """Dòng cuối có dữ liệu từ first_row trở đi, dừng ở khối empty_block
+    dòng trống như iter_sheet_pages (first_row - 1 nếu không có dòng nào).
+    reload như ở iter_sheet_pages."""
+    if page_size is None:
+        page_size = SYSTEM_CONFIG["sheet_page_size"]
+    if empty_block is None:
+        empty_block = SYSTEM_CONFIG["sheet_empty_block"]
+    
+    row_count = worksheet.row_count
+    last = first_row - 1
+    start = first_row
+    while start - last <= empty_block:
+        if start > row_count:
+            if reload is None:
+                break
+            worksheet, reload = reload(), None
+            if worksheet.row_count <= row_count:
+                break
+            row_count = worksheet.row_count
+        end = min(start + page_size - 1, row_count)
+        values = worksheet.get(f"{SHEET_FIRST_COLUMN}{start}:{SHEET_LAST_COLUMN}{end}")
+        for offset, row in enumerate(values):
+            if start + offset - last > empty_block:
+                return last
+            if not _is_blank_row(row):
+                last = start + offset
+        start = end + 1
+    return last
+
+def fetch_sheet_data(client, sheet_name, sheet_url):
+    """Đọc trực tiếp từ Google Sheets, không qua cache (lỗi được ném ra)"""
+    worksheet = SHEET_HANDLES.worksheet(client, sheet_url, sheet_name)
+    reload = functools.partial(SHEET_HANDLES.reload, client, sheet_url, sheet_name)
+    
+    key = (sheet_url, sheet_name)
+    with _HEADER_ROW_LOCK:
+        cached = _HEADER_ROW_CACHE.get(key)
+    
+    pages = None
+    if cached is not None:
+        header_row, has_marker = cached
+        pages = iter_sheet_pages(worksheet, header_row, reload=reload)
+        first_page = next(pages, [])
+        # Sheet đã bị chèn/xóa dòng phía trên tiêu đề: dò lại
+        if has_marker and (not first_page or not _is_header_row(first_page[0])):
+            pages = None
+    
+    if pages is None:
+        header_row = find_header_row(worksheet)
+        pages = iter_sheet_pages(worksheet, header_row, reload=reload)
+        first_page = next(pages, [])
+        has_marker = bool(first_page) and _is_header_row(first_page[0])
+        with _HEADER_ROW_LOCK:
+            _HEADER_ROW_CACHE[key] = (header_row, has_marker)
+    
+    if not first_page:
+        return pd.DataFrame()
+    
+    headers = first_page[0]
+    
+    # Dựng DataFrame theo từng trang để không giữ toàn bộ lưới trong bộ nhớ
+    frames = [_rows_to_frame(headers, rows) for rows in itertools.chain([first_page[1:]], pages)]
+    df, issues = apply_schema(_combine_frames(frames))
+    record_schema_issues(key, issues)
+    return df
+
+def _rows_to_frame(headers, rows):
+    """Chuyển một khối dòng thành DataFrame, đã lọc dòng trống"""
+    if not rows:
+        return pd.DataFrame()
+    chunk = pd.DataFrame(rows, columns=headers)
+    
+    # Lọc dòng trống
+    chunk = chunk.replace('', pd.NA)
+    return chunk.dropna(how='all')
+
+def _combine_frames(frames):
+    """Ghép các khối và đổi tên cột theo COLUMN_MAPPING"""
+    frames = [frame for frame in frames if not frame.empty]
+    if not frames:
+        return pd.DataFrame()
+    
+    df = pd.concat(frames, ignore_index=True)
+    
+    # Đổi tên cột
+    df = df.rename(columns={k: v for k, v in COLUMN_MAPPING.items() if k in df.columns})
+    
+    return df
+
+def parse_month_values(values, empty_block=None):
+    """Phân tích toàn bộ giá trị A:U của một sheet tháng.
+    
+    Trả về (DataFrame, dòng tiêu đề) với cùng quy tắc như fetch_sheet_data;
+    dòng tiêu đề là None khi sheet không có "Ngày/tháng".
+    """
+    if empty_block is None:
+        empty_block = SYSTEM_CONFIG["sheet_empty_block"]
+    
+    header_idx = next((i for i, row in enumerate(values) if _is_header_row(row)), None)
+    header_row = header_idx + 1 if header_idx is not None else None
+    if header_idx is None:
+        header_idx = 0
+    
+    rows = []
+    blank_run = 0
+    for row in values[header_idx:]:
+        row = list(row[:SHEET_WIDTH])
+        blank_run = blank_run + 1 if _is_blank_row(row) else 0
+        if blank_run >= empty_block:
+            break
+        rows.append(row + [''] * (SHEET_WIDTH - len(row)))
+    
+    if not rows:
+        return pd.DataFrame(), header_row
+    
+    return _combine_frames([_rows_to_frame(rows[0], rows[1:])]), header_row
+
+def fetch_year_data(client, sheet_url=None, max_workers=4, combine=True):
+    """Đọc cả 12 tháng (T1...T12) bằng values.batchGet.
+    
+    Các nhóm batchGet chạy song song, từng tháng được phân tích song song
+    và ghép thành một DataFrame có thêm cột month. Kết quả từng tháng cũng
+    được đưa vào MONTH_CACHE. combine=False chỉ nạp cache, trả về dict
+    nhãn tháng -> DataFrame mà không ghép.
+    """
+    if sheet_url is None:
+        sheet_url = SYSTEM_CONFIG["default_sheet_url"]
+    
+    spreadsheet = SHEET_HANDLES.spreadsheet(client, sheet_url)
+    titles = SHEET_HANDLES.worksheets(client, sheet_url)
+    months = [(label, name) for label, name in SYSTEM_CONFIG["month_mapping"].items() if name in titles]
+    if not months:
+        return pd.DataFrame() if combine else {}
+    
+    # Generation trước khi đọc: tháng được ghi trong lúc batchGet đang chạy thì không nạp bản cũ
+    generations = {name: MONTH_CACHE.generation((sheet_url, name)) for _, name in months}
+    ranges = [f"'{name}'!{SHEET_FIRST_COLUMN}1:{SHEET_LAST_COLUMN}" for _, name in months]
+    group_size = SYSTEM_CONFIG["year_batch_size"]
+    groups = [ranges[i:i + group_size] for i in range(0, len(ranges), group_size)]
+    
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(groups)))) as pool:
+        responses = list(pool.map(spreadsheet.values_batch_get, groups))
+    value_ranges = [vr for response in responses for vr in response.get("valueRanges", [])]
+    
+    def parse_typed(value_range):
+        df, header_row = parse_month_values(value_range.get("values", []))
+        return apply_schema(df) + (header_row,)
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        parsed = list(pool.map(parse_typed, value_ranges))
+    
+    loaded = {}
+    frames = []
+    for (label, name), value_range, (df, issues, header_row) in zip(months, value_ranges, parsed):
+        key = (sheet_url, name)
+        record_sheet_io("read", name, value_range.get("values", []))
+        if header_row is not None:
+            with _HEADER_ROW_LOCK:
+                _HEADER_ROW_CACHE[key] = (header_row, True)
+        record_schema_issues(key, issues)
+        MONTH_CACHE.put(key, df, generations[name], summarize_month_frame(df))
+        if not combine:
+            loaded[label] = df
+        elif not df.empty:
+            frames.append(df.assign(month=label))
+    
+    if not combine:
+        return loaded
+    if not frames:
+        return pd.DataFrame()
+    
+    df = pd.concat(frames, ignore_index=True)
+    
+    # Danh mục mỗi tháng khác nhau nên concat trả về object: chuyển lại
+    for column in SCHEMA_CATEGORY_COLUMNS + ['month']:
+        if column in df.columns:
+            df[column] = df[column].astype('category')
+    return df
+
+def read_year_data(client, sheet_url=None):
+    """Đọc dữ liệu cả năm, trả về DataFrame rỗng khi lỗi"""
+    try:
+        return fetch_year_data(client, sheet_url)
+    except Exception as e:
+        print(f"Lỗi đọc dữ liệu cả năm: {str(e)}")
+        if is_structure_error(e):
+            SHEET_HANDLES.invalidate(sheet_url or SYSTEM_CONFIG["default_sheet_url"])
+        return pd.DataFrame()
+
+# Chuỗi gợi ý có khoảng trắng cần bỏ ở đầu/cuối ô
+_PASTE_SPACE_PROBES = (' \n', '\n ', '\xa0', '\x0b', '\x0c', '\u3000')
+
+# Số dòng đầu dùng để nhận diện dấu phẩy làm dấu phân cách
+PASTE_SNIFF_LINES = 50
+
+def _comma_delimited(lines):
+    """Có dòng nào trong PASTE_SNIFF_LINES dòng đầu chứa từ 3 dấu phẩy (đếm tuyến tính, không backtrack)"""
+    return any(line.count(',') >= 3 for line in itertools.islice(lines, PASTE_SNIFF_LINES))
+
+def sniff_paste_delimiter(text):
+    """Chọn dấu phân cách một lần cho cả khối dữ liệu dán.
+    
+    Thứ tự ưu tiên như khi xét từng dòng: tab, nhiều khoảng trắng, dấu phẩy
+    (từ 3 dấu trên một dòng, xét PASTE_SNIFF_LINES dòng đầu), dấu |.
+    Trả về None nếu chỉ có một cột.
+    """
+    if '\t' in text:
+        return '\t'
+    # Hai khoảng trắng nằm giữa dòng (không tính đầu/cuối dòng)
+    if re.search(r'\S {2,}\S', text):
+        return '  '
+    if _comma_delimited(text.split('\n', PASTE_SNIFF_LINES)):
+        return ','
+    if '|' in text:
+        return '|'
+    return None
+
+def parse_paste_frame(pasted_text):
+    """Phân tích dữ liệu dán từ Excel thành DataFrame chuỗi, pad đủ cột.
+    
+    Dấu phân cách được nhận diện một lần, sau đó cả khối được đọc bằng
+    pandas C engine từ bộ nhớ.
+    """
+    if not pasted_text or not pasted_text.strip():
+        return pd.DataFrame()
+    
+    text = pasted_text.replace('\r\n', '\n').replace('\r', '\n')
+    sep = sniff_paste_delimiter(text)
+    
+    # Khoảng trắng trong dòng (tab là dấu phân cách thì không tính)
+    space = r'[^\S\n\t]' if sep == '\t' else r'[^\S\n]'
+    
+    # Chỉ chạy regex khi thật sự có khoảng trắng thừa (dữ liệu Excel thường không có)
+    probes = _PASTE_SPACE_PROBES + ((' ' + sep, sep + ' ') if sep else ())
+    needs_strip = sep == '  ' or text[:1].isspace() or text[-1:].isspace() or any(p in text for p in probes)
+    
+    # Bỏ khoảng trắng đầu/cuối dòng
+    if needs_strip:
+        text = re.sub(rf'^{space}+|{space}+$', '', text, flags=re.MULTILINE)
+    
+    if sep is None:
+        lines = [line for line in text.split('\n') if line]
+        df = pd.DataFrame({0: lines}, dtype=object)
+    else:
+        if sep == '  ':
+            # Nhiều khoảng trắng liên tiếp -> tab
+            text = re.sub(r'[^\S\n]{2,}', '\t', text)
+            sep = '\t'
+        elif needs_strip:
+            # Bỏ khoảng trắng quanh dấu phân cách
+            text = re.sub(rf'{space}*{re.escape(sep)}{space}*', sep, text)
+        
+        width = max(map(str.count, text.split('\n'), itertools.repeat(sep))) + 1
+        df = pd.read_csv(
+            io.StringIO(text),
+            sep=sep,
+            header=None,
+            names=range(width),
+            dtype=str,
+            engine='c',
+            quoting=csv.QUOTE_NONE,
+            keep_default_na=False,
+            na_filter=False,
+            skip_blank_lines=True
+        ).fillna('')
+    
+    # Bỏ dấu nháy bao quanh ô
+    if '"' in text or "'" in text:
+        for column in df.columns:
+            df[column] = df[column].str.strip('"').str.strip("'")
+    
+    # Bỏ dòng trống
+    df = df[(df != '').any(axis=1)]
+    return df.reset_index(drop=True)
+
+# Thứ tự ưu tiên dấu phân cách, giống sniff_paste_delimiter
+_PASTE_DELIMITERS = ('\t', '  ', ',', '|', None)
+_PASTE_TAB_SPACE = re.compile(r'^[^\S\t]+|[^\S\t]+$')
+_PASTE_WIDE_SPACE = re.compile(r'\s{2,}')
+
+def parse_paste_line(line, sep):
+    """Tách một dòng dán thành các ô giống parse_paste_frame"""
+    if sep == '\t':
+        cells = [cell.strip() for cell in _PASTE_TAB_SPACE.sub('', line).split('\t')]
+    elif sep == '  ':
+        cells = _PASTE_WIDE_SPACE.split(line.strip())
+    elif sep is None:
+        cells = [line.strip()]
+    else:
+        cells = [cell.strip() for cell in line.strip().split(sep)]
+    
+    return [cell.strip('"').strip("'") for cell in cells]
+
+def _paste_quantity(cells):
+    """Giá trị cột Số lượng của một dòng (0 nếu trống/không phải số)"""
+    index = SHEET_COLUMNS.index('so_luong')
+    if cells is None or len(cells) <= index:
+        return 0.0
+    try:
+        value = float(re.sub(r'[\s,]', '', cells[index]))
+    except ValueError:
+        return 0.0
+    return value if math.isfinite(value) else 0.0
+
+class PastePreviewState:
+    """Kết quả phân tích dữ liệu dán của một phiên, cập nhật theo dòng.
+    
+    Mỗi lần update chỉ phân tích lại các dòng nằm giữa phần đầu và phần
+    cuối không đổi so với lần trước. Số dòng, số cột và tổng Số lượng được
+    cộng/trừ theo các dòng thay đổi. Chỉ khi dấu phân cách của cả khối đổi
+    thì mới phân tích lại toàn bộ.
+    """
+    
+    def __init__(self):
+        self.lines = []
+        self.rows = []          # mỗi dòng: list ô hoặc None (dòng trống)
+        self.widths = []        # số ô của mỗi dòng, kể cả dòng trống
+        self.ranks = []         # mỗi dòng: vị trí dấu phân cách trong _PASTE_DELIMITERS
+        self.sep = None
+        self.row_count = 0
+        self.total_quantity = 0.0
+        self._rank_counts = Counter()
+        self._width_counts = Counter()
+    
+    @staticmethod
+    def _rank(line):
+        # Dấu phẩy không xét theo từng dòng: như sniff_paste_delimiter, chỉ các
+        # dòng trong PASTE_SNIFF_LINES dòng đầu quyết định (xem update)
+        sep = sniff_paste_delimiter(line)
+        if sep == ',':
+            sep = '|' if '|' in line else None
+        return _PASTE_DELIMITERS.index(sep)
+    
+    def _parse(self, lines):
+        cells = [parse_paste_line(line, self.sep) for line in lines]
+        rows = [row if any(row) else None for row in cells]
+        return rows, [len(row) for row in cells]
+    
+    def _account(self, rows, widths, sign):
+        for row, width in zip(rows, widths):
+            self._width_counts[width] += sign
+            if row is not None:
+                self.row_count += sign
+                self.total_quantity += sign * _paste_quantity(row)
+    
+    def update(self, text):
+        """Cập nhật theo nội dung mới của ô dán; trả về số dòng đã phân tích lại"""
+        text = (text or '').replace('\r\n', '\n').replace('\r', '\n')
+        new_lines = text.split('\n') if text.strip() else []
+        old_lines = self.lines
+        
+        # Phần đầu và phần cuối giống lần trước
+        limit = min(len(old_lines), len(new_lines))
+        head = 0
+        while head < limit and old_lines[head] == new_lines[head]:
+            head += 1
+        tail = 0
+        while tail < limit - head and old_lines[-1 - tail] == new_lines[-1 - tail]:
+            tail += 1
+        old_end, new_end = len(old_lines) - tail, len(new_lines) - tail
+        added = new_lines[head:new_end]
+        
+        added_ranks = [self._rank(line) for line in added]
+        self._rank_counts.subtract(self.ranks[head:old_end])
+        self._rank_counts.update(added_ranks)
+        self.ranks[head:old_end] = added_ranks
+        self.lines = new_lines
+        
+        ranks = [rank for rank, count in self._rank_counts.items() if count > 0]
+        if _comma_delimited(new_lines):
+            ranks.append(_PASTE_DELIMITERS.index(','))
+        sep = _PASTE_DELIMITERS[min(ranks, default=len(_PASTE_DELIMITERS) - 1)]
+        if sep != self.sep:
+            self.sep = sep
+            self.row_count = 0
+            self.total_quantity = 0.0
+            self._width_counts.clear()
+            self.rows, self.widths = self._parse(new_lines)
+            self._account(self.rows, self.widths, 1)
+            return len(new_lines)
+        
+        self._account(self.rows[head:old_end], self.widths[head:old_end], -1)
+        rows, widths = self._parse(added)
+        self._account(rows, widths, 1)
+        self.rows[head:old_end] = rows
+        self.widths[head:old_end] = widths
+        if not self.row_count:
+            self.total_quantity = 0.0
+        return len(added)
+    
+    @property
+    def width(self):
+        if not self.row_count:
+            return 0
+        return max(width for width, count in self._width_counts.items() if count > 0)
+    
+    def preview(self, limit=20):
+        """limit dòng đầu tiên, pad đủ cột"""
+        width = self.width
+        rows = itertools.islice((row for row in self.rows if row is not None), limit)
+        return pd.DataFrame([row + [''] * (width - len(row)) for row in rows])
+
+def parse_excel_paste(pasted_text):
+    """Xử lý dữ liệu dán từ Excel (list các dòng, đã pad đủ cột)"""
+    try:
+        return parse_paste_frame(pasted_text).values.tolist()
+        
+    except Exception as e:
+        print(f"Lỗi phân tích dữ liệu: {str(e)}")
+        return []
+
+def _excel_cell_text(value):
+    """Giá trị ô openpyxl -> chuỗi theo định dạng của sheet tháng"""
+    if value is None:
+        return ''
+    if isinstance(value, datetime):
+        if value.time() == dt_time(0):
+            return value.strftime('%Y-%m-%d')
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, date):
+        return value.strftime('%Y-%m-%d')
+    if isinstance(value, dt_time):
+        return value.strftime('%H:%M:%S')
+    if isinstance(value, timedelta):
+        seconds = int(value.total_seconds())
+        return f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+    return str(value).strip()
+
+def iter_excel_chunks(path, sheet_name=None, chunk_rows=None, empty_block=None):
+    """Đọc file .xlsx ở chế độ read-only, trả về từng khối dòng theo thứ tự cột sheet.
+    
+    Dòng tiêu đề "Ngày/tháng" được dò ở cột A như find_header_row (không có
+    thì dòng 1 là tiêu đề). Có tiêu đề thì chỉ lấy các cột COLUMN_MAPPING
+    theo tên (ValueError nếu thiếu cột nào), các cột còn lại của sheet để
+    trống; không có tiêu đề thì giữ nguyên vị trí cột. Dừng khi gặp một
+    khối dòng trống.
+    """
+    if chunk_rows is None:
+        chunk_rows = SYSTEM_CONFIG["upload_chunk_rows"]
+    if empty_block is None:
+        empty_block = SYSTEM_CONFIG["sheet_empty_block"]
+    
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        # Ưu tiên sheet trùng tên tháng (T1...T12), không có thì sheet đang mở
+        worksheet = workbook[sheet_name] if sheet_name in workbook.sheetnames else workbook.active
+        
+        header_row = 1
+        for number, (cell,) in enumerate(worksheet.iter_rows(max_col=1, values_only=True), start=1):
+            if _is_header_row([_excel_cell_text(cell)]):
+                header_row = number
+                break
+        
+        rows = worksheet.iter_rows(min_row=header_row, values_only=True)
+        headers = [_excel_cell_text(cell) for cell in next(rows, ())]
+        positions = list(range(SHEET_WIDTH))
+        if headers and _is_header_row(headers):
+            index = {title: i for i, title in reversed(list(enumerate(headers)))}
+            missing = [title for title in COLUMN_MAPPING if title not in index]
+            if missing:
+                raise ValueError(f"File thiếu cột: {', '.join(missing)}")
+            positions = [index[title] for title in COLUMN_MAPPING]
+            positions += [None] * (SHEET_WIDTH - len(positions))
+        
+        chunk = []
+        blank_run = 0
+        for values in rows:
+            row = [_excel_cell_text(values[i]) if i is not None and i < len(values) else '' for i in positions]
+            if _is_blank_row(row):
+                blank_run += 1
+                if blank_run >= empty_block:
+                    break
+                continue
+            blank_run = 0
+            chunk.append(row)
+            if len(chunk) >= chunk_rows:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+    finally:
+        workbook.close()
+
+def excel_preview_frame(chunk, limit=20):
+    """limit dòng đầu của một khối, đặt tên cột theo tiêu đề sheet"""
+    titles = list(COLUMN_MAPPING)
+    return pd.DataFrame([row[:len(titles)] for row in chunk[:limit]], columns=titles)
+
+def build_write_batches(sheet_name, data, start_row=7, chunk_cells=None):
+    """Chia dữ liệu thành các lô values.batchUpdate, mỗi lô tối đa chunk_cells ô.
+    
+    Dòng được pad tới cột U để xóa giá trị cũ trên cùng dòng; các dòng cũ
+    phía sau dữ liệu do nơi gọi xóa (xem write_chunks_to_sheet).
+    """
+    if chunk_cells is None:
+        chunk_cells = SYSTEM_CONFIG["write_chunk_cells"]
+    
+    width = max(SHEET_WIDTH, max(len(row) for row in data))
+    rows_per_chunk = max(1, chunk_cells // width)
+    
+    batches = []
+    for offset in range(0, len(data), rows_per_chunk):
+        chunk = data[offset:offset + rows_per_chunk]
+        values = [
+            ["" if cell is None else str(cell) for cell in row] + [""] * (width - len(row))
+            for row in chunk
+        ]
+        first = start_row + offset
+        last = first + len(values) - 1
+        a1 = f"{rowcol_to_a1(first, 1)}:{rowcol_to_a1(last, width)}"
+        batches.append([{"range": absolute_range_name(sheet_name, a1), "values": values}])
+    
+    return batches
+
+def write_to_sheet(client, sheet_name, data, start_row=7, sheet_url=None, progress=None):
+    """Ghi dữ liệu vào Google Sheets theo lô 2-D (values.batchUpdate).
+    
+    progress(số dòng đã ghi, tổng số dòng) được gọi sau mỗi lô.
+    """
+    if not data:
+        return False
+    return write_chunks_to_sheet(client, sheet_name, [data], start_row, sheet_url, progress, total=len(data))
+
+def write_chunks_to_sheet(client, sheet_name, chunks, start_row=7, sheet_url=None, progress=None, total=None):
+    """Ghi lần lượt các khối dòng (iterable) liền nhau từ start_row.
+    
+    Chỉ giữ khối đang ghi và khối kế tiếp trong bộ nhớ. Ghi xong thì xóa
+    phần còn lại của khối dữ liệu cũ (tới khối dòng trống đầu tiên), nên
+    đây là thay cả vùng dữ liệu từ start_row. progress(số dòng đã ghi, total) sau mỗi lô, total là None
+    nếu chưa biết trước.
+    """
+    try:
+        if sheet_url is None:
+            sheet_url = SYSTEM_CONFIG["default_sheet_url"]
+        
+        chunks = (chunk for chunk in chunks if chunk)
+        pending = next(chunks, None)
+        if pending is None:
+            return False
+        
+        spreadsheet = SHEET_HANDLES.spreadsheet(client, sheet_url)
+        worksheet = SHEET_HANDLES.worksheet(client, sheet_url, sheet_name)
+        row_count, col_count = worksheet.row_count, worksheet.col_count
+        reloaded = False
+        
+        written = 0
+        summary = None
+        while pending is not None:
+            chunk, pending = pending, next(chunks, None)
+            last = pending is None
+            first_row = start_row + written
+            
+            # Mở rộng lưới nếu dữ liệu vượt quá số dòng/cột hiện có
+            needed_rows = first_row + len(chunk) - 1
+            if needed_rows > row_count and not reloaded:
+                # Số dòng đang nhớ có thể đã cũ (thêm dòng trên Sheets, values.append):
+                # lấy lại trước khi resize để không cắt mất dòng
+                worksheet = SHEET_HANDLES.reload(client, sheet_url, sheet_name)
+                row_count, col_count = worksheet.row_count, worksheet.col_count
+                reloaded = True
+            if needed_rows > row_count:
+                if total is not None:
+                    needed_rows = max(needed_rows, start_row + total - 1)
+                elif not last:
+                    # Chưa biết tổng số dòng: nới trước vài khối để bớt lượt gọi API
+                    needed_rows += 3 * len(chunk)
+                worksheet.add_rows(needed_rows - row_count)
+                row_count = needed_rows
+            needed_cols = max(SHEET_WIDTH, max(len(row) for row in chunk))
+            if needed_cols > col_count:
+                worksheet.add_cols(needed_cols - col_count)
+                col_count = needed_cols
+            
+            # Ghi đè trực tiếp, không xóa trước: lỗi giữa chừng không để lại vùng trống
+            done = 0
+            for batch in build_write_batches(sheet_name, chunk, first_row):
+                spreadsheet.values_batch_update({"valueInputOption": "RAW", "data": batch})
+                done = min(len(chunk), done + len(batch[0]["values"]))
+                if progress is not None:
+                    progress(written + done, total)
+            written += len(chunk)
+            record_sheet_io("write", sheet_name, chunk)
+            
+            delta = summarize_month_frame(rows_to_month_frame(chunk))
+            summary = delta if summary is None else {name: summary[name] + delta[name] for name in delta}
+        
+        # Xóa phần còn lại của khối dữ liệu cũ (tháng trước dài hơn). Chỉ tới dòng
+        # cuối của khối: ghi chú/tổng cộng cách khối một đoạn trống vẫn được giữ
+        first_stale = start_row + written
+        last_stale = find_data_end(worksheet, first_stale,
+                                   reload=functools.partial(SHEET_HANDLES.reload, client, sheet_url, sheet_name))
+        if last_stale >= first_stale:
+            worksheet.batch_clear([f"{SHEET_FIRST_COLUMN}{first_stale}:{SHEET_LAST_COLUMN}{last_stale}"])
+        
+        # Ghi từ dòng dữ liệu đầu tiên là thay cả tháng (đã xóa hết dữ liệu cũ):
+        # tổng hợp lại từ chính dữ liệu vừa ghi
+        key = (sheet_url, sheet_name)
+        if start_row == SYSTEM_CONFIG["data_start_row"]:
+            update = functools.partial(SUMMARY_STORE.replace, key, summary)
+        else:
+            update = functools.partial(SUMMARY_STORE.drop, key)
+        MONTH_CACHE.invalidate(sheet_url, sheet_name, then=update)
+        SHEET_ERRORS.pop(key, None)
+        return True
+        
+    except Exception as e:
+        print(f"Lỗi ghi dữ liệu: {str(e)}")
+        if is_structure_error(e):
+            SHEET_HANDLES.invalidate(sheet_url)
+        SUMMARY_STORE.drop((sheet_url, sheet_name))
+        SHEET_ERRORS[(sheet_url, sheet_name)] = describe_sheets_error(e)
+        return False
+    
+    finally:
+        # Dù ghi thành công hay lỗi giữa chừng, dữ liệu tháng đã thay đổi
+        MONTH_CACHE.invalidate(sheet_url, sheet_name)
+
+def append_to_sheet(client, sheet_name, rows, sheet_url=None):
+    """Nối các dòng vào cuối vùng dữ liệu tháng bằng một lần gọi values.append.
+    
+    Google tự tìm dòng cuối của bảng và chèn dòng mới (INSERT_ROWS) nên
+    không ghi đè dữ liệu phía dưới. Khác với ghi thay cả tháng, lỗi mạng
+    sau khi Google đã nhận request thì lần thử lại có thể nối trùng, nên
+    trả về True nếu đã ghi, False nếu chắc chắn chưa ghi và None nếu không
+    rõ (xem append_landed trước khi ghi lại).
+    """
+    if not rows:
+        return False
+    if sheet_url is None:
+        sheet_url = SYSTEM_CONFIG["default_sheet_url"]
+    key = (sheet_url, sheet_name)
+    try:
+        spreadsheet = SHEET_HANDLES.spreadsheet(client, sheet_url)
+        spreadsheet.values_append(
+            f"'{sheet_name}'!{SHEET_FIRST_COLUMN}{SYSTEM_CONFIG['data_start_row']}:{SHEET_LAST_COLUMN}",
+            params={"valueInputOption": "RAW", "insertDataOption": "INSERT_ROWS"},
+            body={"values": rows}
+        )
+        # INSERT_ROWS làm lưới dài thêm: số dòng trong handle đang nhớ đã cũ
+        SHEET_HANDLES.expire(sheet_url)
+        record_sheet_io("write", sheet_name, rows)
+        MONTH_CACHE.invalidate(sheet_url, sheet_name, then=functools.partial(
+            SUMMARY_STORE.add, key, summarize_month_frame(rows_to_month_frame(rows))))
+        SHEET_ERRORS.pop(key, None)
+        return True
+    
+    except Exception as e:
+        print(f"Lỗi ghi nối dữ liệu: {str(e)}")
+        if is_structure_error(e):
+            SHEET_HANDLES.invalidate(sheet_url)
+        if is_ambiguous_write_error(e):
+            SHEET_HANDLES.expire(sheet_url)
+            SUMMARY_STORE.drop(key)
+            SHEET_ERRORS[key] = "⚠️ Chưa rõ dữ liệu nối đã được ghi hay chưa, sẽ kiểm tra lại trên Google Sheets trước khi ghi"
+            return None
+        SHEET_ERRORS[key] = describe_sheets_error(e)
+        return False
+    
+    finally:
+        MONTH_CACHE.invalidate(sheet_url, sheet_name)
+
+def append_landed(client, sheet_name, rows, sheet_url=None):
+    """Các dòng của một lần nối không rõ kết quả đã có liền nhau trong vùng dữ liệu tháng chưa.
+    
+    Đọc thẳng từ Google Sheets (không qua cache); lỗi đọc được ném ra.
+    """
+    if sheet_url is None:
+        sheet_url = SYSTEM_CONFIG["default_sheet_url"]
+    spreadsheet = SHEET_HANDLES.spreadsheet(client, sheet_url)
+    response = spreadsheet.values_batch_get(
+        [f"'{sheet_name}'!{SHEET_FIRST_COLUMN}{SYSTEM_CONFIG['data_start_row']}:{SHEET_LAST_COLUMN}"]
+    )
+    
+    def normalize(row):
+        row = [str(cell) for cell in row[:SHEET_WIDTH]]
+        while row and row[-1] == '':
+            row.pop()
+        return tuple(row)
+    
+    target = [normalize(row) for row in rows]
+    values = [normalize(row) for row in response["valueRanges"][0].get("values", [])]
+    return any(values[i:i + len(target)] == target for i in range(len(values) - len(target), -1, -1))
+
+# ========== NHIỀU SPREADSHEET (NĂM / KHO) ==========
+def load_sheet_registry():
+    """Danh sách spreadsheet [{"year", "warehouse", "url"}] từ Environment Variables hoặc sheet_registry.json"""
+    if 'SHEET_REGISTRY_JSON' in os.environ:
+        return json.loads(os.environ['SHEET_REGISTRY_JSON'])
+    if os.path.exists('sheet_registry.json'):
+        with open('sheet_registry.json', 'r', encoding='utf-8') as f:
+            return json.load(f)
+    # Mặc định: chỉ spreadsheet đang dùng, coi là của năm hiện tại
+    return [{"year": datetime.now().year, "url": SYSTEM_CONFIG["default_sheet_url"]}]
+
+class SpreadsheetRegistry:
+    """Các spreadsheet theo năm (và kho nếu có), đọc song song khi so sánh.
+    
+    Mỗi truy vấn nhiều spreadsheet chạy trên một thread pool chung có kích
+    thước cố định. Spreadsheet lỗi hoặc quá thời gian được báo riêng, phần
+    còn lại vẫn được trả về.
+    """
+    
+    def __init__(self, sources=None, max_workers=None):
+        if max_workers is None:
+            max_workers = SYSTEM_CONFIG["registry_max_workers"]
+        self._lock = threading.Lock()
+        self._sources = {}   # (năm, kho) -> url
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sheet-sources")
+        for source in sources if sources is not None else load_sheet_registry():
+            self.register(source["year"], source["url"], source.get("warehouse"))
+    
+    @staticmethod
+    def label(year, warehouse=""):
+        return f"{year} · {warehouse}" if warehouse else str(year)
+    
+    def register(self, year, url, warehouse=None):
+        with self._lock:
+            self._sources[(int(year), warehouse or "")] = url
+    
+    def get(self, year, warehouse=None):
+        with self._lock:
+            return self._sources.get((int(year), warehouse or ""))
+    
+    def sources(self, labels=None):
+        """[(nhãn, năm, kho, url)] theo năm rồi kho; labels=None là tất cả"""
+        with self._lock:
+            items = sorted(self._sources.items())
+        return [(self.label(year, warehouse), year, warehouse, url)
+                for (year, warehouse), url in items
+                if labels is None or self.label(year, warehouse) in labels]
+    
+    def labels(self):
+        return [label for label, *_ in self.sources()]
+    
+    def fetch_year(self, client, labels=None, timeout=None):
+        """Đọc cả năm của các spreadsheet đã chọn -> (DataFrame, {nhãn: lỗi}).
+        
+        DataFrame ghép có thêm cột source, year, warehouse. Lượt đọc quá
+        timeout vẫn chạy tiếp ở nền và nạp MONTH_CACHE cho lần sau.
+        """
+        if timeout is None:
+            timeout = SYSTEM_CONFIG["registry_timeout"]
+        
+        sources = self.sources(labels)
+        futures = [(self._executor.submit(fetch_year_data, client, url), label, year, warehouse)
+                   for label, year, warehouse, url in sources]
+        done, _ = wait_futures([future for future, *_ in futures], timeout=timeout)
+        
+        frames = []
+        failures = {}
+        for future, label, year, warehouse in futures:
+            if future not in done:
+                failures[label] = "⏳ Quá thời gian chờ Google Sheets"
+                continue
+            try:
+                df = future.result()
+            except Exception as e:
+                print(f"Lỗi đọc spreadsheet {label}: {str(e)}")
+                failures[label] = describe_sheets_error(e)
+                continue
+            if not df.empty:
+                frames.append(df.assign(source=label, year=year, warehouse=warehouse))
+        
+        if not frames:
+            return pd.DataFrame(), failures
+        
+        df = pd.concat(frames, ignore_index=True)
+        # Danh mục mỗi spreadsheet khác nhau nên concat trả về object: chuyển lại
+        for column in SCHEMA_CATEGORY_COLUMNS + ['month', 'source', 'warehouse']:
+            if column in df.columns:
+                df[column] = df[column].astype('category')
+        return df, failures
+
+SHEET_REGISTRY = SpreadsheetRegistry()
+
+# ========== TRUY CẬP DỮ LIỆU BẤT ĐỒNG BỘ ==========
+class AsyncSheetsGateway:
+    """Đọc/ghi dữ liệu tháng cho các handler async của Gradio.
+    
+    Lời gọi gspread (đồng bộ) chạy trên thread pool riêng có kích thước
+    max_in_flight, nên nhiều báo cáo cùng lúc chỉ chờ trên event loop thay
+    vì chiếm hết worker thread của Gradio.
+    """
+    
+    def __init__(self, max_in_flight=None):
+        if max_in_flight is None:
+            max_in_flight = SYSTEM_CONFIG["max_sheets_in_flight"]
+        self.max_in_flight = max_in_flight
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="sheets-io")
+        self._lock = threading.Lock()
+        self._stats = {"in_flight": 0, "waiting": 0, "completed": 0}
+    
+    def _track(self, fn):
+        @functools.wraps(fn)
+        def tracked(*args, **kwargs):
+            with self._lock:
+                self._stats["waiting"] -= 1
+                self._stats["in_flight"] += 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._stats["in_flight"] -= 1
+                    self._stats["completed"] += 1
+        return tracked
+    
+    async def run(self, fn, *args, **kwargs):
+        """Chạy một hàm đồng bộ trên thread pool Sheets"""
+        with self._lock:
+            self._stats["waiting"] += 1
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(self._track(fn), *args, **kwargs))
+    
+    def close_after(self, pending, generator):
+        """Đóng generator trên thread pool Sheets sau khi pending (task đang
+        dùng generator trên thread) kết thúc, kể cả khi lượt chờ đã bị hủy"""
+        def close(task=None):
+            if task is not None and not task.cancelled():
+                task.exception()   # đã báo lỗi cho người dùng (nếu còn chờ), không log lại
+            with self._lock:
+                self._stats["waiting"] += 1
+            self._executor.submit(self._track(generator.close))
+        
+        if pending is None or pending.done():
+            close(pending)
+        else:
+            pending.add_done_callback(close)
+    
+    async def read_month(self, sheet_name, sheet_url=None):
+        """Đọc một tháng; dữ liệu còn mới trong cache trả ngay không qua thread"""
+        if sheet_url is None:
+            sheet_url = SYSTEM_CONFIG["default_sheet_url"]
+        df = MONTH_CACHE.peek((sheet_url, sheet_name))
+        if df is not None:
+            return df
+        client = await self.run(get_google_client)
+        return await self.run(read_sheet_data, client, sheet_name, sheet_url)
+    
+    async def read_year(self, sheet_url=None):
+        client = await self.run(get_google_client)
+        if client is None:
+            return None
+        return await self.run(read_year_data, client, sheet_url)
+    
+    async def read_sources(self, labels=None):
+        """Cả năm của nhiều spreadsheet -> (DataFrame, {nhãn: lỗi}), None nếu mất kết nối"""
+        client = await self.run(get_google_client)
+        if client is None:
+            return None
+        return await self.run(SHEET_REGISTRY.fetch_year, client, labels)
+    
+    async def write_chunks(self, sheet_name, chunks, start_row=7, sheet_url=None, progress=None):
+        client = await self.run(get_google_client)
+        if client is None:
+            return None
+        return await self.run(write_chunks_to_sheet, client, sheet_name, chunks, start_row, sheet_url, progress)
+    
+    async def write_month(self, sheet_name, data, start_row=7, sheet_url=None, progress=None):
+        client = await self.run(get_google_client)
+        if client is None:
+            return None
+        return await self.run(write_to_sheet, client, sheet_name, data, start_row, sheet_url, progress)
+    
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, max_in_flight=self.max_in_flight)
+
+SHEETS_GATEWAY = AsyncSheetsGateway()
+
+# ========== HÀNG ĐỢI GHI NỀN (WRITE-BEHIND) ==========
+class SaveJournal:
+    """Nhật ký append-only (JSON Lines) các lượt lưu chưa ghi lên Google Sheets.
+
+    Mỗi lượt lưu là một dòng "save" (được fsync trước khi báo đã nhận);
+    mỗi lần ghi xong, nhật ký được viết lại chỉ còn các lượt đang chờ nên
+    không phình ra. Khởi động lại chỉ cần đọc lại các lượt còn trong nhật
+    ký (dòng "done" của nhật ký cũ vẫn được hiểu). Nhật ký nằm trên đĩa của
+    instance nên chỉ sống sót qua các lần khởi động lại trên cùng máy.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory or SYSTEM_CONFIG["journal_dir"]
+        self.path = os.path.join(self.directory, "saves.jsonl")
+        self._lock = threading.Lock()
+
+    def _write(self, f, records):
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+    def append(self, *records):
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                self._write(f, records)
+
+    def replay(self):
+        """Các bản ghi "save" chưa có "done", theo thứ tự đã lưu"""
+        saves = {}
+        with self._lock:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except json.JSONDecodeError:
+                            # Dòng ghi dở khi tiến trình bị dừng: chưa được báo đã nhận
+                            print(f"⚠️ Bỏ qua dòng nhật ký hỏng: {line[:80]!r}")
+                            continue
+                        if record.get("type") == "save":
+                            saves[record["id"]] = record
+                        elif record.get("type") == "done":
+                            for save_id in record["ids"]:
+                                saves.pop(save_id, None)
+            except FileNotFoundError:
+                pass
+        return list(saves.values())
+
+    def compact(self, records):
+        """Viết lại nhật ký chỉ gồm các lượt còn chờ (ghi file tạm rồi đổi tên)"""
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                self._write(f, records)
+            os.replace(tmp_path, self.path)
+
+def merge_saves(records):
+    """Gộp các lượt lưu của cùng một tháng thành một lần ghi -> (op, rows).
+
+    "replace" thay cả vùng dữ liệu tháng nên bỏ mọi lượt trước nó; các lượt
+    "append" sau đó được nối vào cuối. Chỉ có "append" thì nối tất cả trong
+    một lần.
+    """
+    op, rows = "append", []
+    for record in records:
+        if record["op"] == "replace":
+            op, rows = "replace", list(record["rows"])
+        else:
+            rows.extend(record["rows"])
+    return op, rows
+
+class WriteBehindQueue:
+    """Lưu vào nhật ký, báo đã nhận ngay, ghi lên Google Sheets ở luồng nền.
+
+    Các lượt lưu đang chờ của cùng một tháng được gộp thành một lần ghi.
+    Ghi lỗi thì giữ lại trong nhật ký và thử lại với backoff; khởi động lại
+    thì đọc lại nhật ký và ghi tiếp. Lượt nối lỗi mà không rõ Google đã ghi
+    hay chưa được đánh dấu "uncertain" và chỉ ghi lại khi kiểm tra trên
+    sheet chưa thấy các dòng đó.
+    """
+
+    def __init__(self, journal=None, flush_delay=None, retry_base=None, retry_max=None):
+        self.journal = journal or SaveJournal()
+        self.flush_delay = SYSTEM_CONFIG["save_flush_delay"] if flush_delay is None else flush_delay
+        self.retry_base = retry_base or SYSTEM_CONFIG["save_retry_base"]
+        self.retry_max = retry_max or SYSTEM_CONFIG["save_retry_max"]
+        self._cond = threading.Condition()
+        self._pending = {}       # (sheet_url, sheet_name) -> các bản ghi "save" theo thứ tự
+        self._due = {}           # key -> thời điểm (monotonic) được ghi
+        self._attempts = {}      # key -> số lần ghi lỗi liên tiếp
+        self._thread = None
+        self._stats = {"saved": 0, "replayed": 0, "writes": 0, "merged": 0, "write_errors": 0,
+                       "uncertain": 0, "already_written": 0}
+
+    def start(self):
+        """Đọc lại nhật ký và chạy luồng ghi nền (gọi nhiều lần không sao)"""
+        with self._cond:
+            if self._thread is not None:
+                return
+            for record in self.journal.replay():
+                self._add(record, due=time.monotonic())
+                self._stats["replayed"] += 1
+            if self._stats["replayed"]:
+                print(f"📒 Ghi tiếp {self._stats['replayed']} lượt lưu còn trong nhật ký")
+            self._thread = threading.Thread(target=self._run, name="save-flusher", daemon=True)
+            self._thread.start()
+
+    def _add(self, record, due):
+        key = (record["sheet_url"], record["sheet_name"])
+        self._pending.setdefault(key, []).append(record)
+        self._due.setdefault(key, due)
+        self._cond.notify_all()
+
+    def submit(self, sheet_name, rows, sheet_url=None, op="replace"):
+        """Ghi lượt lưu vào nhật ký (bền vững) và xếp hàng ghi lên sheet.
+        
+        op="replace" thay cả vùng dữ liệu tháng, "append" nối vào cuối.
+        """
+        self.start()
+        record = {
+            "type": "save",
+            "id": uuid.uuid4().hex,
+            "sheet_url": sheet_url or SYSTEM_CONFIG["default_sheet_url"],
+            "sheet_name": sheet_name,
+            "op": op,
+            "rows": rows,
+            "saved_at": datetime.now().isoformat(timespec="seconds"),
+        }
+        with self._cond:
+            self.journal.append(record)
+            self._add(record, due=time.monotonic() + self.flush_delay)
+            self._stats["saved"] += 1
+        return record["id"]
+
+    def pending(self, key):
+        with self._cond:
+            return len(self._pending.get(key, ()))
+    
+    def _compact(self):
+        # Gọi khi đang giữ self._cond: nhật ký chỉ còn các lượt đang chờ
+        self.journal.compact([record for records in self._pending.values() for record in records])
+
+    def _next_due(self):
+        """(key, số giây còn phải chờ) của tháng đến lượt ghi sớm nhất"""
+        if not self._due:
+            return None, None
+        key = min(self._due, key=self._due.get)
+        return key, max(0.0, self._due[key] - time.monotonic())
+
+    def _run(self):
+        while True:
+            with self._cond:
+                key, delay = self._next_due()
+                while key is None or delay > 0:
+                    self._cond.wait(timeout=delay)
+                    key, delay = self._next_due()
+                records = list(self._pending[key])
+                del self._due[key]
+
+            try:
+                ok = self._write(key, records)
+            except Exception as e:
+                print(f"Lỗi ghi nền {key[1]}: {str(e)}")
+                ok = False
+
+            with self._cond:
+                if ok:
+                    done = {record["id"] for record in records}
+                    remaining = [r for r in self._pending[key] if r["id"] not in done]
+                    if remaining:
+                        self._pending[key] = remaining
+                        self._due.setdefault(key, time.monotonic() + self.flush_delay)
+                    else:
+                        del self._pending[key]
+                    self._attempts.pop(key, None)
+                    self._stats["writes"] += 1
+                    self._stats["merged"] += len(records) - 1
+                    self._compact()
+                else:
+                    if ok is None:
+                        # Không tự nối lại: lần sau kiểm tra trên sheet trước (cờ được lưu vào nhật ký)
+                        for record in records:
+                            record["uncertain"] = True
+                        self._stats["uncertain"] += 1
+                        self._compact()
+                    attempt = self._attempts.get(key, 0)
+                    self._attempts[key] = attempt + 1
+                    delay = min(self.retry_max, self.retry_base * 2 ** attempt) * random.uniform(0.5, 1.0)
+                    self._due[key] = time.monotonic() + delay
+                    self._stats["write_errors"] += 1
+                    print(f"⚠️ Chưa ghi được {key[1]}, thử lại sau {delay:.0f}s ({len(self._pending[key])} lượt lưu đang chờ)")
+
+    def _write(self, key, records):
+        sheet_url, sheet_name = key
+        client = get_google_client()
+        if client is None:
+            SHEET_ERRORS[key] = "❌ Không thể kết nối Google Sheets"
+            return False
+        op, rows = merge_saves(records)
+        if op == "append":
+            uncertain = [record for record in records if record.get("uncertain")]
+            if uncertain:
+                if append_landed(client, sheet_name, merge_saves(uncertain)[1], sheet_url=sheet_url):
+                    with self._cond:
+                        self._stats["already_written"] += len(uncertain)
+                    rows = merge_saves([record for record in records if not record.get("uncertain")])[1]
+                    if not rows:
+                        MONTH_CACHE.invalidate(sheet_url, sheet_name)
+                        SHEET_ERRORS.pop(key, None)
+                        return True
+            return append_to_sheet(client, sheet_name, rows, sheet_url=sheet_url)
+        return write_to_sheet(client, sheet_name, rows,
+                              start_row=SYSTEM_CONFIG["data_start_row"], sheet_url=sheet_url)
+
+    def stats(self):
+        with self._cond:
+            return dict(self._stats, pending=sum(len(records) for records in self._pending.values()))
+
+SAVE_QUEUE = WriteBehindQueue()
+
+# ========== CHỈ SỐ KPI ==========
+# Cột DataFrame -> tiêu đề bảng báo cáo
+REPORT_COLUMNS = {
+    'date': 'Ngày',
+    'so_xe': 'Số xe',
+    'nguyen_lieu': 'Nguyên liệu',
+    'xe_can_vao': 'Vào',
+    'xe_can_ra': 'Ra',
+    'tong_thoi_gian': 'TG',
+    'so_luong': 'SL',
+    'net_weight': 'Kg',
+    'nguyen_nhan': 'Nguyên nhân',
+    'ly_do_chi_tiet': 'Chi tiết'
+}
+
+def _as_duration(values):
+    if pd.api.types.is_timedelta64_dtype(values):
+        return values
+    return parse_duration_column(values)
+
+def _as_float(values):
+    if pd.api.types.is_numeric_dtype(values):
+        return values
+    return parse_float_column(values)
+
+def _as_datetime(values):
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    return parse_date_column(values)
+
+def _column(df, name, parser):
+    if name in df.columns:
+        return parser(df[name])
+    return parser(pd.Series(pd.NA, index=df.index, dtype=object))
+
+def _kpi_columns(df, late_cutoff=None, slow_threshold=None):
+    """(late, slow, duration, weight) dạng Series cho toàn DataFrame"""
+    cutoff = pd.to_timedelta(late_cutoff or SYSTEM_CONFIG["late_cutoff"])
+    threshold = pd.to_timedelta(slow_threshold or SYSTEM_CONFIG["slow_threshold"])
+    
+    arrival = _column(df, 'xe_can_vao', _as_duration)
+    departure = _column(df, 'xe_can_ra', _as_duration)
+    duration = _column(df, 'tong_thoi_gian', _as_duration).fillna(departure - arrival)
+    weight = _column(df, 'net_weight', _as_float).astype('float64')
+    
+    # So sánh với NaT luôn False nên ô trống không bị tính là trễ/chậm
+    return arrival > cutoff, duration > threshold, duration, weight
+
+def compute_kpis(df, late_cutoff=None, slow_threshold=None):
+    """Tính các chỉ số báo cáo trên toàn cột (không lặp từng dòng).
+    
+    Dùng được cho một tháng hoặc DataFrame cả năm. Xe trễ: giờ cân vào sau
+    late_cutoff; xe chậm: tổng thời gian (hoặc Ra - Vào) vượt slow_threshold.
+    """
+    late, slow, duration, weight = _kpi_columns(df, late_cutoff, slow_threshold)
+    known = duration.dropna()
+    
+    p50, p95 = known.quantile([0.5, 0.95]).tolist() if len(known) else (pd.NaT, pd.NaT)
+    
+    total = len(df)
+    late_count = int(late.sum())
+    slow_count = int(slow.sum())
+    
+    daily = pd.DataFrame(columns=['total', 'late', 'slow'])
+    if 'date' in df.columns and total:
+        dates = _as_datetime(df['date']).dt.normalize()
+        daily = pd.DataFrame({'total': 1, 'late': late, 'slow': slow}, index=df.index).groupby(dates).sum()
+    
+    return {
+        "total_vehicles": total,
+        "late_count": late_count,
+        "late_rate": late_count / total if total else 0.0,
+        "slow_count": slow_count,
+        "slow_rate": slow_count / total if total else 0.0,
+        "avg_duration": known.mean() if len(known) else pd.NaT,
+        "p50_duration": p50,
+        "p95_duration": p95,
+        "total_weight": float(weight.sum()),
+        "daily": daily
+    }
+
+def format_minutes(value):
+    """Timedelta -> "52 phút" ("--" nếu không có)"""
+    if value is None or pd.isna(value):
+        return "--"
+    return f"{value.total_seconds() / 60:.0f} phút"
+
+def _format_duration_column(values):
+    seconds = values.dt.total_seconds()
+    known = seconds.notna()
+    seconds = seconds.fillna(0).astype('int64')
+    text = (
+        (seconds // 3600).astype(str).str.zfill(2) + ':' +
+        (seconds % 3600 // 60).astype(str).str.zfill(2) + ':' +
+        (seconds % 60).astype(str).str.zfill(2)
+    )
+    return text.where(known, '')
+
+def to_display_frame(df):
+    """DataFrame đã chuyển kiểu -> bảng chuỗi theo tiêu đề REPORT_COLUMNS"""
+    display = pd.DataFrame(index=df.index)
+    for column, title in REPORT_COLUMNS.items():
+        if column not in df.columns:
+            display[title] = ''
+            continue
+        values = df[column]
+        if pd.api.types.is_datetime64_any_dtype(values):
+            display[title] = values.dt.strftime('%Y-%m-%d').fillna('')
+        elif pd.api.types.is_timedelta64_dtype(values):
+            display[title] = _format_duration_column(values)
         else:
-            print("⚠️ Không tìm thấy Google Sheets credentials")
-            return None
-        
-        scope = [
-            'https://www.googleapis.com/auth/spreadsheets',
-            'https://www.googleapis.com/auth/drive'
-        ]
-        
-        # Fix newline trong private key
-        if 'private_key' in creds_dict:
-            creds_dict['private_key'] = creds_dict['private_key'].replace('\\n', '\n')
-        
-        credentials = Credentials.from_service_account_info(creds_dict, scopes=scope)
-        client = gspread.authorize(credentials)
-        print("✅ Kết nối Google Sheets thành công!")
-        return client
-        
-    except Exception as e:
-        print(f"❌ Lỗi kết nối Google Sheets: {str(e)}")
-        traceback.print_exc()
-        return None
+            display[title] = values.astype(object).where(values.notna(), '')
+    return display.reset_index(drop=True)
 
-# ========== HÀM XỬ LÝ DỮ LIỆU ==========
-def read_sheet_data(client, sheet_name, sheet_url=None):
-    """Đọc dữ liệu từ sheet cụ thể"""
-    try:
-        if sheet_url is None:
-            sheet_url = SYSTEM_CONFIG["default_sheet_url"]
-        
-        spreadsheet = client.open_by_url(sheet_url)
-        worksheet = spreadsheet.worksheet(sheet_name)
-        
-        # Đọc toàn bộ dữ liệu
-        all_data = worksheet.get_all_values()
-        
-        if not all_data:
-            return pd.DataFrame()
-        
-        # Xác định dòng bắt đầu dữ liệu
-        start_row = 0
-        for i, row in enumerate(all_data):
-            if len(row) > 0 and "Ngày/tháng" in str(row[0]):
-                start_row = i
-                break
-        
-        # Đọc dữ liệu từ dòng start_row đến 70
-        data_rows = all_data[start_row:70]
-        
-        if len(data_rows) > 1:
-            headers = data_rows[0]
-            data = data_rows[1:]
-            
-            # Đảm bảo số cột bằng nhau
-            max_cols = max(len(row) for row in data)
-            headers = headers + [''] * (max_cols - len(headers))
-            
-            # Pad các dòng
-            padded_data = []
-            for row in data:
-                padded_row = row + [''] * (max_cols - len(row))
-                padded_data.append(padded_row)
-            
-            df = pd.DataFrame(padded_data, columns=headers)
-            
-            # Lọc dòng trống
-            df = df.replace('', pd.NA)
-            df = df.dropna(how='all')
-            
-            # Đổi tên cột
-            column_mapping = {
-                'Ngày/tháng': 'date',
-                'Số Xe': 'so_xe',
-                'Tên nguyên liệu': 'nguyen_lieu',
-                'Xe cân VÀO': 'xe_can_vao',
-                'Xe cân RA': 'xe_can_ra',
-                'Tổng thời gian': 'tong_thoi_gian',
-                'Số lượng': 'so_luong',
-                'Bag.': 'bag',
-                'Net.Wgh. (kg)': 'net_weight',
-                'Nguyên nhân': 'nguyen_nhan',
-                'Lí do chi tiết': 'ly_do_chi_tiet'
-            }
-            
-            df = df.rename(columns={k: v for k, v in column_mapping.items() if k in df.columns})
-            
-            return df
+def format_report_stats(kpis):
+    """Các dòng thống kê của tab báo cáo"""
+    cutoff = SYSTEM_CONFIG["late_cutoff"][:2].lstrip('0')
+    threshold = SYSTEM_CONFIG["slow_threshold"][:2].lstrip('0')
+    return [
+        f"**Tổng số xe:** {kpis['total_vehicles']}",
+        f"**Xe nhập trễ (>{cutoff}h):** {kpis['late_count']} ({kpis['late_rate']:.0%})",
+        f"**Xe nhập chậm (>{threshold}h):** {kpis['slow_count']} ({kpis['slow_rate']:.0%})",
+        f"**Tổng khối lượng:** {kpis['total_weight']:,.0f} kg",
+        f"**TG trung bình/xe:** {format_minutes(kpis['avg_duration'])} "
+        f"(p50 {format_minutes(kpis['p50_duration'])}, p95 {format_minutes(kpis['p95_duration'])})"
+    ]
+
+# ========== BẢNG BÁO CÁO PHÂN TRANG ==========
+# Cột được tìm khi lọc theo từ khóa
+REPORT_SEARCH_COLUMNS = ['so_xe', 'nguyen_lieu', 'nguyen_nhan', 'ly_do_chi_tiet']
+
+def match_report_rows(df, query):
+    """Mảng bool: dòng có chứa query (không phân biệt hoa thường) ở các cột chữ"""
+    mask = np.zeros(len(df), dtype=bool)
+    for column in REPORT_SEARCH_COLUMNS:
+        if column not in df.columns:
+            continue
+        values = df[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            # Chỉ so khớp trên danh sách category, rồi tra theo mã
+            hits = values.cat.categories.astype(str).str.contains(query, case=False, regex=False)
+            codes = values.cat.codes.to_numpy()
+            mask |= (codes >= 0) & np.append(hits, False)[codes]
         else:
-            return pd.DataFrame()
-            
-    except Exception as e:
-        print(f"Lỗi đọc sheet {sheet_name}: {str(e)}")
-        return pd.DataFrame()
+            mask |= values.astype('string').str.contains(query, case=False, regex=False).fillna(False).to_numpy(dtype=bool)
+    return mask
 
-def parse_excel_paste(pasted_text):
-    """Xử lý dữ liệu dán từ Excel"""
-    try:
-        if not pasted_text.strip():
-            return []
+def sort_report_positions(df, positions, column, ascending=True):
+    """Sắp xếp các vị trí dòng theo cột đã chuyển kiểu (ô trống xếp cuối)"""
+    values = df[column].iloc[positions].reset_index(drop=True)
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        values = values.cat.reorder_categories(sorted(values.cat.categories, key=str), ordered=True)
+    order = values.sort_values(ascending=ascending, kind='stable', na_position='last').index.to_numpy()
+    return positions[order]
+
+class ReportView:
+    """Khung dữ liệu báo cáo giữ ở server, chỉ gửi trang đang xem.
+    
+    Lọc và sắp xếp chạy một lần khi điều kiện đổi, kết quả là mảng vị trí
+    dòng. Lật trang chỉ cắt mảng đó nên không phụ thuộc số dòng của tháng.
+    """
+    
+    def __init__(self, df, page_size=None):
+        if page_size is None:
+            page_size = SYSTEM_CONFIG["report_page_size"]
+        self.df = df
+        self.page_size = page_size
+        self.positions = np.arange(len(df))
+        self.page = 0
+    
+    def apply(self, sort_title=None, ascending=True, query=''):
+        """Lọc theo query rồi sắp xếp theo cột có tiêu đề sort_title"""
+        positions = np.arange(len(self.df))
+        query = (query or '').strip()
+        if query:
+            positions = positions[match_report_rows(self.df, query)]
         
-        lines = pasted_text.strip().split('\n')
-        parsed_data = []
+        titles = {title: column for column, title in REPORT_COLUMNS.items()}
+        column = titles.get(sort_title)
+        if column in self.df.columns:
+            positions = sort_report_positions(self.df, positions, column, ascending)
         
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-            
-            # Phân tích định dạng
-            if '\t' in line:
-                cells = line.split('\t')
-            elif '  ' in line:
-                cells = re.split(r'\s{2,}', line)
-            elif ',' in line and not line.count(',') < 3:
-                cells = line.split(',')
-            elif '|' in line:
-                cells = line.split('|')
-            else:
-                cells = [line]
-            
-            # Làm sạch dữ liệu
-            cleaned_cells = []
-            for cell in cells:
-                cell = cell.strip()
-                cell = cell.strip('"').strip("'")
-                cleaned_cells.append(cell)
-            
-            if cleaned_cells:
-                parsed_data.append(cleaned_cells)
+        self.positions = positions
+        self.page = 0
+        return self
+    
+    @property
+    def page_count(self):
+        return max(1, -(-len(self.positions) // self.page_size))
+    
+    def goto(self, page):
+        self.page = min(max(int(page), 0), self.page_count - 1)
+        return self
+    
+    def page_frame(self):
+        start = self.page * self.page_size
+        return to_display_frame(self.df.iloc[self.positions[start:start + self.page_size]])
+    
+    def page_label(self):
+        label = f"**Trang {self.page + 1}/{self.page_count}** · {len(self.positions):,} dòng"
+        if len(self.positions) != len(self.df):
+            label += f" (lọc từ {len(self.df):,})"
+        return label
+
+# ========== XUẤT BÁO CÁO ==========
+class ExportCache:
+    """File CSV/Excel đã xuất, khóa theo phiên bản dữ liệu các tháng liên quan.
+    
+    Dữ liệu không đổi thì lần tải sau trả lại ngay file cũ. Mỗi file nằm
+    trong thư mục con riêng để giữ tên file dễ đọc khi tải về; chỉ giữ
+    max_files file dùng gần nhất.
+    """
+    
+    def __init__(self, directory=None, max_files=None):
+        self.directory = directory or SYSTEM_CONFIG["export_dir"]
+        self.max_files = max_files or SYSTEM_CONFIG["export_cache_files"]
+        self._lock = threading.Lock()
+        self._building = {}     # path -> Lock, tránh hai lượt cùng tạo một file
+        self._stats = {"hits": 0, "misses": 0}
+    
+    def _path(self, filename, versions):
+        digest = hashlib.sha1(json.dumps([filename, versions]).encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.directory, digest, filename)
+    
+    def get(self, filename, versions, writer):
+        """Đường dẫn file đã xuất; gọi writer(path_tạm) nếu chưa có trong cache"""
+        path = self._path(filename, versions)
+        with self._lock:
+            building = self._building.setdefault(path, threading.Lock())
         
-        return parsed_data
+        try:
+            with building:
+                if os.path.exists(path):
+                    os.utime(os.path.dirname(path))
+                    with self._lock:
+                        self._stats["hits"] += 1
+                    return path
+                
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                try:
+                    writer(tmp_path)
+                    os.replace(tmp_path, path)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                with self._lock:
+                    self._stats["misses"] += 1
+        finally:
+            # Cả lượt hit và lượt writer lỗi: không để lại lock cho mỗi file đã xuất
+            with self._lock:
+                if self._building.get(path) is building:
+                    del self._building[path]
         
+        self._evict(keep=os.path.dirname(path))
+        return path
+    
+    def _evict(self, keep):
+        try:
+            entries = [os.path.join(self.directory, name) for name in os.listdir(self.directory)]
+            entries.sort(key=os.path.getmtime, reverse=True)
+            for entry in entries[self.max_files:]:
+                if entry != keep:
+                    shutil.rmtree(entry, ignore_errors=True)
+        except OSError as e:
+            print(f"⚠️ Lỗi dọn cache file xuất: {str(e)}")
+    
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+EXPORT_CACHE = ExportCache()
+
+def _export_chunks(parts, chunk_rows):
+    """(nhãn, DataFrame) -> các khối bảng hiển thị, mỗi lần chỉ một khối"""
+    for label, df in parts:
+        for start in range(0, len(df), chunk_rows):
+            yield label, to_display_frame(df.iloc[start:start + chunk_rows])
+
+def write_csv_export(path, parts, with_month=False, chunk_rows=None):
+    """Ghi CSV (UTF-8 có BOM để Excel đọc đúng tiếng Việt) theo từng khối"""
+    if chunk_rows is None:
+        chunk_rows = SYSTEM_CONFIG["export_chunk_rows"]
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        header = True
+        for label, chunk in _export_chunks(parts, chunk_rows):
+            if with_month:
+                chunk.insert(0, "Tháng", label)
+            chunk.to_csv(f, header=header, index=False)
+            header = False
+
+def write_excel_export(path, parts, chunk_rows=None):
+    """Ghi .xlsx bằng openpyxl write-only, mỗi tháng một sheet"""
+    if chunk_rows is None:
+        chunk_rows = SYSTEM_CONFIG["export_chunk_rows"]
+    workbook = openpyxl.Workbook(write_only=True)
+    sheets = {}
+    for label, chunk in _export_chunks(parts, chunk_rows):
+        worksheet = sheets.get(label)
+        if worksheet is None:
+            worksheet = sheets[label] = workbook.create_sheet(title=label)
+            worksheet.append(list(REPORT_COLUMNS.values()))
+        for row in chunk.itertuples(index=False, name=None):
+            worksheet.append(list(row))
+    if not sheets:
+        workbook.create_sheet(title="Trống")
+    workbook.save(path)
+
+def build_export(filename, fmt, parts):
+    """Xuất parts [(nhãn, DataFrame, phiên bản)] qua EXPORT_CACHE; trả về đường dẫn file"""
+    versions = [[label, version] for label, _, version in parts]
+    frames = [(label, df) for label, df, _ in parts]
+    if fmt == "xlsx":
+        writer = lambda path: write_excel_export(path, frames)
+    else:
+        writer = lambda path: write_csv_export(path, frames, with_month=len(frames) > 1)
+    return EXPORT_CACHE.get(f"{filename}.{fmt}", versions, writer)
+
+def _month_part(sheet_url, sheet_name, df=None):
+    """(sheet_name, DataFrame, phiên bản) từ MONTH_CACHE, tính phiên bản nếu chưa có"""
+    entry = MONTH_CACHE.versioned((sheet_url, sheet_name))
+    if entry is None:
+        if df is None:
+            return None
+        entry = (df, frame_version(df))
+    return (sheet_name,) + entry
+
+def export_month_file(month, fmt):
+    """Xuất một tháng ra file; trả về (đường dẫn hoặc None, thông báo)"""
+    if fmt == "xlsx" and not EXCEL_AVAILABLE:
+        return None, "❌ Chưa cài openpyxl để xuất Excel"
+    sheet_url = SYSTEM_CONFIG["default_sheet_url"]
+    sheet_name = SYSTEM_CONFIG["month_mapping"].get(month, "T1")
+    df = read_sheet_data(get_google_client(), sheet_name, sheet_url)
+    part = _month_part(sheet_url, sheet_name, df)
+    if part is None or part[1].empty:
+        error = SHEET_ERRORS.get((sheet_url, sheet_name))
+        return None, error or "📭 Chưa có dữ liệu để xuất"
+    path = build_export(f"BaoCao_{sheet_name}", fmt, [part])
+    return path, f"✅ Đã xuất {len(part[1])} dòng {sheet_name} ({fmt.upper()})"
+
+def export_year_file(fmt):
+    """Xuất cả năm (mỗi tháng một sheet với Excel, thêm cột Tháng với CSV)"""
+    if fmt == "xlsx" and not EXCEL_AVAILABLE:
+        return None, "❌ Chưa cài openpyxl để xuất Excel"
+    sheet_url = SYSTEM_CONFIG["default_sheet_url"]
+    names = list(SYSTEM_CONFIG["month_mapping"].values())
+    
+    # Tháng chưa có trong cache: nạp cả năm bằng một lượt batchGet, không ghép frame
+    if any(MONTH_CACHE.versioned((sheet_url, name)) is None for name in names):
+        client = get_google_client()
+        if client is not None:
+            try:
+                fetch_year_data(client, sheet_url, combine=False)
+            except Exception as e:
+                print(f"Lỗi đọc dữ liệu cả năm: {str(e)}")
+    
+    parts = [part for part in (_month_part(sheet_url, name) for name in names) if part is not None and not part[1].empty]
+    if not parts:
+        return None, "📭 Chưa có dữ liệu để xuất"
+    path = build_export("BaoCao_CaNam", fmt, parts)
+    return path, f"✅ Đã xuất {sum(len(part[1]) for part in parts)} dòng / {len(parts)} tháng ({fmt.upper()})"
+
+@instrumented
+async def export_report(month, fmt="csv"):
+    """Handler nút xuất báo cáo một tháng"""
+    try:
+        path, status = await SHEETS_GATEWAY.run(export_month_file, month, fmt)
     except Exception as e:
-        print(f"Lỗi phân tích dữ liệu: {str(e)}")
-        return []
+        path, status = None, f"❌ Lỗi xuất file: {str(e)}"
+    return gr.File(value=path, visible=path is not None), status
 
-def write_to_sheet(client, sheet_name, data, start_row=7, sheet_url=None):
-    """Ghi dữ liệu vào Google Sheets"""
+@instrumented
+async def export_year_report(fmt="xlsx"):
+    """Handler nút xuất báo cáo cả năm"""
     try:
-        if sheet_url is None:
-            sheet_url = SYSTEM_CONFIG["default_sheet_url"]
-        
-        spreadsheet = client.open_by_url(sheet_url)
-        worksheet = spreadsheet.worksheet(sheet_name)
-        
-        # Xóa vùng dữ liệu cũ
-        num_rows = len(data)
-        clear_range = f"A{start_row}:U{start_row + num_rows + 10}"
-        worksheet.batch_clear([clear_range])
-        
-        # Ghi dữ liệu mới
-        cell_list = worksheet.range(f"A{start_row}:{chr(65 + len(data[0]) - 1)}{start_row + num_rows - 1}")
-        
-        idx = 0
-        for i, row in enumerate(data):
-            for j, cell in enumerate(row):
-                if idx < len(cell_list):
-                    cell_list[idx].value = str(cell) if cell is not None else ""
-                    idx += 1
-        
-        worksheet.update_cells(cell_list)
-        return True
-        
+        path, status = await SHEETS_GATEWAY.run(export_year_file, fmt)
     except Exception as e:
-        print(f"Lỗi ghi dữ liệu: {str(e)}")
-        return False
+        path, status = None, f"❌ Lỗi xuất file: {str(e)}"
+    return gr.File(value=path, visible=path is not None), status
+
+# ========== TỔNG HỢP THEO THÁNG (DASHBOARD) ==========
+# Thứ tự cột A, B, C... trên sheet tháng (theo COLUMN_MAPPING)
+SHEET_COLUMNS = list(COLUMN_MAPPING.values())
+
+def rows_to_month_frame(rows):
+    """Các dòng ghi lên sheet (theo thứ tự cột A...) -> DataFrame có tên cột"""
+    if not rows:
+        return pd.DataFrame(columns=SHEET_COLUMNS)
+    df = pd.DataFrame(rows).iloc[:, :len(SHEET_COLUMNS)]
+    df.columns = SHEET_COLUMNS[:df.shape[1]]
+    return df
+
+def summarize_month_frame(df):
+    """Các tổng có thể cộng dồn của một khối dòng"""
+    if df.empty:
+        return {"count": 0, "late_count": 0, "slow_count": 0,
+                "weight_sum": 0.0, "duration_sum": 0.0, "duration_count": 0}
+    
+    late, slow, duration, weight = _kpi_columns(df)
+    known = duration.dropna()
+    return {
+        "count": len(df),
+        "late_count": int(late.sum()),
+        "slow_count": int(slow.sum()),
+        "weight_sum": float(weight.sum()),
+        "duration_sum": float(known.dt.total_seconds().sum()),
+        "duration_count": len(known)
+    }
+
+class MonthSummaryStore:
+    """Bảng tổng hợp từng tháng, khóa (sheet_url, sheet_name).
+    
+    Được cập nhật khi tải hoặc ghi dữ liệu, để Dashboard đọc trong O(1)
+    mà không gọi Google Sheets API.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._summaries = {}
+    
+    def replace(self, key, summary):
+        """Thay toàn bộ tổng hợp của tháng"""
+        with self._lock:
+            self._summaries[key] = dict(summary, updated_at=datetime.now())
+    
+    def add(self, key, delta):
+        """Cộng thêm tổng hợp của các dòng mới (ghi nối)"""
+        with self._lock:
+            current = self._summaries.get(key)
+            if current is None:
+                # Chưa biết phần đã có trên sheet: đợi lần tải sau
+                return
+            merged = {name: current[name] + delta[name] for name in delta}
+            self._summaries[key] = dict(merged, updated_at=datetime.now())
+    
+    def drop(self, key):
+        with self._lock:
+            self._summaries.pop(key, None)
+    
+    def get(self, key):
+        with self._lock:
+            summary = self._summaries.get(key)
+            return dict(summary) if summary is not None else None
+
+SUMMARY_STORE = MonthSummaryStore()
+
+def summary_kpis(summary):
+    """Tổng hợp tháng -> các chỉ số dùng cho Dashboard"""
+    count = summary["count"]
+    avg_seconds = summary["duration_sum"] / summary["duration_count"] if summary["duration_count"] else None
+    return {
+        "total_vehicles": count,
+        "late_count": summary["late_count"],
+        "late_rate": summary["late_count"] / count if count else 0.0,
+        "slow_count": summary["slow_count"],
+        "slow_rate": summary["slow_count"] / count if count else 0.0,
+        "avg_duration": pd.Timedelta(seconds=avg_seconds) if avg_seconds is not None else pd.NaT,
+        "total_weight": summary["weight_sum"]
+    }
 
 # ========== COMPONENTS GIAO DIỆN ==========
 def create_header():
@@ -312,44 +2930,70 @@ def create_sidebar():
     
     return sidebar, month_dropdown, btn_dashboard, btn_nhap_lieu, btn_bao_cao, btn_tong_hop, btn_quan_ly, btn_huong_dan
 
-def create_dashboard_tab():
+def render_metric_card(label, value, color, element_id):
+    """HTML một thẻ chỉ số trên Dashboard"""
+    return f"""
+                <div class="metric-card">
+                    <div style="font-size: 0.9rem; color: #6b7280;">{label}</div>
+                    <div style="font-size: 2rem; font-weight: 700; color: {color};" id="{element_id}">{value}</div>
+                </div>
+                """
+
+def render_dashboard_cards(month, kpis=None):
+    """4 thẻ chỉ số Dashboard; kpis=None hiển thị --"""
+    total, late, rate = "--", "--", "--%"
+    if kpis is not None:
+        total = str(kpis["total_vehicles"])
+        late = str(kpis["late_count"])
+        rate = f"{kpis['late_rate']:.0%}"
+    return [
+        render_metric_card("THÁNG HIỆN TẠI", month, "#3b82f6", "current-month"),
+        render_metric_card("TỔNG SỐ XE", total, "#10b981", "total-vehicles"),
+        render_metric_card("XE NHẬP TRỄ", late, "#ef4444", "late-vehicles"),
+        render_metric_card("TỶ LỆ TRỄ", rate, "#f59e0b", "late-percentage")
+    ]
+
+def load_dashboard_metrics(month, sheet_url=None):
+    """Các thẻ Dashboard từ bảng tổng hợp tháng (không gọi Google Sheets)"""
+    if sheet_url is None:
+        sheet_url = SYSTEM_CONFIG["default_sheet_url"]
+    sheet_name = SYSTEM_CONFIG["month_mapping"].get(month, "T1")
+    summary = SUMMARY_STORE.get((sheet_url, sheet_name))
+    if summary is None:
+        return render_dashboard_cards(month)
+    return render_dashboard_cards(month, summary_kpis(summary))
+
+@instrumented
+async def refresh_dashboard_metrics(month):
+    """Tải lại tháng từ Google Sheets rồi vẽ lại các thẻ Dashboard"""
+    try:
+        sheet_name = SYSTEM_CONFIG["month_mapping"].get(month, "T1")
+        await SHEETS_GATEWAY.read_month(sheet_name)
+        return load_dashboard_metrics(month)
+    
+    except Exception as e:
+        print(f"Lỗi tải Dashboard: {str(e)}")
+        return load_dashboard_metrics(month)
+
+def create_dashboard_tab(month_dropdown=None):
     """Tạo tab Dashboard"""
     with gr.Column() as tab:
         gr.Markdown("## 📊 DASHBOARD TỔNG QUAN")
         
         # Metrics cards
+        cards = render_dashboard_cards("Tháng 1")
         with gr.Row():
             with gr.Column():
-                metric1 = gr.HTML("""
-                <div class="metric-card">
-                    <div style="font-size: 0.9rem; color: #6b7280;">THÁNG HIỆN TẠI</div>
-                    <div style="font-size: 2rem; font-weight: 700; color: #3b82f6;" id="current-month">Tháng 1</div>
-                </div>
-                """)
+                metric1 = gr.HTML(cards[0])
             
             with gr.Column():
-                metric2 = gr.HTML("""
-                <div class="metric-card">
-                    <div style="font-size: 0.9rem; color: #6b7280;">TỔNG SỐ XE</div>
-                    <div style="font-size: 2rem; font-weight: 700; color: #10b981;" id="total-vehicles">--</div>
-                </div>
-                """)
+                metric2 = gr.HTML(cards[1])
             
             with gr.Column():
-                metric3 = gr.HTML("""
-                <div class="metric-card">
-                    <div style="font-size: 0.9rem; color: #6b7280;">XE NHẬP TRỄ</div>
-                    <div style="font-size: 2rem; font-weight: 700; color: #ef4444;" id="late-vehicles">--</div>
-                </div>
-                """)
+                metric3 = gr.HTML(cards[2])
             
             with gr.Column():
-                metric4 = gr.HTML("""
-                <div class="metric-card">
-                    <div style="font-size: 0.9rem; color: #6b7280;">TỶ LỆ TRỄ</div>
-                    <div style="font-size: 2rem; font-weight: 700; color: #f59e0b;" id="late-percentage">--%</div>
-                </div>
-                """)
+                metric4 = gr.HTML(cards[3])
         
         gr.Markdown("---")
         
@@ -361,6 +3005,22 @@ def create_dashboard_tab():
             quick_btn3 = gr.Button("🔄 Cập nhật dữ liệu", size="lg")
             quick_btn4 = gr.Button("📤 Xuất Excel", size="lg")
         
+        with gr.Row():
+            quick_export_file = gr.File(label="📄 File xuất", visible=False, interactive=False)
+            quick_export_status = gr.Markdown("")
+        
+        if month_dropdown is not None:
+            quick_btn4.click(
+                functools.partial(export_report, fmt="xlsx"),
+                inputs=[month_dropdown],
+                outputs=[quick_export_file, quick_export_status],
+                concurrency_limit=None
+            )
+            metrics = [metric1, metric2, metric3, metric4]
+            # Handler async: giới hạn đồng thời nằm ở SHEETS_GATEWAY, không ở hàng đợi Gradio
+            quick_btn3.click(refresh_dashboard_metrics, inputs=[month_dropdown], outputs=metrics, concurrency_limit=None)
+            month_dropdown.change(load_dashboard_metrics, inputs=[month_dropdown], outputs=metrics)
+        
         gr.Markdown("---")
         
         # Hướng dẫn nhanh
@@ -386,7 +3046,190 @@ def create_dashboard_tab():
     
     return tab
 
-def create_data_input_tab():
+@instrumented
+async def save_paste_data(text, month):
+    """Lưu dữ liệu dán vào sheet của tháng đang chọn (ghi lên Google Sheets ở nền)"""
+    try:
+        data = parse_excel_paste(text)
+        if not data:
+            return "❌ Chưa có dữ liệu để lưu"
+        
+        sheet_name = SYSTEM_CONFIG["month_mapping"].get(month, "T1")
+        # Chỉ chờ ghi nhật ký cục bộ, không chờ Google Sheets
+        await asyncio.to_thread(SAVE_QUEUE.submit, sheet_name, data)
+        return f"✅ Đã nhận {len(data)} dòng cho {sheet_name}, đang ghi lên Google Sheets"
+    
+    except Exception as e:
+        return f"❌ Lỗi: {str(e)}"
+
+def _upload_path(file):
+    """Đường dẫn file từ gr.File (chuỗi hoặc đối tượng có .name)"""
+    if file is None:
+        return None
+    return file if isinstance(file, str) else getattr(file, "name", None)
+
+@instrumented
+def preview_excel_upload(file, month=None):
+    """Preview khối đầu tiên của file Excel vừa chọn (không đọc hết file)"""
+    path = _upload_path(file)
+    if path is None:
+        return gr.Dataframe(visible=False), ""
+    if not EXCEL_AVAILABLE:
+        return gr.Dataframe(visible=False), "❌ Chưa cài openpyxl để đọc file Excel"
+    if not path.lower().endswith(".xlsx"):
+        return gr.Dataframe(visible=False), "❌ Chỉ hỗ trợ file .xlsx"
+    try:
+        sheet_name = SYSTEM_CONFIG["month_mapping"].get(month, "T1")
+        chunks = iter_excel_chunks(path, sheet_name)
+        first = next(chunks, [])
+        chunks.close()
+        if not first:
+            return gr.Dataframe(visible=False), "📭 Không tìm thấy dữ liệu trong file"
+        return gr.Dataframe(visible=True, value=excel_preview_frame(first)), f"👁️ Xem trước {min(len(first), 20)} dòng đầu"
+    except Exception as e:
+        return gr.Dataframe(visible=False), f"❌ Lỗi đọc file: {str(e)}"
+
+@instrumented
+async def upload_excel_data(file, month, progress=gr.Progress()):
+    """Đọc file Excel theo khối và ghi thẳng từng khối lên sheet tháng"""
+    path = _upload_path(file)
+    if path is None:
+        yield gr.update(), "❌ Chưa chọn file"
+        return
+    if not EXCEL_AVAILABLE:
+        yield gr.update(), "❌ Chưa cài openpyxl để đọc file Excel"
+        return
+    if not path.lower().endswith(".xlsx"):
+        yield gr.update(), "❌ Chỉ hỗ trợ file .xlsx"
+        return
+    
+    sheet_name = SYSTEM_CONFIG["month_mapping"].get(month, "T1")
+    chunks = iter_excel_chunks(path, sheet_name)
+    # Lượt đang đọc chunks trên thread Sheets; shield để task chỉ xong khi thread xong
+    pending = None
+    try:
+        pending = asyncio.ensure_future(SHEETS_GATEWAY.run(next, chunks, []))
+        first = await asyncio.shield(pending)
+        if not first:
+            yield gr.Dataframe(visible=False), "📭 Không tìm thấy dữ liệu trong file"
+            return
+        yield gr.Dataframe(visible=True, value=excel_preview_frame(first)), f"⏳ Đang ghi vào {sheet_name}..."
+        
+        written = [0]
+        def report(done, total):
+            written[0] = done
+            progress((done, total), desc=f"Đã ghi {done} dòng", unit="dòng")
+        
+        pending = asyncio.ensure_future(SHEETS_GATEWAY.write_chunks(
+            sheet_name, itertools.chain([first], chunks),
+            start_row=SYSTEM_CONFIG["data_start_row"],
+            progress=report
+        ))
+        ok = await asyncio.shield(pending)
+        if ok is None:
+            yield gr.update(), "❌ Không thể kết nối Google Sheets"
+        elif not ok:
+            error = SHEET_ERRORS.get((SYSTEM_CONFIG["default_sheet_url"], sheet_name))
+            yield gr.update(), error or f"❌ Lỗi khi lưu vào {sheet_name} (đã ghi {written[0]} dòng)"
+        else:
+            yield gr.update(), f"✅ Đã tải {written[0]} dòng từ file lên {sheet_name}"
+    
+    except Exception as e:
+        yield gr.update(), f"❌ Lỗi: {str(e)}"
+    finally:
+        # Bị hủy giữa chừng thì thread có thể vẫn đang chạy next(chunks): đóng
+        # generator (và workbook) trên thread Sheets sau khi lượt đó xong
+        SHEETS_GATEWAY.close_after(pending, chunks)
+
+MANUAL_DISPLAY_HEADERS = ['#', 'Ngày', 'Số xe', 'Nguyên liệu', 'Vào', 'Ra', 'TG', 'SL', 'Kg', 'Nguyên nhân', 'Chi tiết']
+
+class ManualEntryBuffer:
+    """Các dòng nhập thủ công của một phiên, chưa lưu.
+    
+    Dòng (theo thứ tự cột A:K của sheet) được nối vào list, không dựng lại
+    DataFrame mỗi lần thêm. Bảng hiển thị chỉ gồm vài dòng cuối nên mỗi lần
+    cập nhật gửi lượng dữ liệu cố định dù phiên đã nhập hàng trăm dòng.
+    """
+    
+    def __init__(self):
+        self.rows = []
+        self.total_quantity = 0.0
+    
+    def add(self, row):
+        self.rows.append(row)
+        self.total_quantity += float(row[6] or 0)
+    
+    def tail(self, limit=None):
+        """limit dòng cuối (kèm số thứ tự) để hiển thị"""
+        if limit is None:
+            limit = SYSTEM_CONFIG["manual_display_rows"]
+        start = max(0, len(self.rows) - limit)
+        return pd.DataFrame(
+            [[number] + row[:7] + row[8:] for number, row in enumerate(self.rows[start:], start=start + 1)],
+            columns=MANUAL_DISPLAY_HEADERS
+        )
+    
+    def label(self):
+        shown = min(len(self.rows), SYSTEM_CONFIG["manual_display_rows"])
+        return f"📋 DANH SÁCH ĐÃ NHẬP ({len(self.rows)} dòng, hiển thị {shown} dòng cuối)"
+
+def _manual_clock(value, name):
+    try:
+        return datetime.strptime(str(value).strip(), "%H:%M:%S")
+    except ValueError:
+        raise ValueError(f"{name} phải có dạng HH:MM:SS")
+
+def manual_entry_row(entry_date, vehicle, material, time_in, time_out, total_time,
+                     quantity, net_weight, reason, detail):
+    """Dòng sheet (cột A:K) từ các ô nhập thủ công; ValueError nếu thiếu/sai"""
+    if not str(vehicle or "").strip():
+        raise ValueError("Chưa nhập số xe")
+    try:
+        entry_date = datetime.strptime(str(entry_date).strip(), "%Y-%m-%d").strftime("%Y-%m-%d")
+    except ValueError:
+        raise ValueError("Ngày nhập phải có dạng YYYY-MM-DD")
+    arrived = _manual_clock(time_in, "Xe cân vào")
+    left = _manual_clock(time_out, "Xe cân ra")
+    if str(total_time or "").strip():
+        total_time = _manual_clock(total_time, "Tổng thời gian").strftime("%H:%M:%S")
+    else:
+        # Xe ra sau nửa đêm: cộng thêm một ngày
+        seconds = int((left - arrived).total_seconds()) % 86400
+        total_time = f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+    
+    return [
+        entry_date, str(vehicle).strip(), str(material or "").strip(),
+        arrived.strftime("%H:%M:%S"), left.strftime("%H:%M:%S"), total_time,
+        str(float(quantity or 0)), '', str(float(net_weight or 0)),
+        str(reason or "").strip(), str(detail or "").strip()
+    ]
+
+@instrumented
+def add_manual_entry(buffer, *fields):
+    """Thêm một dòng vào danh sách của phiên, chỉ gửi lại phần cuối bảng"""
+    if buffer is None:
+        buffer = ManualEntryBuffer()
+    try:
+        buffer.add(manual_entry_row(*fields))
+    except ValueError as e:
+        return gr.update(), f"❌ {str(e)}", buffer
+    status = f"➕ Đã thêm dòng {len(buffer.rows)} · Tổng SL: {buffer.total_quantity:,.1f}"
+    return gr.Dataframe(visible=True, value=buffer.tail(), label=buffer.label()), status, buffer
+
+@instrumented
+async def save_manual_entries(buffer, month):
+    """Nối cả danh sách vào sheet tháng trong một lượt lưu (ghi nền)"""
+    if buffer is None or not buffer.rows:
+        return gr.update(), "❌ Danh sách trống", buffer
+    try:
+        sheet_name = SYSTEM_CONFIG["month_mapping"].get(month, "T1")
+        await asyncio.to_thread(SAVE_QUEUE.submit, sheet_name, buffer.rows, op="append")
+        status = f"✅ Đã nhận {len(buffer.rows)} dòng cho {sheet_name}, đang ghi lên Google Sheets"
+        return gr.Dataframe(visible=False, value=None), status, ManualEntryBuffer()
+    except Exception as e:
+        return gr.update(), f"❌ Lỗi: {str(e)}", buffer
+
+def create_data_input_tab(month_dropdown=None):
     """Tạo tab Nhập dữ liệu"""
     with gr.Column() as tab:
         gr.Markdown("## 📥 NHẬP DỮ LIỆU THÔNG MINH")
@@ -428,8 +3271,8 @@ def create_data_input_tab():
                 gr.Markdown("### 📤 TẢI FILE EXCEL LÊN")
                 
                 file_upload = gr.File(
-                    label="Chọn file Excel (.xlsx, .xls)",
-                    file_types=[".xlsx", ".xls"],
+                    label="Chọn file Excel (.xlsx)",
+                    file_types=[".xlsx"],
                     file_count="single"
                 )
                 
@@ -460,30 +3303,125 @@ def create_data_input_tab():
                 manual_add_btn = gr.Button("➕ THÊM VÀO DANH SÁCH", size="lg")
                 manual_list = gr.Dataframe(
                     label="📋 DANH SÁCH ĐÃ NHẬP",
-                    headers=['Ngày', 'Số xe', 'Nguyên liệu', 'Vào', 'Ra', 'TG', 'SL', 'Kg', 'Nguyên nhân', 'Chi tiết'],
+                    headers=MANUAL_DISPLAY_HEADERS,
+                    interactive=False,
                     visible=False
                 )
                 manual_save_btn = gr.Button("💾 LƯU TẤT CẢ", variant="primary", size="lg")
                 manual_status = gr.Markdown("")
         
+        # Kết quả phân tích của phiên, chỉ phân tích lại các dòng thay đổi
+        paste_state = gr.State(None)
+        # Các dòng nhập thủ công chưa lưu của phiên
+        manual_state = gr.State(None)
+        
         # Xử lý sự kiện
-        def on_paste_change(text):
-            data = parse_excel_paste(text)
-            if data:
-                df = pd.DataFrame(data[:20])  # Hiển thị 20 dòng đầu
-                stats = f"**Số dòng:** {len(data)}"
-                return gr.Dataframe(visible=True, value=df), stats, f"**Số cột:** {len(data[0]) if data else 0}"
+        @instrumented
+        async def on_paste_change(text, state):
+            # Debounce: các lần gõ liên tiếp gộp lại (trigger_mode="always_last")
+            await asyncio.sleep(SYSTEM_CONFIG["paste_debounce"])
+            if state is None:
+                state = PastePreviewState()
+            try:
+                state.update(text)
+            except Exception as e:
+                print(f"Lỗi phân tích dữ liệu: {str(e)}")
+                state = PastePreviewState()
+            if state.row_count:
+                df = state.preview(20)  # Hiển thị 20 dòng đầu
+                return (gr.Dataframe(visible=True, value=df), f"**Số dòng:** {state.row_count}",
+                        f"**Số cột:** {state.width}", f"**Tổng SL:** {state.total_quantity:,.1f}", state)
             else:
-                return gr.Dataframe(visible=False), "**Số dòng:** 0", "**Số cột:** 0"
+                return gr.Dataframe(visible=False), "**Số dòng:** 0", "**Số cột:** 0", "**Tổng SL:** N/A", state
         
         paste_area.change(
             on_paste_change,
-            inputs=[paste_area],
-            outputs=[preview_table, stats1, stats2]
+            inputs=[paste_area, paste_state],
+            outputs=[preview_table, stats1, stats2, stats3, paste_state],
+            trigger_mode="always_last",
+            show_progress="hidden",
+            concurrency_limit=None
+        )
+        
+        if month_dropdown is not None:
+            save_btn.click(
+                save_paste_data,
+                inputs=[paste_area, month_dropdown],
+                outputs=[save_status],
+                concurrency_limit=None
+            )
+            file_upload.change(
+                preview_excel_upload,
+                inputs=[file_upload, month_dropdown],
+                outputs=[upload_preview, upload_status]
+            )
+            upload_btn.click(
+                upload_excel_data,
+                inputs=[file_upload, month_dropdown],
+                outputs=[upload_preview, upload_status],
+                concurrency_limit=None
+            )
+            manual_save_btn.click(
+                save_manual_entries,
+                inputs=[manual_state, month_dropdown],
+                outputs=[manual_list, manual_status, manual_state],
+                concurrency_limit=None
+            )
+        
+        manual_add_btn.click(
+            add_manual_entry,
+            inputs=[manual_state, entry_date, vehicle_number, material_name, time_in, time_out,
+                    total_time, quantity, net_weight, reason, detail_reason],
+            outputs=[manual_list, manual_status, manual_state],
+            show_progress="hidden"
         )
     
     return tab
 
+@instrumented
+async def load_report_data(month, sort_title=None, sort_order="Tăng dần", query=""):
+    """Tải dữ liệu báo cáo; bảng chỉ nhận trang đầu của ReportView"""
+    empty_stats = ["--"] * 5
+    empty_page = "**Trang 1/1** · 0 dòng"
+    try:
+        # Không có kết nối vẫn đọc được từ cache/snapshot
+        sheet_name = SYSTEM_CONFIG["month_mapping"].get(month, "T1")
+        df = await SHEETS_GATEWAY.read_month(sheet_name)
+        
+        if df.empty:
+            # Phân biệt tháng trống thật với lỗi quota/kết nối (đã ghi khi đọc trên thread Sheets)
+            error = SHEET_ERRORS.get((SYSTEM_CONFIG["default_sheet_url"], sheet_name))
+            return pd.DataFrame(), error or "📭 Chưa có dữ liệu", *empty_stats, None, empty_page
+        
+        # Tính toán thống kê (trên cả tháng, không theo bộ lọc)
+        stats = format_report_stats(compute_kpis(df))
+        
+        view = ReportView(df).apply(sort_title, sort_order != "Giảm dần", query)
+        status = "✅ Đã tải dữ liệu"
+        pending = SAVE_QUEUE.pending((SYSTEM_CONFIG["default_sheet_url"], sheet_name))
+        if pending:
+            status += f" · ⏳ {pending} lượt lưu đang chờ ghi lên Google Sheets"
+        return view.page_frame(), status, *stats, view, view.page_label()
+        
+    except Exception as e:
+        return pd.DataFrame(), f"❌ Lỗi: {str(e)}", *empty_stats, None, empty_page
+
+@instrumented
+def update_report_view(view, sort_title, sort_order, query):
+    """Lọc/sắp xếp lại bảng đã tải, về trang đầu"""
+    if view is None:
+        return gr.update(), view, gr.update()
+    view.apply(sort_title, sort_order != "Giảm dần", query)
+    return view.page_frame(), view, view.page_label()
+
+@instrumented
+def change_report_page(view, step):
+    """Sang trang trước (step=-1) hoặc sau (step=1)"""
+    if view is None:
+        return gr.update(), view, gr.update()
+    view.goto(view.page + step)
+    return view.page_frame(), view, view.page_label()
+
 def create_report_tab():
     """Tạo tab Báo cáo"""
     with gr.Column() as tab:
@@ -500,7 +3438,17 @@ def create_report_tab():
             export_csv = gr.Button("📥 Tải CSV")
             export_excel = gr.Button("📥 Tải Excel")
         
-        # Data table
+        # Lọc / sắp xếp ở server
+        with gr.Row():
+            report_query = gr.Textbox(label="🔎 Lọc (số xe, nguyên liệu, nguyên nhân...)", scale=3)
+            report_sort = gr.Dropdown(
+                choices=list(REPORT_COLUMNS.values()),
+                value=None,
+                label="Sắp xếp theo"
+            )
+            report_order = gr.Radio(["Tăng dần", "Giảm dần"], value="Tăng dần", label="Thứ tự")
+        
+        # Data table: chỉ chứa trang đang xem
         report_table = gr.Dataframe(
             label="DỮ LIỆU CHI TIẾT",
             headers=['Ngày', 'Số xe', 'Nguyên liệu', 'Vào', 'Ra', 'TG', 'SL', 'Kg', 'Nguyên nhân', 'Chi tiết'],
@@ -508,11 +3456,21 @@ def create_report_tab():
             height=500
         )
         
+        report_view = gr.State(None)
+        with gr.Row():
+            prev_page_btn = gr.Button("◀ Trang trước", size="sm")
+            page_label = gr.Markdown("**Trang 1/1** · 0 dòng")
+            next_page_btn = gr.Button("Trang sau ▶", size="sm")
+        
+        report_status = gr.Markdown("**Trạng thái:** Chờ tải dữ liệu")
+        export_file = gr.File(label="📄 File xuất", visible=False, interactive=False)
+        
         # Statistics
         gr.Markdown("### 📈 THỐNG KÊ")
         with gr.Row():
             stat1 = gr.Markdown("**Tổng số xe:** --")
             stat2 = gr.Markdown("**Xe nhập trễ (>17h):** --")
+            stat5 = gr.Markdown("**Xe nhập chậm (>2h):** --")
             stat3 = gr.Markdown("**Tổng khối lượng:** -- kg")
             stat4 = gr.Markdown("**TG trung bình/xe:** --")
         
@@ -523,12 +3481,150 @@ def create_report_tab():
             
             with gr.TabItem("📋 Bảng số liệu"):
                 reason_table = gr.Dataframe(label="Thống kê nguyên nhân")
+        
+        refresh_btn.click(
+            load_report_data,
+            inputs=[report_month, report_sort, report_order, report_query],
+            outputs=[report_table, report_status, stat1, stat2, stat5, stat3, stat4, report_view, page_label],
+            concurrency_limit=None
+        )
+        
+        view_outputs = [report_table, report_view, page_label]
+        for control in (report_sort, report_order):
+            control.change(update_report_view, inputs=[report_view, report_sort, report_order, report_query], outputs=view_outputs)
+        report_query.submit(update_report_view, inputs=[report_view, report_sort, report_order, report_query], outputs=view_outputs)
+        for button, fmt in ((export_csv, "csv"), (export_excel, "xlsx")):
+            button.click(
+                functools.partial(export_report, fmt=fmt),
+                inputs=[report_month],
+                outputs=[export_file, report_status],
+                concurrency_limit=None
+            )
+        prev_page_btn.click(lambda view: change_report_page(view, -1), inputs=[report_view], outputs=view_outputs)
+        next_page_btn.click(lambda view: change_report_page(view, 1), inputs=[report_view], outputs=view_outputs)
+    
+    return tab
+
+def summarize_year_data(df):
+    """Bảng tổng hợp theo tháng từ DataFrame cả năm"""
+    months = list(SYSTEM_CONFIG["month_mapping"].keys())
+    if df.empty or 'month' not in df.columns:
+        return pd.DataFrame(columns=['Tháng', 'Số xe', 'Tổng khối lượng (kg)'])
+    
+    weights = pd.to_numeric(df['net_weight'], errors='coerce') if 'net_weight' in df.columns else pd.Series(0.0, index=df.index)
+    grouped = weights.groupby(df['month'], observed=False).agg(['size', 'sum'])
+    grouped = grouped.reindex([m for m in months if m in grouped.index])
+    
+    return pd.DataFrame({
+        'Tháng': grouped.index,
+        'Số xe': grouped['size'].astype(int).values,
+        'Tổng khối lượng (kg)': grouped['sum'].round(0).values
+    })
+
+def summarize_sources(df, labels):
+    """Bảng tổng hợp theo tháng của từng spreadsheet, nối theo thứ tự labels"""
+    columns = ['Nguồn', 'Tháng', 'Số xe', 'Tổng khối lượng (kg)']
+    if df.empty or 'source' not in df.columns:
+        return pd.DataFrame(columns=columns)
+    groups = dict(tuple(df.groupby('source', observed=True)))
+    parts = [summarize_year_data(groups[label]).assign(**{'Nguồn': label}) for label in labels if label in groups]
+    if not parts:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(parts, ignore_index=True)[columns]
+
+def create_summary_tab():
+    """Tạo tab Tổng hợp 12 tháng"""
+    with gr.Column() as tab:
+        gr.Markdown("## 📈 TỔNG HỢP 12 THÁNG")
+        
+        with gr.Row():
+            load_year_btn = gr.Button("🔄 Tải tổng hợp", variant="primary")
+            export_year_btn = gr.Button("📤 Xuất Excel cả năm")
+        
+        year_status = gr.Markdown("**Trạng thái:** Chờ tải dữ liệu")
+        year_export_file = gr.File(label="📄 File xuất", visible=False, interactive=False)
+        year_table = gr.Dataframe(
+            label="TỔNG HỢP THEO THÁNG",
+            headers=['Tháng', 'Số xe', 'Tổng khối lượng (kg)'],
+            interactive=False
+        )
+        
+        @instrumented
+        async def load_year_summary():
+            """Tải dữ liệu 12 tháng trong một lượt batchGet"""
+            try:
+                started = time.perf_counter()
+                df = await SHEETS_GATEWAY.read_year()
+                if df is None:
+                    return summarize_year_data(pd.DataFrame()), "❌ Không thể kết nối Google Sheets"
+                if df.empty:
+                    return summarize_year_data(df), "📭 Chưa có dữ liệu"
+                
+                elapsed = time.perf_counter() - started
+                return summarize_year_data(df), f"✅ Đã tải {len(df)} dòng / {df['month'].nunique()} tháng ({elapsed:.1f}s)"
+            
+            except Exception as e:
+                return summarize_year_data(pd.DataFrame()), f"❌ Lỗi: {str(e)}"
+        
+        with gr.Accordion("🗂️ So sánh nhiều năm / kho", open=False):
+            source_labels = SHEET_REGISTRY.labels()
+            source_select = gr.CheckboxGroup(choices=source_labels, value=source_labels, label="Spreadsheet")
+            compare_btn = gr.Button("🔄 So sánh")
+            compare_status = gr.Markdown("")
+            compare_table = gr.Dataframe(
+                label="TỔNG HỢP THEO SPREADSHEET",
+                headers=['Nguồn', 'Tháng', 'Số xe', 'Tổng khối lượng (kg)'],
+                interactive=False
+            )
+        
+        @instrumented
+        async def load_source_comparison(labels):
+            """Đọc song song các spreadsheet đã chọn; spreadsheet lỗi không chặn phần còn lại"""
+            empty = summarize_sources(pd.DataFrame(), [])
+            if not labels:
+                return empty, "❌ Chưa chọn spreadsheet"
+            try:
+                started = time.perf_counter()
+                result = await SHEETS_GATEWAY.read_sources(labels)
+                if result is None:
+                    return empty, "❌ Không thể kết nối Google Sheets"
+                df, failures = result
+                
+                elapsed = time.perf_counter() - started
+                loaded = len(labels) - len(failures)
+                status = f"✅ Đã tải {len(df)} dòng từ {loaded}/{len(labels)} spreadsheet ({elapsed:.1f}s)"
+                if failures:
+                    status += "\n\n" + "\n".join(f"- ⚠️ **{label}:** {error}" for label, error in failures.items())
+                return summarize_sources(df, list(labels)), status
+            
+            except Exception as e:
+                return empty, f"❌ Lỗi: {str(e)}"
+        
+        load_year_btn.click(
+            load_year_summary,
+            outputs=[year_table, year_status],
+            concurrency_limit=None
+        )
+        compare_btn.click(
+            load_source_comparison,
+            inputs=[source_select],
+            outputs=[compare_table, compare_status],
+            concurrency_limit=None
+        )
+        export_year_btn.click(
+            functools.partial(export_year_report, fmt="xlsx"),
+            outputs=[year_export_file, year_status],
+            concurrency_limit=None
+        )
     
     return tab
 
 # ========== TẠO ỨNG DỤNG CHÍNH ==========
 def create_app():
     """Tạo ứng dụng Gradio chính"""
+    # Ghi tiếp các lượt lưu còn trong nhật ký từ lần chạy trước
+    SAVE_QUEUE.start()
+    
     with gr.Blocks(
         title=SYSTEM_CONFIG["app_name"],
         theme=gr.themes.Soft(),
@@ -551,11 +3647,11 @@ def create_app():
                 with gr.Tabs() as tabs:
                     # Tab 1: Dashboard
                     with gr.TabItem("📊 Dashboard", id=0):
-                        dashboard_tab = create_dashboard_tab()
+                        dashboard_tab = create_dashboard_tab(month_dropdown)
                     
                     # Tab 2: Nhập dữ liệu
                     with gr.TabItem("📥 Nhập dữ liệu", id=1):
-                        input_tab = create_data_input_tab()
+                        input_tab = create_data_input_tab(month_dropdown)
                     
                     # Tab 3: Xem báo cáo
                     with gr.TabItem("📈 Xem báo cáo", id=2):
@@ -563,8 +3659,7 @@ def create_app():
                     
                     # Tab 4: Tổng hợp
                     with gr.TabItem("📋 Tổng hợp 12 tháng", id=3):
-                        gr.Markdown("## 📈 TỔNG HỢP 12 THÁNG")
-                        gr.Markdown("Chức năng đang được phát triển...")
+                        summary_tab = create_summary_tab()
                     
                     # Tab 5: Quản lý lý do
                     with gr.TabItem("⚙️ Quản lý lý do", id=4):
@@ -618,59 +3713,23 @@ def create_app():
             outputs=[tabs]
         )
         
-        # ========== XỬ LÝ DỮ LIỆU THỰC ==========
-        def load_report_data(month):
-            """Tải dữ liệu báo cáo"""
-            try:
-                client = get_google_client()
-                if client is None:
-                    return pd.DataFrame(), "❌ Không thể kết nối Google Sheets", "--", "--", "--", "--"
-                
-                sheet_name = SYSTEM_CONFIG["month_mapping"].get(month, "T1")
-                df = read_sheet_data(client, sheet_name)
-                
-                if df.empty:
-                    return pd.DataFrame(), "📭 Chưa có dữ liệu", "--", "--", "--", "--"
-                
-                # Tính toán thống kê
-                total_vehicles = len(df)
-                
-                # Đếm xe nhập trễ (giả sử cột 'xe_can_ra' có thời gian)
-                late_count = 0
-                if 'xe_can_ra' in df.columns:
-                    try:
-                        # Logic đếm xe sau 17h
-                        pass
-                    except:
-                        pass
-                
-                # Tổng khối lượng
-                total_weight = 0
-                if 'net_weight' in df.columns:
-                    try:
-                        total_weight = pd.to_numeric(df['net_weight'], errors='coerce').sum()
-                    except:
-                        pass
-                
-                stats = [
-                    f"**Tổng số xe:** {total_vehicles}",
-                    f"**Xe nhập trễ (>17h):** {late_count}",
-                    f"**Tổng khối lượng:** {total_weight:,.0f} kg",
-                    f"**TG trung bình/xe:** Đang tính..."
-                ]
-                
-                return df, "✅ Đã tải dữ liệu", *stats
-                
-            except Exception as e:
-                return pd.DataFrame(), f"❌ Lỗi: {str(e)}", "--", "--", "--", "--"
-        
-        # Kết nối nút refresh trong tab báo cáo
-        refresh_btn = None  # Cần tìm component thực tế
-        
     return app
 
+def create_server(blocks=None):
+    """FastAPI phục vụ giao diện Gradio ở "/" và chỉ số Prometheus ở "/metrics" """
+    server = FastAPI()
+    
+    @server.get("/metrics")
+    def metrics():
+        return Response(METRICS.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+    
+    return gr.mount_gradio_app(server, blocks if blocks is not None else create_app(), path="/")
+
 # ========== CHẠY ỨNG DỤNG ==========
 if __name__ == "__main__":
+    # fake_sheets.py / benchmark.py "import app": dùng chính module đang chạy, không nạp lại
+    sys.modules.setdefault("app", sys.modules["__main__"])
+    
     # Kiểm tra môi trường
     print("=" * 50)
     print(f"🚀 KHỞI ĐỘNG {SYSTEM_CONFIG['app_name']}")
@@ -679,12 +3738,5 @@ if __name__ == "__main__":
     print(f"📦 Pandas: {pd.__version__}")
     print("=" * 50)
     
-    # Tạo và chạy app
-    app = create_app()
-    app.launch(
-        server_name="0.0.0.0",
-        server_port=7860,
-        share=False,
-        debug=True,
-        favicon_path=None
-    )
+    # Tạo và chạy app (kèm /metrics)
+    uvicorn.run(create_server(), host="0.0.0.0", port=7860)
@@ -0,0 +1,255 @@
+# benchmark.py - Đo các đường xử lý dữ liệu chính của app.py
+# Chạy: python benchmark.py [--sizes 100,10000,1000000] [--only paste] [--output ket_qua.json]
+# Kết quả là JSON để so sánh trước/sau khi tối ưu trên cùng một máy.
+
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+import app
+
+# ========== DỮ LIỆU CÂN XE GIẢ LẬP ==========
+MATERIALS = ['Thức ăn Bổ Sung', 'Ngô hạt', 'Khô đậu nành', 'Cám gạo', 'Bột cá', 'Lúa mì', 'Premix', 'Dầu cá']
+REASONS = ['Đúng giờ', 'Xếp hàng đợi', 'Kẹt xe', 'Thời tiết', 'Chờ chứng từ', 'Hỏng xe', 'Lý do khác']
+DETAILS = ['', '', '', 'Chờ QC lấy mẫu', 'Cân lại lần 2', 'Thiếu hóa đơn']
+PROVINCES = ['86C', '86H', '51D', '61C', '72C', '50H']
+
+# Các dòng tiêu đề phía trên dữ liệu, giống file mẫu (tiêu đề ở dòng 6)
+TITLE_ROWS = [
+    ['BÁO CÁO THỜI GIAN NHẬP HÀNG'],
+    [''],
+    ['Kho nguyên liệu'],
+    [''],
+    [''],
+]
+
+def _clock(seconds):
+    seconds = int(seconds) % 86400
+    return f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+def generate_weighbridge_rows(count, seed=0, year=2025, month=1):
+    """count dòng phiếu cân (21 cột A:U, dạng chuỗi như Google Sheets trả về).
+
+    Cùng seed luôn cho cùng dữ liệu. Biển số, giờ vào/ra, thời gian,
+    khối lượng và nguyên nhân được sinh theo phân bố gần với thực tế:
+    phần lớn xe vào giờ hành chính, một phần vào sau 17h hoặc nằm quá 2h.
+    """
+    rng = random.Random(seed)
+    plates = [f"{rng.choice(PROVINCES)}{rng.randrange(10000, 99999):05d} L{rng.randrange(1, 4)}" for _ in range(2000)]
+    days = (date(year, month % 12 + 1, 1) if month < 12 else date(year + 1, 1, 1)) - date(year, month, 1)
+    dates = [(date(year, month, 1) + timedelta(days=d)).isoformat() for d in range(days.days)]
+    padding = [''] * (app.SHEET_WIDTH - 11)
+
+    rows = []
+    for _ in range(count):
+        arrival = rng.gauss(11 * 3600, 3 * 3600)
+        arrival = min(max(arrival, 5 * 3600), 22 * 3600)
+        duration = rng.expovariate(1 / 2400) + 300
+        quantity = rng.choice([4.0, 4.5, 5.0, 5.5, 6.0, 8.0, 10.0])
+        rows.append([
+            rng.choice(dates),
+            rng.choice(plates),
+            rng.choice(MATERIALS),
+            _clock(arrival),
+            _clock(arrival + duration),
+            _clock(duration),
+            f"{quantity}",
+            str(rng.randrange(0, 200)) if rng.random() < 0.3 else '',
+            f"{round(quantity * rng.uniform(780, 820), 1)}",
+            rng.choice(REASONS),
+            rng.choice(DETAILS),
+        ] + padding)
+    return rows
+
+def sheet_values(rows):
+    """Giá trị cả sheet tháng: các dòng tiêu đề, dòng "Ngày/tháng" rồi dữ liệu"""
+    header = list(app.COLUMN_MAPPING) + [''] * (app.SHEET_WIDTH - len(app.COLUMN_MAPPING))
+    return TITLE_ROWS + [header] + rows
+
+def paste_text(rows, sep):
+    """Khối văn bản như khi copy từ Excel, với dấu phân cách sep"""
+    return '\n'.join(sep.join(row[:11]) for row in rows)
+
+class BenchWorksheet:
+    """Worksheet trong bộ nhớ, đủ cho find_header_row / iter_sheet_pages"""
+
+    def __init__(self, title, values):
+        self.id = 0
+        self.title = title
+        # API bỏ ô trống cuối dòng: cắt sẵn một lần để không tính vào thời gian đo
+        self.values = [row[:max((i + 1 for i, cell in enumerate(row) if cell != ''), default=0)] for row in values]
+        self.column_a = [row[:1] for row in self.values]
+        self.row_count = len(values) + 100
+        self.col_count = app.SHEET_WIDTH
+
+    def get(self, range_name):
+        # "A1:A500" hoặc "A7:U506"
+        start, end = range_name.split(':')
+        first = int(start.lstrip('ABCDEFGHIJKLMNOPQRSTUVWXYZ'))
+        last = int(end.lstrip('ABCDEFGHIJKLMNOPQRSTUVWXYZ'))
+        source = self.column_a if end.startswith(app.SHEET_FIRST_COLUMN) else self.values
+        page = source[first - 1:last]
+        # ... và dòng trống cuối vùng
+        while page and not page[-1]:
+            page = page[:-1]
+        return page
+
+class BenchSpreadsheet:
+    def __init__(self, worksheets):
+        self._worksheets = {ws.title: ws for ws in worksheets}
+
+    def worksheet(self, title):
+        return self._worksheets[title]
+
+    def worksheets(self):
+        return list(self._worksheets.values())
+
+class BenchClient:
+    def __init__(self, spreadsheet):
+        self._spreadsheet = spreadsheet
+
+    def open_by_url(self, url):
+        return self._spreadsheet
+
+# ========== ĐO THỜI GIAN ==========
+def _repeats(rows):
+    """Số lần lặp theo cỡ dữ liệu, để mỗi phép đo mất cỡ vài giây"""
+    if rows <= 1000:
+        return 50
+    if rows <= 100000:
+        return 5
+    return 1
+
+def measure(name, rows, fn, setup=None, repeat=None):
+    """Chạy fn() repeat lần (setup() trước mỗi lần, không tính giờ)"""
+    repeat = repeat or _repeats(rows)
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+
+    best = min(times)
+    return {
+        "name": name,
+        "rows": rows,
+        "repeat": repeat,
+        "min_s": best,
+        "median_s": statistics.median(times),
+        "mean_s": statistics.fmean(times),
+        "rows_per_s": rows / best if best > 0 else None,
+    }
+
+def bench_paste(rows):
+    count = len(rows)
+    for label, sep in (("tab", "\t"), ("double_space", "  "), ("comma", ","), ("pipe", "|")):
+        text = paste_text(rows, sep)
+        yield measure(f"parse_excel_paste[{label}]", count, lambda: app.parse_excel_paste(text))
+
+def bench_read(rows):
+    count = len(rows)
+    values = sheet_values(rows)
+    client = BenchClient(BenchSpreadsheet([BenchWorksheet("T1", values)]))
+    url = "bench://sheet"
+
+    def cold():
+        # Bỏ vị trí tiêu đề đã nhớ để đo cả bước dò tiêu đề
+        with app._HEADER_ROW_LOCK:
+            app._HEADER_ROW_CACHE.pop((url, "T1"), None)
+
+    yield measure("find_header_row", count, lambda: app.find_header_row(client.open_by_url(url).worksheet("T1")))
+    yield measure("fetch_sheet_data[cold_header]", count, lambda: app.fetch_sheet_data(client, "T1", url), setup=cold)
+    yield measure("fetch_sheet_data[cached_header]", count, lambda: app.fetch_sheet_data(client, "T1", url))
+    yield measure("parse_month_values", count, lambda: app.parse_month_values(values))
+
+def bench_write(rows):
+    count = len(rows)
+    data = [row[:11] for row in rows]
+    yield measure("build_write_batches", count, lambda: app.build_write_batches("T1", data, app.SYSTEM_CONFIG["data_start_row"]))
+
+def bench_kpis(rows):
+    count = len(rows)
+    header = list(app.COLUMN_MAPPING)
+    raw = app._combine_frames([pd.DataFrame([row[:11] for row in rows], columns=header)])
+    typed, _ = app.apply_schema(raw)
+
+    yield measure("apply_schema", count, lambda: app.apply_schema(raw))
+    yield measure("compute_kpis", count, lambda: app.compute_kpis(typed))
+    yield measure("summarize_month_frame", count, lambda: app.summarize_month_frame(typed))
+    yield measure("to_display_frame", count, lambda: app.to_display_frame(typed))
+
+SUITES = {
+    "paste": bench_paste,
+    "read": bench_read,
+    "write": bench_write,
+    "kpi": bench_kpis,
+}
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def run(sizes, only=None, seed=0):
+    results = []
+    for size in sizes:
+        rows = generate_weighbridge_rows(size, seed=seed)
+        for name, suite in SUITES.items():
+            if only and not any(part in name for part in only):
+                continue
+            for result in suite(rows):
+                print(f"  {result['name']:<36} {size:>9,} dòng  {result['min_s'] * 1000:10.2f} ms", file=sys.stderr)
+                results.append(result)
+        del rows
+
+    return {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "processor": platform.processor() or platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "pandas": pd.__version__,
+            "numpy": np.__version__,
+            "seed": seed,
+            "sizes": sizes,
+        },
+        "results": results,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Micro-benchmark các hàm xử lý dữ liệu của app.py")
+    parser.add_argument("--sizes", default="100,10000,1000000", help="Số dòng, cách nhau bởi dấu phẩy")
+    parser.add_argument("--only", default="", help="Chỉ chạy nhóm: paste,read,write,kpi")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Ghi JSON vào file (mặc định in ra stdout)")
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+    only = [part for part in args.only.split(',') if part]
+    report = run(sizes, only, args.seed)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+# fake_sheets.py - Google Sheets giả lập trong bộ nhớ
+# Thay cho phần gspread mà app.py dùng, để chạy thử và kiểm thử tải khi
+# không có spreadsheet thật. Bật trong app: SHEETS_BACKEND=fake
+#
+# Biến môi trường (đều tùy chọn):
+#   FAKE_SHEETS_ROWS         số dòng mỗi tháng (mặc định 2000)
+#   FAKE_SHEETS_LATENCY      độ trễ trung bình mỗi lời gọi, giây (0.08)
+#   FAKE_SHEETS_ERROR_RATE   tỉ lệ lỗi 500/503 ngẫu nhiên (0)
+#   FAKE_SHEETS_QUOTA_RATE   tỉ lệ lỗi 429 ngẫu nhiên (0)
+#   FAKE_SHEETS_QUOTA        quota lượt gọi/phút như Google, 0 là không giới hạn (0)
+#   FAKE_SHEETS_SEED         seed sinh dữ liệu và lỗi (0)
+
+import os
+import random
+import threading
+import time
+from collections import Counter, deque
+
+from gspread.exceptions import APIError
+from gspread.utils import a1_range_to_grid_range, rowcol_to_a1
+
+import app
+from benchmark import generate_weighbridge_rows, sheet_values
+
+class FakeResponse:
+    """Đủ thuộc tính để dựng gspread APIError"""
+
+    def __init__(self, code, message, status):
+        self.status_code = code
+        self.text = message
+        self.headers = {}
+        self._error = {"code": code, "message": message, "status": status}
+
+    def json(self):
+        return {"error": self._error}
+
+def api_error(code):
+    messages = {
+        429: ("Quota exceeded for quota metric 'Read requests'", "RESOURCE_EXHAUSTED"),
+        500: ("Internal error encountered.", "INTERNAL"),
+        503: ("The service is currently unavailable.", "UNAVAILABLE"),
+    }
+    message, status = messages.get(code, ("Error", "UNKNOWN"))
+    return APIError(FakeResponse(code, message, status))
+
+def _split_range(name, default_sheet=None):
+    """"'T1'!A1:U" -> ("T1", "A1:U")"""
+    if '!' in name:
+        sheet, cells = name.rsplit('!', 1)
+        return sheet.strip("'"), cells
+    return default_sheet, name
+
+def _trim(rows):
+    """Bỏ ô trống cuối dòng và dòng trống cuối vùng như API thật"""
+    trimmed = []
+    for row in rows:
+        end = len(row)
+        while end and row[end - 1] in ('', None):
+            end -= 1
+        trimmed.append([str(cell) for cell in row[:end]])
+    while trimmed and not trimmed[-1]:
+        trimmed.pop()
+    return trimmed
+
+# Tên thao tác Google API (như app.sheets_operation) của các lời gọi giả lập
+API_OPERATIONS = {
+    "values_append": "values.append",
+    "values_batch_get": "values.batchGet",
+    "values_batch_update": "values.batchUpdate",
+}
+
+class FakeCell:
+    def __init__(self, row, col, value=''):
+        self.row = row
+        self.col = col
+        self.value = value
+
+class FakeSheetsBackend:
+    """Một spreadsheet giả lập với độ trễ, lỗi 5xx và 429 có thể cấu hình.
+
+    Mọi lời gọi đi qua app.SHEETS_SCHEDULER như request HTTP thật, nên token
+    bucket, thử lại và backoff của app đều được kiểm thử.
+    """
+
+    def __init__(self, months=None, rows_per_month=2000, latency=0.08, jitter=0.5,
+                 error_rate=0.0, quota_rate=0.0, quota_per_minute=0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.quota_rate = quota_rate
+        self.quota_per_minute = quota_per_minute
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._recent = deque()       # thời điểm các lời gọi trong 60 giây gần nhất
+        self.stats = Counter()
+
+        if months is None:
+            months = {
+                name: sheet_values(generate_weighbridge_rows(rows_per_month, seed=seed + number, month=number))
+                for number, name in enumerate(app.SYSTEM_CONFIG["month_mapping"].values(), start=1)
+            }
+        self.spreadsheet = FakeSpreadsheet(self, months)
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            rows_per_month=int(os.getenv("FAKE_SHEETS_ROWS", 2000)),
+            latency=float(os.getenv("FAKE_SHEETS_LATENCY", 0.08)),
+            error_rate=float(os.getenv("FAKE_SHEETS_ERROR_RATE", 0)),
+            quota_rate=float(os.getenv("FAKE_SHEETS_QUOTA_RATE", 0)),
+            quota_per_minute=int(os.getenv("FAKE_SHEETS_QUOTA", 0)),
+            seed=int(os.getenv("FAKE_SHEETS_SEED", 0)),
+        )
+
+    def client(self):
+        return FakeClient(self)
+
+    def call(self, kind, method, fn):
+        """Chạy fn như một request "read"/"write" qua scheduler của app"""
+        return app.SHEETS_SCHEDULER.execute(kind, lambda: self._serve(method, fn),
+                                            operation=API_OPERATIONS.get(method, method))
+
+    def _serve(self, method, fn):
+        with self._lock:
+            self.stats[f"calls.{method}"] += 1
+            delay = max(0.0, self._rng.gauss(self.latency, self.latency * self.jitter))
+            roll = self._rng.random()
+
+            now = time.monotonic()
+            while self._recent and now - self._recent[0] > 60:
+                self._recent.popleft()
+            over_quota = self.quota_per_minute and len(self._recent) >= self.quota_per_minute
+            if not over_quota:
+                self._recent.append(now)
+
+        time.sleep(delay)
+        if over_quota or roll < self.quota_rate:
+            with self._lock:
+                self.stats["errors.429"] += 1
+            raise api_error(429)
+        if roll < self.quota_rate + self.error_rate:
+            code = 503 if roll < self.quota_rate + self.error_rate / 2 else 500
+            with self._lock:
+                self.stats[f"errors.{code}"] += 1
+            raise api_error(code)
+
+        with self._lock:
+            return fn()
+
+class FakeClient:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def open_by_url(self, url):
+        return self.backend.call("read", "open_by_url", lambda: self.backend.spreadsheet)
+
+    def open_by_key(self, key):
+        return self.backend.call("read", "open_by_key", lambda: self.backend.spreadsheet)
+
+class FakeSpreadsheet:
+    """Lưới dữ liệu nằm phía "server" (FakeGrid); worksheets()/worksheet()
+    trả về handle mới mỗi lần như gspread, giữ số dòng/cột lúc lấy metadata."""
+
+    def __init__(self, backend, months):
+        self.backend = backend
+        self._grids = {
+            name: FakeGrid(number, name, values)
+            for number, (name, values) in enumerate(months.items())
+        }
+
+    def worksheets(self):
+        return self.backend.call("read", "worksheets",
+                                 lambda: [FakeWorksheet(self.backend, grid) for grid in self._grids.values()])
+
+    def worksheet(self, title):
+        def find():
+            if title not in self._grids:
+                raise APIError(FakeResponse(400, f"Unable to parse range: {title}", "INVALID_ARGUMENT"))
+            return FakeWorksheet(self.backend, self._grids[title])
+        return self.backend.call("read", "worksheet", find)
+
+    def values_batch_get(self, ranges, params=None):
+        def read():
+            value_ranges = []
+            for name in ranges:
+                sheet, cells = _split_range(name)
+                value_ranges.append({"range": name, "values": self._grids[sheet].read(cells)})
+            return {"valueRanges": value_ranges}
+        return self.backend.call("read", "values_batch_get", read)
+
+    def values_append(self, range, params=None, body=None):
+        def append():
+            sheet, cells = _split_range(range)
+            grid = self._grids[sheet]
+            top = grid.bounds(cells)[0]
+            # Bảng kết thúc ở dòng có dữ liệu cuối cùng (API thật dò vùng liền nhau)
+            last = max((i + 1 for i, row in enumerate(grid.values) if any(cell != '' for cell in row)), default=0)
+            first = max(top, last)
+            values = body["values"]
+            # INSERT_ROWS chèn dòng mới vào lưới
+            grid.row_count = max(grid.row_count + len(values), first + len(values))
+            grid.write(rowcol_to_a1(first + 1, 1), values)
+            updated = f"{rowcol_to_a1(first + 1, 1)}:{rowcol_to_a1(first + len(values), app.SHEET_WIDTH)}"
+            return {"updates": {"updatedRange": f"'{sheet}'!{updated}", "updatedRows": len(values)}}
+        return self.backend.call("write", "values_append", append)
+
+    def values_batch_update(self, body):
+        def write():
+            for item in body["data"]:
+                sheet, cells = _split_range(item["range"])
+                self._grids[sheet].write(cells, item["values"])
+            return {"totalUpdatedRanges": len(body["data"])}
+        return self.backend.call("write", "values_batch_update", write)
+
+class FakeGrid:
+    """Trạng thái một worksheet phía server (chỉ truy cập khi đã giữ lock của backend)"""
+
+    def __init__(self, sheet_id, title, values):
+        self.id = sheet_id
+        self.title = title
+        self.values = [list(row) for row in values]
+        self.row_count = max(1000, len(self.values) + 100)
+        self.col_count = 26
+
+    def bounds(self, cells):
+        grid = a1_range_to_grid_range(cells)
+        return (grid.get("startRowIndex", 0), grid.get("endRowIndex", self.row_count),
+                grid.get("startColumnIndex", 0), grid.get("endColumnIndex", self.col_count))
+
+    def read(self, cells):
+        top, bottom, left, right = self.bounds(cells)
+        if top >= self.row_count:
+            raise APIError(FakeResponse(400, f"Range ({self.title}!{cells}) exceeds grid limits.", "INVALID_ARGUMENT"))
+        return _trim(row[left:right] for row in self.values[top:bottom])
+
+    def write(self, cells, values):
+        top, bottom, left, right = self.bounds(cells)
+        if top + len(values) > self.row_count:
+            raise APIError(FakeResponse(400, f"Range ({self.title}!{cells}) exceeds grid limits.", "INVALID_ARGUMENT"))
+        while len(self.values) < top + len(values):
+            self.values.append([])
+        for offset, row in enumerate(values):
+            target = self.values[top + offset]
+            if len(target) < left + len(row):
+                target.extend([''] * (left + len(row) - len(target)))
+            target[left:left + len(row)] = ["" if cell is None else cell for cell in row]
+
+    def clear(self, cells):
+        top, bottom, left, right = self.bounds(cells)
+        if top >= self.row_count:
+            raise APIError(FakeResponse(400, f"Range ({self.title}!{cells}) exceeds grid limits.", "INVALID_ARGUMENT"))
+        for row in self.values[top:min(bottom, len(self.values))]:
+            row[left:right] = [''] * len(row[left:right])
+
+    def resize(self, rows=None, cols=None):
+        # Thu nhỏ lưới thì mất các dòng/cột bị cắt như API thật
+        if rows is not None:
+            self.row_count = rows
+            del self.values[rows:]
+        if cols is not None:
+            self.col_count = cols
+            for row in self.values:
+                del row[cols:]
+
+class FakeWorksheet:
+    """Handle như gspread Worksheet: số dòng/cột là bản chụp lúc lấy metadata,
+    chỉ đổi khi chính handle này resize"""
+
+    def __init__(self, backend, grid):
+        self.backend = backend
+        self._grid = grid
+        self.id = grid.id
+        self.title = grid.title
+        self.row_count = grid.row_count
+        self.col_count = grid.col_count
+
+    def get(self, range_name=None):
+        return self.backend.call("read", "get", lambda: self._grid.read(range_name or f"A1:{app.SHEET_LAST_COLUMN}"))
+
+    def get_all_values(self):
+        return self.backend.call("read", "get_all_values", lambda: _trim(self._grid.values))
+
+    def range(self, name):
+        def cells():
+            values = self._grid.values
+            top, bottom, left, right = self._grid.bounds(name)
+            return [
+                FakeCell(r + 1, c + 1, values[r][c] if r < len(values) and c < len(values[r]) else '')
+                for r in range(top, bottom) for c in range(left, right)
+            ]
+        return self.backend.call("read", "range", cells)
+
+    def update_cells(self, cell_list, value_input_option="RAW"):
+        def write():
+            for cell in cell_list:
+                self._grid.write(rowcol_to_a1(cell.row, cell.col), [[cell.value]])
+        return self.backend.call("write", "update_cells", write)
+
+    def batch_clear(self, ranges):
+        def clear():
+            for name in ranges:
+                _, cells = _split_range(name, self.title)
+                self._grid.clear(cells)
+        return self.backend.call("write", "batch_clear", clear)
+
+    def resize(self, rows=None, cols=None):
+        self.backend.call("write", "resize", lambda: self._grid.resize(rows, cols))
+        if rows is not None:
+            self.row_count = rows
+        if cols is not None:
+            self.col_count = cols
+
+    def add_rows(self, rows):
+        self.resize(rows=self.row_count + rows)
+
+    def add_cols(self, cols):
+        self.resize(cols=self.col_count + cols)
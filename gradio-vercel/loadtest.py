@@ -0,0 +1,186 @@
+# loadtest.py - Kiểm thử tải các handler Gradio trên Google Sheets giả lập
+# Chạy: python loadtest.py --users 20 --duration 30 [--latency 0.08] [--quota-rate 0.02] [--output ket_qua.json]
+# Mỗi người dùng giả lập gọi lần lượt các handler của app.py (báo cáo, cập nhật
+# Dashboard, lưu dữ liệu dán, tổng hợp năm) theo tỉ lệ --mix; kết quả gồm
+# throughput và độ trễ p50/p95/p99 cho từng loại thao tác.
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime
+
+# Không dùng Google Sheets thật, snapshot và nhật ký lưu ghi vào thư mục tạm riêng
+os.environ["SHEETS_BACKEND"] = "fake"
+os.environ.setdefault("SNAPSHOT_DIR", tempfile.mkdtemp(prefix="kieutimes-loadtest-"))
+os.environ.setdefault("JOURNAL_DIR", tempfile.mkdtemp(prefix="kieutimes-loadtest-journal-"))
+
+import numpy as np
+
+import app
+from benchmark import generate_weighbridge_rows
+from fake_sheets import FakeSheetsBackend
+
+MONTHS = list(app.SYSTEM_CONFIG["month_mapping"])
+
+# Mỗi thao tác: async (rng, cold_rate) -> True nếu thành công
+async def _report(rng, cold_rate):
+    month = rng.choice(MONTHS)
+    if rng.random() < cold_rate:
+        app.MONTH_CACHE.invalidate(app.SYSTEM_CONFIG["default_sheet_url"], app.SYSTEM_CONFIG["month_mapping"][month])
+    result = await app.load_report_data(month)
+    return result[1].startswith(("✅", "📭"))
+
+async def _dashboard(rng, cold_rate):
+    await app.refresh_dashboard_metrics(rng.choice(MONTHS))
+    return True
+
+async def _save(rng, cold_rate, rows=50):
+    month = rng.choice(MONTHS)
+    lines = generate_weighbridge_rows(rows, seed=rng.randrange(1 << 30), month=MONTHS.index(month) + 1)
+    text = '\n'.join('\t'.join(row[:11]) for row in lines)
+    status = await app.save_paste_data(text, month)
+    return status.startswith("✅")
+
+async def _year(rng, cold_rate):
+    df = await app.SHEETS_GATEWAY.read_year()
+    app.summarize_year_data(df if df is not None else app.pd.DataFrame())
+    return df is not None and not df.empty
+
+SCENARIOS = {"report": _report, "dashboard": _dashboard, "save": _save, "year": _year}
+
+def parse_mix(text):
+    """"report=60,dashboard=20" -> {"report": 60, "dashboard": 20}"""
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in SCENARIOS:
+            raise SystemExit(f"Thao tác không hợp lệ: {name} (có: {', '.join(SCENARIOS)})")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+async def simulated_user(user_id, deadline, mix, think, cold_rate, seed, samples):
+    rng = random.Random(seed + user_id)
+    names, weights = list(mix), list(mix.values())
+    while time.monotonic() < deadline:
+        name = rng.choices(names, weights)[0]
+        started = time.perf_counter()
+        try:
+            ok = await SCENARIOS[name](rng, cold_rate)
+        except Exception as e:
+            print(f"⚠️ {name}: {e}", file=sys.stderr)
+            ok = False
+        samples[name].append((time.perf_counter() - started, ok))
+        if think:
+            await asyncio.sleep(rng.uniform(0, think))
+
+def summarize(samples, elapsed):
+    """Độ trễ (ms) và throughput theo từng loại thao tác"""
+    def describe(items):
+        latencies = np.array([latency for latency, _ in items]) * 1000
+        errors = sum(1 for _, ok in items if not ok)
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if len(latencies) else (None, None, None)
+        return {
+            "count": len(items),
+            "errors": errors,
+            "error_rate": errors / len(items) if items else 0.0,
+            "throughput_per_s": len(items) / elapsed if elapsed else 0.0,
+            "mean_ms": float(latencies.mean()) if len(latencies) else None,
+            "p50_ms": float(p50) if p50 is not None else None,
+            "p95_ms": float(p95) if p95 is not None else None,
+            "p99_ms": float(p99) if p99 is not None else None,
+            "max_ms": float(latencies.max()) if len(latencies) else None,
+        }
+
+    results = {name: describe(items) for name, items in samples.items()}
+    results["all"] = describe([item for items in samples.values() for item in items])
+    return results
+
+async def run(args):
+    backend = FakeSheetsBackend(
+        rows_per_month=args.rows,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        quota_rate=args.quota_rate,
+        quota_per_minute=args.quota,
+        seed=args.seed,
+    )
+    app.CLIENT_POOL.install(backend.client())
+    if args.read_quota or args.write_quota:
+        app.SHEETS_SCHEDULER = app.SheetsCallScheduler(read_quota=args.read_quota, write_quota=args.write_quota)
+
+    mix = parse_mix(args.mix)
+    samples = defaultdict(list)
+    started = time.monotonic()
+    deadline = started + args.duration
+    await asyncio.gather(*(
+        simulated_user(user, deadline, mix, args.think, args.cold_rate, args.seed, samples)
+        for user in range(args.users)
+    ))
+    elapsed = time.monotonic() - started
+
+    return {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "users": args.users,
+            "duration_s": elapsed,
+            "mix": mix,
+            "rows_per_month": args.rows,
+            "latency_s": args.latency,
+            "error_rate": args.error_rate,
+            "quota_rate": args.quota_rate,
+            "quota_per_minute": args.quota,
+            "cold_rate": args.cold_rate,
+            "seed": args.seed,
+        },
+        "results": summarize(samples, elapsed),
+        "backend": dict(backend.stats),
+        "scheduler": app.SHEETS_SCHEDULER.stats(),
+        "cache": app.MONTH_CACHE.stats(),
+        "gateway": app.SHEETS_GATEWAY.stats(),
+        "save_queue": app.SAVE_QUEUE.stats(),
+    }
+
+def print_table(report):
+    print(f"{'Thao tác':<10} {'Số lượt':>8} {'Lỗi':>5} {'/giây':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}", file=sys.stderr)
+    for name, row in report["results"].items():
+        if not row["count"]:
+            continue
+        print(f"{name:<10} {row['count']:>8} {row['errors']:>5} {row['throughput_per_s']:>8.2f} "
+              f"{row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} {row['p99_ms']:>9.1f}", file=sys.stderr)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Kiểm thử tải handler Gradio trên Google Sheets giả lập")
+    parser.add_argument("--users", type=int, default=20, help="Số người dùng đồng thời")
+    parser.add_argument("--duration", type=float, default=30, help="Thời gian chạy (giây)")
+    parser.add_argument("--mix", default="report=60,dashboard=20,save=10,year=10", help="Tỉ lệ các thao tác")
+    parser.add_argument("--think", type=float, default=0.5, help="Thời gian nghỉ tối đa giữa hai thao tác (giây)")
+    parser.add_argument("--cold-rate", type=float, default=0.1, help="Tỉ lệ lượt báo cáo bỏ qua cache tháng")
+    parser.add_argument("--rows", type=int, default=2000, help="Số dòng mỗi tháng giả lập")
+    parser.add_argument("--latency", type=float, default=0.08, help="Độ trễ trung bình mỗi lời gọi Sheets (giây)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Tỉ lệ lỗi 5xx")
+    parser.add_argument("--quota-rate", type=float, default=0.0, help="Tỉ lệ lỗi 429 ngẫu nhiên")
+    parser.add_argument("--quota", type=int, default=0, help="Quota phía server (lượt/phút), 0 là không giới hạn")
+    parser.add_argument("--read-quota", type=int, default=0, help="Thay sheets_read_quota của app (lượt/phút)")
+    parser.add_argument("--write-quota", type=int, default=0, help="Thay sheets_write_quota của app (lượt/phút)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Ghi JSON vào file (mặc định in ra stdout)")
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(run(args))
+    print_table(report)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()